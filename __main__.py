@@ -1,19 +1,37 @@
 #!/usr/bin/env python3
 
+import _thread
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import logging.handlers
+import queue
+import signal
 import sys
+from threading import Event, Thread
+import time
 
 from colorstreamhandler import ColorStreamHandler
 
-from bots import IRCBot, TelegramImageBot
+# Heavy third-party modules (twx.botapi, imgurpython, requests, yaml)
+# are imported on first use, so the IRC connection can be started before they are loaded.
+from bots.pool import IRCPool
 import config
-from handlers import AuthHandler, ImageHandler
+from config.watcher import ConfigWatcher
+from handlers import AuthHandler, BaseHandler, ImageHandler, MaintenanceJob, RetryScheduler
+from models.cache import ImageCache
+from models.fileinfo import FileInfoCache
 from models.image import ImageDatabase
 from models.user import UserDatabase
+from util.endpoints import configure_endpoints
+from util.log import (JSONFormatter, LazyQueueHandler, NewStyleLogRecord, RateLimitFilter,
+                      SuppressedCountFormatter)
+from util.profiler import profile_path
 
 
 CONFIG_FILE = "config.yaml"
+# Top-level loggers of the application
+APP_LOGGERS = ("__main__", "asyncirc", "bots", "config", "handlers", "metrics", "models", "util")
 
 l = logging.getLogger(__name__)
 
@@ -36,52 +54,88 @@ def verify_config(conf):
     return False
 
 
+def start_telegram(conf, user_db):
+    from bots import TelegramImageBot
+
+    configure_endpoints(conf)
+    tg_bot = TelegramImageBot(conf, user_db, token=conf.telegram.token)
+    l.info("Me: {}", tg_bot.update_bot_info().wait())
+    tg_bot.file_infos = FileInfoCache.from_conf(conf)
+    if conf.telegram.record.path:
+        from bots.recorder import UpdateRecorder
+        tg_bot.recorder = UpdateRecorder(conf.telegram.record.path,
+                                         contents=conf.telegram.record.contents)
+    return tg_bot
+
+
+def load_backlog(conf):
+    if not conf.storage.database:
+        return []
+    with ImageDatabase(conf.storage.database) as db:
+        return db.get_unfinished_images()
+
+
 def init_logging(conf, console_level):
     console_fmt = "| {levelname:^8} | {message} (from {name}; {threadName})"
     file_fmt = "| {asctime} " + console_fmt
-    asyncirc_logger = logging.getLogger("asyncirc")
-
-    class NewStyleLogRecord(logging.LogRecord):
-        def getMessage(self):  # noqa
-            msg = self.msg
-            if not isinstance(self.msg, str):
-                msg = str(self.msg)
-            if not isinstance(self.args, tuple):
-                self.args = (self.args,)
-            return msg.rstrip().format(*self.args)
-    logging.setLogRecordFactory(NewStyleLogRecord)
 
+    handlers = []
     handler = ColorStreamHandler(sys.stdout)
-    handler.setFormatter(logging.Formatter(console_fmt, style='{'))
-    handler.addFilter(lambda r: r.levelno >= console_level)
-
-    l.addHandler(handler)
-    asyncirc_logger.addHandler(handler)
+    handler.setFormatter(SuppressedCountFormatter(console_fmt, style='{'))
+    handler.setLevel(console_level)
+    handlers.append(handler)
 
     conf_level = console_level
     if conf.logging.active:
-        conf_level = getattr(logging, (conf.logging.level or "WARN").upper())
+        conf_level = conf.logging.level
 
-        handler = logging.handlers.TimedRotatingFileHandler(conf.logging.path or "log",
+        handler = logging.handlers.TimedRotatingFileHandler(conf.logging.path,
                                                             **conf.logging.rotate)
-        handler.setFormatter(logging.Formatter(file_fmt, style='{'))
-        handler.addFilter(lambda r: r.levelno >= conf_level)
-
-        l.addHandler(handler)
-        asyncirc_logger.addHandler(handler)
-
-    min_level = min(console_level, conf_level)
+        if conf.logging.json:
+            handler.setFormatter(JSONFormatter())
+        else:
+            handler.setFormatter(SuppressedCountFormatter(file_fmt, style='{'))
+        handler.setLevel(conf_level)
+        handlers.append(handler)
+
+    # Loggers only enqueue records;
+    # formatting and I/O happen in the listener thread, for records that pass the handler levels
+    queue_handler = LazyQueueHandler(queue.Queue())
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    for name in APP_LOGGERS:
+        logging.getLogger(name).addHandler(queue_handler)
+
+    def reconfigure(conf):
+        """Apply the level and rate limit settings, also after a config reload."""
+        conf_level = console_level
+        if len(handlers) > 1:
+            conf_level = conf.logging.level
+            handlers[1].setLevel(conf_level)
+
+        for filter_ in queue_handler.filters[:]:
+            queue_handler.removeFilter(filter_)
+        if conf.logging.rate_limit.active:
+            queue_handler.addFilter(
+                RateLimitFilter(per_second=conf.logging.rate_limit.per_second,
+                                burst=conf.logging.rate_limit.burst))
+
+        for name in APP_LOGGERS:
+            logging.getLogger(name).setLevel(min(console_level, conf_level))
+        return conf_level
+
+    conf_level = reconfigure(conf)
     max_level = max(console_level, conf_level)
-    l.setLevel(min_level)
-    asyncirc_logger.setLevel(min_level)
-
     l.log(max_level,
           "application started; console logging level: {}; file logging level: {}",
           console_level,
           conf_level if conf.logging.active else "disabled")
 
     # return minimum level required to pass all filters
-    return max_level
+    return max_level, reconfigure
 
 
 ###############################################################################
@@ -96,47 +150,127 @@ def main():
         else:
             console_level = getattr(logging, sys.argv[1].upper(), console_level)
     # Read config and init logging
-    conf = config.read_file(CONFIG_FILE)
-    all_log_level = init_logging(conf=conf, console_level=console_level)
-    l.info("config: {!s}", conf)
+    # (the record factory is needed for the config module's messages already)
+    logging.setLogRecordFactory(NewStyleLogRecord)
+    try:
+        conf = config.read_file(CONFIG_FILE)
+    except config.ConfigError as e:
+        print(e, file=sys.stderr)
+        return 2
+    all_log_level, reconfigure_logging = init_logging(conf=conf, console_level=console_level)
+    l.info("config: {!s}", config.to_dict(conf))
 
     # Verify other config
     if not verify_config(conf):
         return 2
 
+    # Take over the IRC connection and Telegram offset from a running instance, if there is one
+    handoff = None
+    if conf.handoff.path:
+        from util.handoff import request_handoff
+        handoff = request_handoff(conf.handoff.path, timeout=conf.handoff.timeout)
+
+    # Serve metrics, if requested
+    if conf.metrics.active:
+        from metrics.server import MetricsServer
+        MetricsServer(host=conf.metrics.host,
+                      port=conf.metrics.port).start()
+
     # Load user database
-    user_db = UserDatabase(conf.storage.user_database or "users.json")
-
-    # Start IRC bot
-    irc_bot = IRCBot(
-        host=conf.irc.host,
-        port=conf.irc.port or 6667,
-        nick=conf.irc.nick or "TelegramBot",
-        realname=conf.irc.nick,
-        password=conf.irc.password or None,
-        use_ssl=conf.irc.ssl or False
-    )
-    irc_bot.start()
-    if not irc_bot.wait_connected(conf.irc.timeout or 7):
-        l.critical("couldn't connect to IRC")
-        irc_bot.stop()
-        return 3
-    l.info("connected to IRC")
-    irc_bot.join(conf.irc.channel)
+    user_db = UserDatabase(conf.storage.user_database)
 
-    # Start Telegram bot
-    tg_bot = TelegramImageBot(conf, user_db, token=conf.telegram.token)
-    l.info("Me: {}", tg_bot.update_bot_info().wait())
+    # Bootstrap IRC, Telegram and the database concurrently.
+    # IRC registration (the MOTD wait) may finish last;
+    # joins and posts are queued by the IRC bots until then.
+    irc_pool = IRCPool(conf)
+    irc_bot = irc_pool.default
+
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix="Bootstrap") as executor:
+        if handoff and handoff[0].get('irc'):
+            irc_started = executor.submit(irc_pool.start, handoff[0]['irc'], handoff[1])
+        else:
+            irc_started = executor.submit(irc_pool.start)
+        telegram_started = executor.submit(start_telegram, conf, user_db)
+        backlog_loaded = executor.submit(load_backlog, conf)
+
+        # Index locally cached images, unless they are deleted right away
+        image_cache = None
+        if not conf.storage.delete_images:
+            image_cache = ImageCache(max_bytes=conf.storage.cache.max_bytes or None,
+                                     max_files=conf.storage.cache.max_files or None,
+                                     dbpath=conf.storage.database)
+            image_cache.load()
+
+        try:
+            irc_started.result()
+        except OSError as e:
+            l.critical("couldn't connect to IRC: {}", e)
+            return 3
+        try:
+            tg_bot = telegram_started.result()
+            if handoff:
+                tg_bot.offset = handoff[0]['offset']
+            backlog = backlog_loaded.result()
+        except:
+            irc_pool.stop()
+            raise
+
+    # Run image jobs in worker processes, if configured
+    workers = None
+    if conf.workers.processes:
+        from handlers.workers import WorkerPool
+        workers = WorkerPool(conf, irc_pool, user_db, cache=image_cache)
+        workers.start()
+
+    # or as coroutines of one event loop
+    pipeline = None
+    if conf.pipeline.asyncio and not workers:
+        from handlers.pipeline import ImagePipeline
+        pipeline = ImagePipeline(conf, irc_pool, tg_bot, user_db, cache=image_cache)
+        pipeline.start()
+
+    def pending_images():
+        if workers:
+            return workers.pending()
+        if pipeline:
+            return pipeline.pending()
+        return BaseHandler.live_handlers().get('ImageHandler', 0)
+
+    tg_bot.admission.pending = pending_images
+
+    memstats = tg_bot.memstats
+    memstats.queues.update(irc=irc_pool.queue_sizes, image_jobs=pending_images,
+                           reorder=lambda: len(ImageHandler.order))
+    if image_cache:
+        memstats.queues['cache_files'] = lambda: image_cache.stats()['files']
+
+    # Stop polling if IRC registration does not complete in time
+    irc_failed = Event()
+
+    def watch_irc_registration():
+        if irc_bot.wait_connected(conf.irc.timeout):
+            l.info("connected to IRC")
+        else:
+            l.critical("couldn't connect to IRC")
+            irc_failed.set()
+            _thread.interrupt_main()
+
+    Thread(target=watch_irc_registration, name="IRCRegistration", daemon=True).start()
 
     # Register image callback as a closure
     def on_image(img):
-        nonlocal conf, irc_bot, tg_bot, user_db
+        nonlocal conf, irc_pool, tg_bot, user_db, image_cache
+        if workers:
+            return workers.submit(img)
+        if pipeline:
+            return pipeline.submit(img)
         thread = ImageHandler(
             conf=conf,
-            irc_bot=irc_bot,
+            irc_pool=irc_pool,
             tg_bot=tg_bot,
             user_db=user_db,
-            img=img
+            img=img,
+            cache=image_cache
         )
         thread.start()
         return thread
@@ -158,26 +292,143 @@ def main():
 
     tg_bot.on_auth = on_auth
 
-    # Go through backlog and reschedule failed image uploads
-    if conf.storage.database:
-        with ImageDatabase(conf.storage.database) as db:
-            backlog = db.get_unfinished_images()
+    # Retry failed jobs in the background, once the backlog is through
+    retry_scheduler = None
+    if conf.retry.active and conf.storage.database:
+        retry_scheduler = RetryScheduler(conf, on_image)
+
+    # Archive old images and compact the database, also once the backlog is through
+    maintenance = None
+    if conf.maintenance.active and conf.storage.database:
+        maintenance = MaintenanceJob(conf)
+
+    # Go through backlog and reschedule failed image uploads, while already polling
+    def process_backlog():
         if backlog:
             l.info("Going through backlog, size: {}", len(backlog))
             for img in backlog:
                 on_image(img).join()
             l.info("Finished backlog")
+        if retry_scheduler:
+            retry_scheduler.start()
+        if maintenance:
+            maintenance.start()
+
+    Thread(target=process_backlog, name="Backlog", daemon=True).start()
+
+    # Apply config changes to new work without restarting
+    def on_reload(new_conf, changed):
+        nonlocal conf
+        conf = new_conf
+        tg_bot.conf = new_conf
+        if workers:
+            workers.update_conf(new_conf)
+        if pipeline:
+            pipeline.conf = new_conf
+        if retry_scheduler:
+            retry_scheduler.conf = new_conf
+        if maintenance:
+            maintenance.conf = new_conf
+        if image_cache and any(k.startswith("storage.cache.") for k in changed):
+            image_cache.resize(max_bytes=new_conf.storage.cache.max_bytes or None,
+                               max_files=new_conf.storage.cache.max_files or None)
+        if any(k.startswith("logging.") for k in changed):
+            reconfigure_logging(new_conf)
+        if "routes" in changed:
+            irc_pool.join_routes(new_conf)
+
+    config_watcher = ConfigWatcher(CONFIG_FILE, conf, on_reload,
+                                   watch=conf.reload.watch, interval=conf.reload.interval)
+    config_watcher.start()
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: config_watcher.request())
+
+    # Log a memory report on request; the first one starts tracemalloc
+    def log_memstats():
+        l.warn("memory report:\n{}", "\n".join(memstats.report()))
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: Thread(
+            target=log_memstats, name="MemStats", daemon=True).start())
+
+    # Profile all threads on request
+    def log_profile(profile, path):
+        if profile:
+            l.warn("profile written to {}:\n{}", path, "\n".join(profile.summary()))
+
+    def start_profile():
+        if not tg_bot.profiler.start(conf.profiler.seconds, profile_path(conf.profiler.path),
+                                     interval=conf.profiler.interval,
+                                     on_done=log_profile):
+            l.warn("a profile is running already")
+
+    if hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, lambda signum, frame: start_profile())
+
+    # Hand over to a new process on request
+    handoff_server = None
+    if conf.handoff.path:
+        from util.handoff import HandoffServer
+
+        def prepare_handoff():
+            offset = tg_bot.stop_polling()
+            if retry_scheduler:
+                retry_scheduler.stop()
+            if maintenance:
+                maintenance.stop()
+            deadline = time.monotonic() + conf.handoff.drain_timeout
+            while pending_images() and time.monotonic() < deadline:
+                time.sleep(0.1)
+            if pending_images():
+                # Their posts would go to a detached connection and be lost;
+                # keep it to finish them and let the successor connect on its own
+                l.warn("{} image jobs still running after {} s; handing over the Telegram offset"
+                       " only", pending_images(), conf.handoff.drain_timeout)
+                return dict(offset=offset, irc={}), []
+            l.info("drained image handlers; live handlers: {}", dict(BaseHandler.live_handlers()))
+
+            socks, irc_state = irc_pool.detach_state()
+            return dict(offset=offset, irc=irc_state), socks
+
+        handoff_server = HandoffServer(conf.handoff.path, prepare_handoff)
+        handoff_server.start()
 
     # Main loop
     try:
         tg_bot.poll_loop()
+        if handoff_server and handoff_server.requested.is_set():
+            handoff_server.done.wait(conf.handoff.drain_timeout + 30)
     except KeyboardInterrupt:
-        print("user interrupt...")
+        if not irc_failed.is_set():
+            print("user interrupt...")
     except:
-        l.exception()
+        l.exception("unexpected error in main loop")
     finally:
-        logging.log(all_log_level, "shutting down")
-        irc_bot.stop()
+        l.log(all_log_level, "shutting down")
+        config_watcher.stop()
+        if handoff_server and not handoff_server.requested.is_set():
+            handoff_server.close()
+        if retry_scheduler:
+            retry_scheduler.stop()
+        if maintenance:
+            maintenance.stop()
+        if tg_bot.recorder:
+            tg_bot.recorder.close()
+        # Jobs left running by a handoff post through this process' connections
+        try:
+            while handoff_server and handoff_server.requested.is_set() and pending_images():
+                l.info("waiting for {} image jobs before disconnecting", pending_images())
+                time.sleep(1)
+        except KeyboardInterrupt:
+            l.warn("interrupted; {} image jobs will not be posted", pending_images())
+        if workers:
+            workers.stop()
+        if pipeline:
+            pipeline.stop()
+        irc_pool.stop()
+
+    if irc_failed.is_set():
+        return 3
 
 
 if __name__ == '__main__':
@@ -55,6 +55,11 @@ class IRCBot(IRCClient):
 
     _process_thread = None
 
+    def __init__(self, *args, **kwargs):
+        IRCClient.__init__(self, *args, **kwargs)
+        # Handlers are registered per instance, so several bots can run side by side
+        self._handlers = dict((type, []) for type in self._handlers)
+
     def _async_process(self):
         while not self._stop_event.is_set():
             time.sleep(0.01)
@@ -122,11 +127,22 @@ class IRCBot(IRCClient):
             except Exception as e:
                 logger.exception("Error while handling message " + str(args))
 
-    def start(self):
-        IRCClient.start(self)
+    def start(self, retry=False):
+        IRCClient.start(self, retry)
         self._process_thread = threading.Thread(target=self._async_process)
         self._process_thread.start()
 
+    def adopt(self, sock, recv_buffer=b""):
+        IRCClient.adopt(self, sock, recv_buffer)
+        self._process_thread = threading.Thread(target=self._async_process)
+        self._process_thread.start()
+
+    def detach(self, timeout=10):
+        detached = IRCClient.detach(self, timeout)
+        if detached and self._process_thread:
+            self._process_thread.join()
+        return detached
+
     def on(self, type):
         '''Decorator function'''
         def decorator(self, func):
@@ -4,6 +4,7 @@ import socket
 import ssl
 import threading
 import logging
+import random
 import time
 
 if sys.hexversion < 0x03000000:
@@ -48,6 +49,7 @@ class IRCClient(object):
     _out_queue = None
     _send_thread = None
     _recv_thread = None
+    _supervisor_thread = None
     _stop_event = None
 
     host = None
@@ -59,7 +61,8 @@ class IRCClient(object):
     running = True
 
     def __init__(self, host, port=6667, nick='UNCONFIGURED', ident='PythonIRCClient', realname='PythonIRCClient',
-                 password=None, use_ssl=False):
+                 password=None, use_ssl=False, connect_timeout=10, keepalive=120,
+                 min_reconnect_delay=1, max_reconnect_delay=300):
         """Create a new IRC Client instance
 
         :param host: required server host
@@ -73,43 +76,76 @@ class IRCClient(object):
         :param realname='PythonIRCClient': Your real name (pseudonym, etc)
 
         :param password=None: Password for the server
+
+        :param keepalive=120: seconds without data from the server before it is PINGed;
+            the connection is considered dead after twice that time
+
+        :param min_reconnect_delay=1, max_reconnect_delay=300: bounds of the jittered
+            exponential backoff between reconnect attempts
         """
-        self.host = socket.getaddrinfo(host, port)[0]
+        self.host = host
+        self.port = port
         self.nick = nick
         self.password = password
         self.ident = ident
         self.realname = realname
         self.use_ssl = use_ssl
+        self.connect_timeout = connect_timeout
+        self.keepalive = keepalive
+        self.min_reconnect_delay = min_reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+        self.address = None  # address of the current connection
+        self.reconnects = 0
 
         self._in_queue = queue.Queue()
         self._out_queue = queue.Queue()
         self._stop_event = threading.Event()
-
+        self._connected_event = threading.Event()  # set while the socket is usable
+        self._lost_event = threading.Event()
+        self._socket_lock = threading.Lock()
+        self._last_recv = time.monotonic()
+        self._recv_buffer = b""  # received bytes of an incomplete line
+
+        self._ssl_context = None
+        self._tls_session = None
         if use_ssl:
-            self._socket = ssl.wrap_socket(socket.socket(self.host[0], socket.SOCK_STREAM))
-        else:
-            self._socket = socket.socket(self.host[0], socket.SOCK_STREAM)
-
+            # As with the former `ssl.wrap_socket`, certificates are not verified.
+            # One context for all connections, so TLS sessions can be resumed.
+            self._ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            self._ssl_context.check_hostname = False
+            self._ssl_context.verify_mode = ssl.CERT_NONE
 
     def _async_send(self):
         logger.info("Send loop started")
         while not self._stop_event.is_set():
-            time.sleep(0.01)
+            if not self._connected_event.wait(1):
+                continue
             try:
                 msg = self._out_queue.get(timeout=1)
-                if msg:
-                    while True: #Retry sending until it succeeds
-                        time.sleep(0.01)
-                        try:
-                            self._socket.send(msg.encode("UTF-8"))
-                            self._out_queue.task_done()
-                        except (BlockingIOError, ssl.SSLWantWriteError):
-                            pass
-                        else:
-                            break
-                    logger.debug("<- {!r}".format(msg))
             except queue.Empty as e:
-                pass
+                continue
+            if not msg:
+                continue
+            sock = self._socket
+            try:
+                data = msg.encode("UTF-8")
+                while data:
+                    try:
+                        sent = sock.send(data)
+                    except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                        time.sleep(0.01)
+                    else:
+                        data = data[sent:]
+            except (OSError, AttributeError) as e:
+                # The line is lost; callers that need delivery replay it after reconnecting
+                self._connection_lost(e, sock)
+            else:
+                logger.debug("<- {!r}", msg)
+            finally:
+                self._out_queue.task_done()
+            if self._out_queue.empty():
+                self._on_sent_all()
         logger.info("Send loop stopped")
 
     def _async_recv(self):
@@ -117,23 +153,32 @@ class IRCClient(object):
         decoding should be handling inside this function"""
 
         logger.info("Receive loop started")
-        recbuffer = b""
 
         while not self._stop_event.is_set():
+            if not self._connected_event.wait(1):
+                continue
+            sock = self._socket
             time.sleep(0.01)
             try:
-                recbuffer = recbuffer + self._socket.recv(1024)
-                data = recbuffer.split(b'\r\n')
-                recbuffer = data.pop()
-                if data:
-                    for line in data:
-                        self._process_data(line.decode(encoding='UTF-8', errors='ignore'))
+                chunk = sock.recv(4096)
             except (BlockingIOError, ssl.SSLWantReadError) as e:
-                pass
+                continue
+            except (OSError, AttributeError) as e:
+                self._connection_lost(e, sock)
+                continue
+            if not chunk:
+                self._connection_lost("connection closed by server", sock)
+                continue
+
+            self._last_recv = time.monotonic()
+            data = (self._recv_buffer + chunk).split(b'\r\n')
+            self._recv_buffer = data.pop()
+            for line in data:
+                self._process_data(line.decode(encoding='UTF-8', errors='ignore'))
         logger.info("Receive loop stopped")
 
     def _process_data(self, line):
-        logger.debug("-> {!r}".format(line))
+        logger.debug("-> {!r}", line)
         line = line.rstrip()
         line = line.split()
         if not line:
@@ -144,33 +189,254 @@ class IRCClient(object):
         else:
             self._in_queue.put(line)
 
-    def start(self):
-        self._socket.connect(self.host[4])
-        self._socket.setblocking(0)
+    def _connection_lost(self, error, sock=None):
+        with self._socket_lock:
+            if not self._connected_event.is_set() or self._stop_event.is_set():
+                return  # already noticed, or shutting down
+            if sock is not None and sock is not self._socket:
+                return  # error of a previous connection
+            self._connected_event.clear()
+        logger.warning("Lost connection to {}: {}".format(self.host, error))
+        self._lost_event.set()
+
+    # Connecting
+
+    def _resolve(self):
+        # Resolved again for every connection, the server's addresses may have changed
+        infos = socket.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+        # Alternate address families, starting with the preferred one (RFC 8305)
+        by_family = {}
+        for info in infos:
+            by_family.setdefault(info[0], []).append(info)
+        families = list(by_family.values())
+        ordered = []
+        while any(families):
+            for infos in families:
+                if infos:
+                    ordered.append(infos.pop(0))
+        return ordered
+
+    def _open_connection(self, infos, attempt_delay=0.25):
+        """Connect to the first address that answers ("Happy Eyeballs").
+
+        A new attempt is started every `attempt_delay` seconds,
+        or as soon as the previous one failed, without cancelling the ones in flight.
+        """
+        results = queue.Queue()
 
-        self.running = True
+        def attempt(info):
+            family, type_, proto, _, sockaddr = info
+            sock = socket.socket(family, type_, proto)
+            try:
+                sock.settimeout(self.connect_timeout)
+                sock.connect(sockaddr)
+            except OSError as e:
+                sock.close()
+                results.put((None, sockaddr, e))
+            else:
+                results.put((sock, sockaddr, None))
+
+        deadline = time.monotonic() + self.connect_timeout
+        pending = list(infos)
+        running = 0
+        error = None
+        winner = None
+        while pending or running:
+            if pending:
+                threading.Thread(target=attempt, args=(pending.pop(0),), daemon=True,
+                                 name="IRCConnect").start()
+                running += 1
+            timeout = attempt_delay if pending else deadline - time.monotonic()
+            try:
+                sock, sockaddr, error = results.get(timeout=max(0, timeout))
+            except queue.Empty as e:
+                if not pending:
+                    error = socket.timeout("timed out")
+                    break
+                continue
+            running -= 1
+            if sock:
+                winner = (sock, sockaddr)
+                break
+            logger.info("Connecting to {} failed: {}".format(sockaddr, error))
+
+        def close_late(count):
+            for _ in range(count):
+                sock = results.get()[0]
+                if sock:
+                    sock.close()
+        if running:
+            threading.Thread(target=close_late, args=(running,), daemon=True).start()
+
+        if not winner:
+            raise error or OSError("no addresses for {}".format(self.host))
+        return winner
+
+    def _connect(self):
+        sock, self.address = self._open_connection(self._resolve())
+        if self._ssl_context:
+            try:
+                sock = self._ssl_context.wrap_socket(sock, server_hostname=self.host,
+                                                     session=self._tls_session)
+            except (OSError, ValueError):
+                sock.close()
+                raise
+            logger.info("Using {} with {}; session reused: {}".format(
+                sock.version(), self.address, sock.session_reused))
+        sock.setblocking(0)
+
+        with self._socket_lock:
+            old, self._socket = self._socket, sock
+            # Lines queued for the old connection would precede the registration
+            while True:
+                try:
+                    self._out_queue.get_nowait()
+                    self._out_queue.task_done()
+                except queue.Empty as e:
+                    break
+            self._last_recv = time.monotonic()
+            self._recv_buffer = b""
+            self._lost_event.clear()
+            self._connected_event.set()
+        if old is not None:
+            old.close()
+
+        self._register()
+        self._on_connected()
+
+    def _register(self):
+        if self.password:
+            self.send_raw("PASS {password}".format(password=self.password))
+        self.send_raw("NICK {nick}".format(nick=self.nick))
+        self.send_raw("USER {ident} {host} localhost :{realname}".format(
+            ident=self.ident,
+            host=self.address[0],
+            realname=self.realname))
+
+    def _on_connected(self):
+        """Called after every (re)connect, once the registration is queued."""
+        pass
+
+    def _on_disconnected(self):
+        """Called after the connection was lost, before reconnecting."""
+        pass
 
+    def _on_sent_all(self):
+        """Called by the send loop when it has written every queued line."""
+        pass
+
+    def _supervise(self):
+        """Reconnect with jittered exponential backoff when the connection is lost."""
+        while not self._stop_event.is_set():
+            if not self._lost_event.wait(1):
+                # keepalive: PING a quiet server, give up on a silent one
+                quiet = time.monotonic() - self._last_recv
+                if self.keepalive and quiet > 2 * self.keepalive:
+                    self._connection_lost("no data for {:.0f}s".format(quiet))
+                elif self.keepalive and quiet > self.keepalive:
+                    self.send_raw("PING :keepalive")
+                continue
+
+            if self._ssl_context and self._socket is not None:
+                try:
+                    self._tls_session = self._socket.session or self._tls_session
+                except (AttributeError, ValueError):
+                    pass
+            self._on_disconnected()
+
+            attempt = 0
+            while not self._stop_event.is_set():
+                delay = min(self.min_reconnect_delay * 2 ** attempt, self.max_reconnect_delay)
+                delay *= random.uniform(0.5, 1.5)
+                logger.info("Reconnecting to {} in {:.1f}s".format(self.host, delay))
+                if self._stop_event.wait(delay):
+                    return
+                attempt += 1
+                try:
+                    self._connect()
+                except OSError as e:
+                    logger.warning("Reconnecting to {} failed: {}".format(self.host, e))
+                else:
+                    self.reconnects += 1
+                    break
+
+    def start(self, retry=False):
+        """Connect (raising OSError on failure) and start the worker threads.
+
+        Connections lost later are re-established in the background.
+        With `retry`, a failed first connect is retried in the background as well.
+        """
+        self.running = True
+        try:
+            self._connect()
+        except OSError as e:
+            if not retry:
+                raise
+            logger.warning("Connecting to {} failed: {}".format(self.host, e))
+            self._lost_event.set()
+        self._start_threads()
+
+    def _start_threads(self):
         self._send_thread = threading.Thread(target=self._async_send)
         self._recv_thread = threading.Thread(target=self._async_recv)
+        self._supervisor_thread = threading.Thread(target=self._supervise, name="IRCSupervisor")
 
         self._send_thread.start()
         self._recv_thread.start()
+        self._supervisor_thread.start()
+
+    def adopt(self, sock, recv_buffer=b""):
+        """Continue an established and registered connection, e.g. one returned by `detach`."""
+        sock.setblocking(0)
+        with self._socket_lock:
+            self._socket = sock
+            self.address = sock.getpeername()
+            self._recv_buffer = recv_buffer
+            self._last_recv = time.monotonic()
+            self._connected_event.set()
+        self.running = True
+        self._start_threads()
 
-        if self.password:
-            self.send_raw("PASS {password}".format(password=self.password))
-        self.send_raw("NICK {nick}".format(nick=self.nick))
-        self.send_raw("USER {ident} {host} localhost :{realname}".format(
-            ident=self.ident,
-            host=self.host[4][0],
-            realname=self.realname))
+    def detach(self, timeout=10):
+        """Stop all threads, but keep the connection open and return it instead of closing it.
 
+        Waits up to `timeout` seconds for queued lines to be sent.
+        Returns the socket and the received bytes of an incomplete line,
+        or None if there is no connection to hand out (TLS state cannot be transferred).
+        """
+        if self._ssl_context or not self._connected_event.is_set():
+            return None
+
+        deadline = time.monotonic() + timeout
+        while self._out_queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.running = False
+        self._stop_event.set()
+        for thread in (self._send_thread, self._recv_thread, self._supervisor_thread):
+            if thread and thread.is_alive():
+                thread.join()
+        with self._socket_lock:
+            sock, self._socket = self._socket, None
+            self._connected_event.clear()
+        sock.setblocking(1)
+        return sock, self._recv_buffer
 
     def stop(self):
         self.running = False
-        self.send_raw("QUIT")
         self._stop_event.set()
-        self._send_thread.join()
-        self._recv_thread.join()
+        if self._connected_event.is_set():
+            try:
+                self._socket.setblocking(1)
+                self._socket.settimeout(1)
+                self._socket.sendall(b"QUIT\r\n")
+            except OSError as e:
+                pass
+        for thread in (self._send_thread, self._recv_thread, self._supervisor_thread):
+            if thread and thread.is_alive():
+                thread.join()
+        if self._socket is not None:
+            self._socket.close()
         self.running = False
 
     def get_message(self, block=True, timeout=None):
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""Compare two JSON benchmark reports.
+
+    python -m bench.compare baseline.json candidate.json
+"""
+
+import json
+import sys
+
+
+def flatten(data, prefix=""):
+    for key, value in sorted(data.items()):
+        if key == 'params':
+            continue
+        name = prefix + key
+        if isinstance(value, dict):
+            yield from flatten(value, name + ".")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print(__doc__.strip())
+        return 2
+
+    with open(argv[0]) as f:
+        base = dict(flatten(json.load(f)))
+    with open(argv[1]) as f:
+        new = dict(flatten(json.load(f)))
+
+    width = max(map(len, base.keys() | new.keys()))
+    for key in sorted(base.keys() | new.keys()):
+        old, cur = base.get(key), new.get(key)
+        change = ""
+        if old and cur is not None:
+            change = "{:+.1%}".format((cur - old) / old)
+        print("{:<{}}  {:>14}  {:>14}  {:>8}".format(key, width, _fmt(old), _fmt(cur), change))
+    return 0
+
+
+def _fmt(value):
+    if value is None:
+        return "-"
+    return "{:.4g}".format(value) if isinstance(value, float) else str(value)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
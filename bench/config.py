@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Microbenchmark of config attribute access.
+
+Compares the raw, dict-based `Config` with the compiled config
+for a present key (`conf.irc.channel`) and a key missing from the files (`conf.imgur.album`).
+Prints nanoseconds per access as JSON.
+
+    python -m bench.config --number 1000000
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import timeit
+
+import yaml
+
+from bench.e2e import ROOT
+import config
+
+
+def load(path):
+    with open(path) as f:
+        raw = config.Config(yaml.safe_load(f))
+    # a key that only the schema knows
+    del raw['imgur']['album']
+    return raw, config.compile_config(raw)
+
+
+def measure(stmt, conf, number, repeat):
+    best = min(timeit.repeat(stmt, globals=dict(conf=conf), number=number, repeat=repeat))
+    return best / number * 1e9
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--number', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--log-level', default="INFO",
+                        help="level of the config logger while measuring")
+    args = parser.parse_args(argv)
+
+    logging.getLogger("config").setLevel(args.log_level.upper())
+    raw, compiled = load(os.path.join(ROOT, "config.yaml"))
+
+    report = {}
+    for name, stmt in (("present", "conf.irc.channel"), ("missing", "conf.imgur.album")):
+        report[name] = {
+            'raw_ns': measure(stmt, raw, args.number, args.repeat),
+            'compiled_ns': measure(stmt, compiled, args.number, args.repeat),
+        }
+        report[name]['speedup'] = report[name]['raw_ns'] / report[name]['compiled_ns']
+    print(json.dumps(report, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
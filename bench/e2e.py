@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""Hermetic end-to-end benchmark.
+
+Starts fake Telegram, Imgur and IRC servers,
+runs the real bot (`__main__.py`) against them in a subprocess
+and has N users send M images each.
+Prints a JSON report with throughput, end-to-end latency percentiles,
+peak RSS and peak thread count of the bot process.
+
+    python -m bench.e2e --users 4 --images 25 --size 200000 --imgur-latency 0.3
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+from threading import Condition, Thread
+import time
+
+import yaml
+
+from bench.fakes import FakeImgur, FakeIRCd, FakeTelegram
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return None
+    return values[max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))]
+
+
+def read_proc_status(pid):
+    """Return (VmRSS in kB, thread count) of a process, or Nones if unavailable."""
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None, None
+    rss = fields.get('VmRSS')
+    threads = fields.get('Threads')
+    return (int(rss.split()[0]) if rss else None,
+            int(threads) if threads else None)
+
+
+def make_image(file_id, size, blob):
+    # Unique prefix, so no two images share their content hash
+    head = file_id.encode('ascii').ljust(64, b"\0")
+    return (head + blob)[:max(size, len(head))]
+
+
+def write_config(workdir, telegram, imgur, ircd, user_ids, extra=None):
+    shutil.copy(os.path.join(ROOT, "config.yaml"), workdir)
+    user_config = {
+        'telegram': {'token': "bench", 'api_url': telegram.api_url,
+                     'file_url': telegram.file_url, 'timeout': 5, 'admin': []},
+        'imgur': {'client_id': "bench", 'client_secret': "bench",
+                  'refresh_token': "bench", 'api_url': imgur.url},
+        'storage': {'directory': os.path.join(workdir, "images"),
+                    'database': os.path.join(workdir, "images.db"),
+                    'user_database': os.path.join(workdir, "users.json")},
+        'irc': {'host': "127.0.0.1", 'port': ircd.port, 'nick': "BenchBot",
+                'channel': "#bench"},
+        'logging': {'active': False},
+        # Measure the whole load; bench.overload covers shedding it
+        'admission': {'max_pending': 0},
+    }
+    for section, values in (extra or {}).items():
+        user_config.setdefault(section, {}).update(values)
+
+    with open(os.path.join(workdir, "user_config.yaml"), 'w') as f:
+        yaml.safe_dump(user_config, f)
+    with open(os.path.join(workdir, "users.json"), 'w') as f:
+        json.dump(dict(name_map={str(u): "user{}".format(u) for u in user_ids}, blacklist=[]), f)
+
+
+class Bench(object):
+    """Synthetic load: `--users` users each send `--images` images of `--size` bytes."""
+
+    def __init__(self, args):
+        self.args = args
+        self.sent_at = {}  # caption -> time the update was made available
+        self.posted_at = {}  # caption -> time the post arrived on IRC
+        self.workdir = None
+        self.procs = []  # bot processes, the current one last
+        self._cond = Condition()
+
+        self.telegram = FakeTelegram(latency=args.telegram_latency).start()
+        self.imgur = FakeImgur(latency=args.imgur_latency, jitter=args.imgur_jitter).start()
+        self.ircd = FakeIRCd(latency=args.irc_latency, on_privmsg=self.on_privmsg).start()
+
+    def on_privmsg(self, at, nick, target, text):
+        caption = text.rsplit(" ", 1)[-1]
+        with self._cond:
+            if caption in self.sent_at and caption not in self.posted_at:
+                self.posted_at[caption] = at
+                self._cond.notify_all()
+
+    def spawn_bot(self, workdir):
+        env = dict(os.environ, PYTHONUNBUFFERED="1")
+        return subprocess.Popen([sys.executable, os.path.join(ROOT, "__main__.py"),
+                                 self.args.log_level],
+                                cwd=workdir, env=env)
+
+    def user_ids(self):
+        return list(range(1000, 1000 + self.args.users))
+
+    def expected_images(self):
+        return self.args.users * self.args.images
+
+    def outstanding(self):
+        """Number of images that are still to be posted."""
+        return self.expected_images() - len(self.posted_at)
+
+    def mark_sent(self, caption):
+        with self._cond:
+            self.sent_at[caption] = time.time()
+
+    def send_round(self, m, blob):
+        """Send the m-th image of every user."""
+        for u in self.user_ids():
+            caption = "bench-{}-{}".format(u, m)
+            data = make_image(caption, self.args.size, blob)
+            self.mark_sent(caption)
+            self.telegram.push_photo(u, caption, data, caption=caption)
+
+    def send_images(self):
+        blob = os.urandom(self.args.size)
+        for m in range(self.args.images):
+            self.send_round(m, blob)
+            if self.args.interval:
+                time.sleep(self.args.interval)
+
+    def run(self):
+        args = self.args
+        user_ids = self.user_ids()
+        total = self.expected_images()
+        peak_rss = peak_threads = 0
+
+        workdir = self.workdir = tempfile.mkdtemp(prefix="tgircbench-")
+        try:
+            write_config(workdir, self.telegram, self.imgur, self.ircd, user_ids,
+                         extra=json.loads(args.config) if args.config else None)
+            start = time.time()
+            self.procs.append(self.spawn_bot(workdir))
+            if not (self.ircd.wait_joined(args.timeout)
+                    and self.telegram.wait_polling(args.timeout)):
+                raise RuntimeError("bot did not start up")
+            ready = time.time()
+
+            sender = Thread(target=self.send_images, name="sender", daemon=True)
+            sender.start()
+            deadline = None  # counts from when all updates have been sent
+            with self._cond:
+                while self.outstanding() > 0:
+                    if deadline is None and not sender.is_alive():
+                        deadline = time.monotonic() + args.timeout
+                    elif deadline is not None and time.monotonic() > deadline:
+                        break
+                    self._cond.wait(0.1)
+                    rss, threads = read_proc_status(self.procs[-1].pid)
+                    peak_rss = max(peak_rss, rss or 0)
+                    peak_threads = max(peak_threads, threads or 0)
+        finally:
+            for proc in self.procs:
+                if proc.poll() is not None:
+                    continue
+                proc.send_signal(signal.SIGINT)
+                try:
+                    proc.wait(15)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+            for fake in (self.telegram, self.imgur, self.ircd):
+                fake.stop()
+            if not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+        latencies = sorted(self.posted_at[c] - self.sent_at[c] for c in self.posted_at)
+        first_sent = min(self.sent_at.values()) if self.sent_at else ready
+        last_posted = max(self.posted_at.values()) if self.posted_at else first_sent
+        duration = last_posted - first_sent
+        return {
+            'params': {k: v for k, v in vars(args).items() if k not in ('output', 'keep')},
+            'python': platform.python_version(),
+            'startup_seconds': ready - start,
+            'images': total,
+            'delivered': len(self.posted_at),
+            'uploads': len(self.imgur.uploads),
+            'irc_pings': self.ircd.pings,
+            'duration_seconds': duration,
+            'throughput_per_second': len(self.posted_at) / duration if duration else None,
+            'latency_seconds': {
+                'mean': sum(latencies) / len(latencies) if latencies else None,
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None,
+            },
+            'peak_rss_kb': peak_rss or None,
+            'peak_threads': peak_threads or None,
+        }
+
+
+def add_common_arguments(parser):
+    parser.add_argument('--telegram-latency', type=float, default=0.0)
+    parser.add_argument('--imgur-latency', type=float, default=0.0)
+    parser.add_argument('--imgur-jitter', type=float, default=0.0,
+                        help="random extra upload latency of up to this many seconds")
+    parser.add_argument('--irc-latency', type=float, default=0.0,
+                        help="delay before the IRC server completes registration")
+    parser.add_argument('--config', help="JSON object merged into the bot's user config")
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--log-level', default="WARNING", help="console log level of the bot")
+    parser.add_argument('--output', help="write the JSON report to this file")
+    parser.add_argument('--keep', action='store_true', help="keep the working directory")
+
+
+def write_report(report, output=None):
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + "\n")
+    print(text)
+    return 0 if report['delivered'] == report['images'] else 1
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--images', type=int, default=10, help="images per user")
+    parser.add_argument('--size', type=int, default=100000, help="image size in bytes")
+    parser.add_argument('--interval', type=float, default=0.0,
+                        help="seconds between sending rounds (one image per user)")
+    add_common_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    return write_report(Bench(args).run(), args.output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
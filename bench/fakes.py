@@ -0,0 +1,386 @@
+"""Local stand-ins for the Telegram Bot API, Imgur and an IRC server.
+
+They implement just enough of each protocol for the bot to run against them,
+with configurable latencies to model slow services.
+"""
+
+import base64
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import itertools
+import json
+import os
+import random
+import socket
+import socketserver
+import sys
+from threading import Condition, Lock, Thread
+import time
+from urllib.parse import parse_qs, urlparse
+
+
+class _QuietServerMixin(object):
+    def handle_error(self, request, client_address):
+        # The bot drops in-flight requests when it shuts down
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _ThreadingHTTPServer(_QuietServerMixin, socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _FakeServer(object):
+    server_class = _ThreadingHTTPServer
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self._server = self.server_class((host, port), self._make_handler())
+        self._thread = Thread(target=self._server.serve_forever, daemon=True,
+                              name=self.__class__.__name__)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/".format(self.port)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _make_handler(self):
+        raise NotImplementedError
+
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def read_form(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ""
+        params = parse_qs(urlparse(self.path).query)
+        params.update(parse_qs(body))
+        return {k: v[0] for k, v in params.items()}
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTelegram(_FakeServer):
+    """getMe, getUpdates (long polling), getFile, file downloads and sending methods."""
+
+    def __init__(self, latency=0.0, bot_username="BenchBot", drop_after=None, **kwargs):
+        self.latency = latency
+        self.bot_username = bot_username
+        # Bytes of a file sent per response before the connection is dropped, if set
+        self.drop_after = drop_after
+        self.file_requests = []  # (file_id, first byte requested)
+
+        self.updates = []
+        self.files = {}  # file_id -> bytes
+        self.sent = []  # (time, method, params)
+        self.polls = 0
+        self.first_poll_at = None
+        self._cond = Condition()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        super().__init__(**kwargs)
+
+    @property
+    def api_url(self):
+        return self.url + "bot"
+
+    @property
+    def file_url(self):
+        return self.url + "file/bot"
+
+    def add_file(self, file_id, data):
+        self.files[file_id] = data
+
+    def push_update(self, message):
+        """Queue a message update; returns its update_id."""
+        with self._cond:
+            update_id = next(self._update_ids)
+            message.setdefault('message_id', next(self._message_ids))
+            message.setdefault('date', int(time.time()))
+            self.updates.append(dict(update_id=update_id, message=message))
+            self._cond.notify_all()
+        return update_id
+
+    def push_photo(self, user_id, file_id, data, caption=None):
+        self.add_file(file_id, data)
+        return self.push_update(dict(
+            chat={'id': user_id, 'type': 'private', 'first_name': "user{}".format(user_id)},
+            caption=caption,
+            photo=[{'file_id': file_id, 'width': 1280, 'height': 960, 'file_size': len(data)}],
+            **{'from': {'id': user_id, 'first_name': "user{}".format(user_id)}}
+        ))
+
+    def push_text(self, user_id, text):
+        return self.push_update({
+            'chat': {'id': user_id, 'type': 'private', 'first_name': "user{}".format(user_id)},
+            'from': {'id': user_id, 'first_name': "user{}".format(user_id)},
+            'text': text,
+        })
+
+    def get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.polls += 1
+            if self.first_poll_at is None:
+                self.first_poll_at = time.time()
+            self._cond.notify_all()
+            while True:
+                pending = [u for u in self.updates if u['update_id'] >= offset]
+                remaining = deadline - time.monotonic()
+                if pending or remaining <= 0:
+                    # confirmed updates are never needed again
+                    self.updates = pending
+                    return pending[:100]
+                self._cond.wait(remaining)
+
+    def wait_polling(self, timeout=30):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.polls > 0, timeout)
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(_JSONHandler):
+            def do_GET(self):  # noqa
+                if self.path.startswith("/file/bot"):
+                    self.send_file()
+                else:
+                    self.do_POST()
+
+            def do_POST(self):  # noqa
+                path = urlparse(self.path).path
+                if not path.startswith("/bot"):
+                    self.send_json({'ok': False, 'description': "Not Found"}, status=404)
+                    return
+                method = path.rsplit("/", 1)[-1]
+                params = self.read_form()
+
+                if method == 'getUpdates':
+                    result = fake.get_updates(int(params.get('offset') or 0),
+                                              float(params.get('timeout') or 0))
+                else:
+                    time.sleep(fake.latency)
+                    if method == 'getMe':
+                        result = {'id': 1, 'first_name': "Bench", 'username': fake.bot_username}
+                    elif method == 'getFile':
+                        file_id = params['file_id']
+                        result = {'file_id': file_id,
+                                  'file_size': len(fake.files.get(file_id, b"")),
+                                  'file_path': "photos/{}.jpg".format(file_id)}
+                    elif method == 'sendMessage':
+                        fake.sent.append((time.time(), method, params))
+                        result = {'message_id': next(fake._message_ids),
+                                  'date': int(time.time()),
+                                  'chat': {'id': int(params.get('chat_id', 0)),
+                                           'type': 'private'},
+                                  'text': params.get('text')}
+                    else:
+                        fake.sent.append((time.time(), method, params))
+                        result = True
+                self.send_json({'ok': True, 'result': result})
+
+            def send_file(self):
+                time.sleep(fake.latency)
+                file_path = urlparse(self.path).path.split("/", 3)[-1]
+                file_id = os.path.splitext(os.path.basename(file_path))[0]
+                data = fake.files.get(file_id)
+                if data is None:
+                    self.send_json({'ok': False}, status=404)
+                    return
+
+                start = 0
+                range_ = self.headers.get('Range')
+                if range_ and range_.startswith("bytes="):
+                    start = int(range_[6:].split("-")[0])
+                fake.file_requests.append((file_id, start))
+                body = data[start:]
+                self.send_response(206 if range_ else 200)
+                self.send_header("Content-Length", str(len(body)))
+                if range_:
+                    self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                        start, len(data) - 1, len(data)))
+                self.end_headers()
+                if fake.drop_after is not None and len(body) > fake.drop_after:
+                    # Promise the whole body, send part of it and hang up
+                    self.wfile.write(body[:fake.drop_after])
+                    self.wfile.flush()
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+        return Handler
+
+
+class FakeImgur(_FakeServer):
+    """Token refresh, credits and image upload endpoints."""
+
+    def __init__(self, latency=0.0, jitter=0.0, **kwargs):
+        self.latency = latency
+        self.jitter = jitter  # random extra latency of up to this many seconds
+        self.uploads = []  # (time, params without image data)
+        self._ids = itertools.count(1)
+        self._lock = Lock()
+        super().__init__(**kwargs)
+
+    def _make_handler(self):
+        fake = self
+        headers = {'X-RateLimit-ClientRemaining': "12500",
+                   'X-RateLimit-UserRemaining': "2000"}
+
+        class Handler(_JSONHandler):
+            def do_GET(self):  # noqa
+                if urlparse(self.path).path == "/3/credits":
+                    self.send_json({'data': {'ClientRemaining': 12500}, 'success': True,
+                                    'status': 200}, headers=headers)
+                else:
+                    self.send_json({'data': {'error': "Not found"}}, status=404)
+
+            def do_POST(self):  # noqa
+                path = urlparse(self.path).path
+                params = self.read_form()
+                if path == "/oauth2/token":
+                    self.send_json({'access_token': "bench", 'refresh_token': "bench",
+                                    'expires_in': 3600})
+                elif path == "/3/upload":
+                    time.sleep(fake.latency + random.uniform(0, fake.jitter))
+                    size = len(base64.b64decode(params.pop('image', "")))
+                    with fake._lock:
+                        image_id = "bench{}".format(next(fake._ids))
+                        fake.uploads.append((time.time(), dict(params, size=size)))
+                    self.send_json({'data': {'id': image_id,
+                                             'link': "https://i.imgur.example/{}.jpg"
+                                                     .format(image_id)},
+                                    'success': True, 'status': 200}, headers=headers)
+                else:
+                    self.send_json({'data': {'error': "Not found"}}, status=404)
+
+        return Handler
+
+
+class _ThreadingTCPServer(_QuietServerMixin, socketserver.ThreadingMixIn,
+                          socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeIRCd(_FakeServer):
+    """Registers clients, answers PINGs and JOINs and records PRIVMSGs."""
+
+    server_class = _ThreadingTCPServer
+
+    def __init__(self, latency=0.0, on_privmsg=None, **kwargs):
+        self.latency = latency  # delay before the registration numerics (MOTD wait)
+        self.on_privmsg = on_privmsg
+        self.messages = []  # (time, nick, target, text)
+        self.joined = []
+        self.registrations = 0
+        self.pings = 0
+        self._connections = set()
+        self._cond = Condition()
+        super().__init__(**kwargs)
+
+    def wait_joined(self, timeout=30):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.joined, timeout)
+
+    def kill_clients(self):
+        """Drop all client connections without a goodbye; returns how many were dropped."""
+        with self._cond:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        return len(connections)
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def setup(self):
+                super().setup()
+                self.nick = None
+                self.lock = Lock()
+                with fake._cond:
+                    fake._connections.add(self.connection)
+
+            def finish(self):
+                with fake._cond:
+                    fake._connections.discard(self.connection)
+                try:
+                    super().finish()
+                except OSError:
+                    pass
+
+            def send(self, line):
+                with self.lock:
+                    self.wfile.write((line + "\r\n").encode('utf-8'))
+                    self.wfile.flush()
+
+            def handle(self):
+                for raw in self.rfile:
+                    line = raw.decode('utf-8', errors='ignore').rstrip("\r\n")
+                    if not line:
+                        continue
+                    command, _, rest = line.partition(" ")
+                    command = command.upper()
+                    try:
+                        self.dispatch(command, rest)
+                    except OSError:
+                        return
+
+            def dispatch(self, command, rest):
+                if command == 'NICK':
+                    self.nick = rest.strip().lstrip(":")
+                elif command == 'USER':
+                    time.sleep(fake.latency)
+                    with fake._cond:
+                        fake.registrations += 1
+                    for numeric, text in (("001", "Welcome to the fake network"),
+                                          ("251", "There are 1 users on 1 server"),
+                                          ("266", "Current global users 1")):
+                        self.send(":fake.ircd {} {} :{}".format(numeric, self.nick, text))
+                elif command == 'PING':
+                    with fake._cond:
+                        fake.pings += 1
+                    self.send(":fake.ircd PONG fake.ircd {}".format(rest))
+                elif command == 'JOIN':
+                    channel = rest.split()[0]
+                    self.send(":{0}!bot@localhost JOIN :{1}".format(self.nick, channel))
+                    with fake._cond:
+                        fake.joined.append((time.time(), channel))
+                        fake._cond.notify_all()
+                elif command == 'PRIVMSG':
+                    target, _, text = rest.partition(" :")
+                    entry = (time.time(), self.nick, target, text)
+                    with fake._cond:
+                        fake.messages.append(entry)
+                        fake._cond.notify_all()
+                    if fake.on_privmsg:
+                        fake.on_privmsg(*entry)
+
+        return Handler
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Multi-network fan-out benchmark.
+
+Runs the end-to-end benchmark with a second IRC network
+whose server completes registration only after `--slow-latency` seconds.
+Every image must be uploaded once and posted to both networks;
+posts to the fast network must not wait for the slow one.
+
+    python -m bench.fanout --users 2 --images 10 --slow-latency 5
+"""
+
+import argparse
+import json
+import sys
+from threading import Lock
+
+from bench.e2e import Bench, add_common_arguments, percentile, write_report
+from bench.fakes import FakeIRCd
+
+
+class FanoutBench(Bench):
+    def __init__(self, args):
+        super().__init__(args)
+        self.arrived = {'default': {}, 'slow': {}}  # network -> caption -> time
+        self._lock = Lock()
+        self.slow_ircd = FakeIRCd(latency=args.slow_latency,
+                                  on_privmsg=self.on_slow_privmsg).start()
+        config = json.loads(args.config) if args.config else {}
+        config.setdefault('irc', {})['networks'] = {'slow': {'port': self.slow_ircd.port}}
+        args.config = json.dumps(config)
+
+    def record(self, network, at, nick, target, text):
+        caption = text.rsplit(" ", 1)[-1]
+        with self._lock:
+            self.arrived[network].setdefault(caption, at)
+            everywhere = all(caption in posts for posts in self.arrived.values())
+        if everywhere:
+            super().on_privmsg(at, nick, target, text)
+
+    def on_privmsg(self, at, nick, target, text):
+        self.record('default', at, nick, target, text)
+
+    def on_slow_privmsg(self, at, nick, target, text):
+        self.record('slow', at, nick, target, text)
+
+    def run(self):
+        try:
+            report = super().run()
+        finally:
+            self.slow_ircd.stop()
+        for network, posts in self.arrived.items():
+            latencies = sorted(at - self.sent_at[c] for c, at in posts.items()
+                               if c in self.sent_at)
+            report[network] = {
+                'delivered': len(latencies),
+                'p50_seconds': percentile(latencies, 50),
+                'max_seconds': latencies[-1] if latencies else None,
+            }
+        return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--users', type=int, default=2)
+    parser.add_argument('--images', type=int, default=10, help="images per user")
+    parser.add_argument('--size', type=int, default=20000, help="image size in bytes")
+    parser.add_argument('--interval', type=float, default=0.2,
+                        help="seconds between sending rounds (one image per user)")
+    parser.add_argument('--slow-latency', type=float, default=5.0,
+                        help="delay before the slow IRC server completes registration")
+    add_common_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    return write_report(FanoutBench(args).run(), args.output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Zero-downtime restart benchmark.
+
+Runs the end-to-end benchmark and, halfway through sending,
+starts a second bot process that takes over from the first one (`handoff`).
+Reports how long the handoff took and whether the IRC connection was kept,
+i.e. the fake IRC server saw a single registration.
+Linux only.
+
+    python -m bench.handoff --users 2 --images 20 --interval 0.2
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from threading import Thread
+import time
+
+from bench.e2e import Bench, add_common_arguments, write_report
+
+
+class HandoffBench(Bench):
+    def __init__(self, args):
+        super().__init__(args)
+        self.handoff_seconds = None
+
+    def send_images(self):
+        blob = os.urandom(self.args.size)
+        for m in range(self.args.images):
+            if m == self.args.images // 2:
+                # Keep sending while the successor takes over
+                Thread(target=self.restart, name="restart", daemon=True).start()
+            self.send_round(m, blob)
+            if self.args.interval:
+                time.sleep(self.args.interval)
+
+    def restart(self):
+        start = time.time()
+        old = self.procs[-1]
+        self.procs.append(self.spawn_bot(self.workdir))
+        try:
+            old.wait(self.args.timeout)
+        except subprocess.TimeoutExpired:
+            return
+        self.handoff_seconds = time.time() - start
+
+    def run(self):
+        report = super().run()
+        report.update(
+            handoff_seconds=self.handoff_seconds,
+            old_exit_code=self.procs[0].returncode,
+            registrations=self.ircd.registrations,
+        )
+        return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--users', type=int, default=2)
+    parser.add_argument('--images', type=int, default=20, help="images per user")
+    parser.add_argument('--size', type=int, default=20000, help="image size in bytes")
+    parser.add_argument('--interval', type=float, default=0.2,
+                        help="seconds between sending rounds (one image per user)")
+    add_common_arguments(parser)
+    parser.set_defaults(config='{"handoff": {"path": "handoff.sock"}}')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    return write_report(HandoffBench(args).run(), args.output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
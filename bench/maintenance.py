@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Database maintenance benchmark (`maintenance`).
+
+Fills an image database with `--rows` finished images spread over the past year
+and a few unfinished ones,
+then reports the time of the startup backlog scan and of lookups,
+and the database size,
+before and after archiving images older than `--archive-after` days and compacting.
+
+    python -m bench.maintenance --rows 1000000
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from bench.e2e import percentile
+from bench.search import fill, make_vocabulary
+from models.image import ImageDatabase, ImageInfo
+
+
+def measure(db, rows, rng, lookups):
+    start = time.perf_counter()
+    unfinished = db.get_unfinished_images()
+    backlog = time.perf_counter() - start
+
+    durations = []
+    for _ in range(lookups):
+        img = ImageInfo("f{}".format(rng.randrange(rows)), *[None] * 10)
+        start = time.perf_counter()
+        db.find_image(img)
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+
+    used, free = db.database_size()
+    images, archived = db.count_images()
+    return {
+        'images': images,
+        'archived': archived,
+        'unfinished': len(unfinished),
+        'backlog_scan_ms': backlog * 1000,
+        'find_image_p50_us': percentile(durations, 50) * 1e6,
+        'find_image_p99_us': percentile(durations, 99) * 1e6,
+        'used_bytes': used,
+        'free_bytes': free,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--unfinished', type=int, default=100)
+    parser.add_argument('--archive-after', type=float, default=30, help="days")
+    parser.add_argument('--lookups', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="tgircmaint-")
+    dbpath = os.path.join(workdir, "images.db")
+    try:
+        fill(dbpath, args.rows, make_vocabulary(1000), 300, rng)
+        with ImageDatabase(dbpath) as db:
+            db.db.execute("UPDATE images SET finished = 0, url = NULL"
+                          " WHERE rowid > ?", (args.rows - args.unfinished,))
+            db.db.commit()
+            # As compact_database.py does once
+            db.enable_incremental_vacuum()
+            before = measure(db, args.rows, rng, args.lookups)
+
+            start = time.perf_counter()
+            archived = db.archive(time.time() - args.archive_after * 86400)
+            archive_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            reclaimed = db.compact()
+            compact_seconds = time.perf_counter() - start
+            after = measure(db, args.rows, rng, args.lookups)
+
+        report = {
+            'params': vars(args),
+            'archived': archived,
+            'archive_seconds': archive_seconds,
+            'reclaimed_bytes': reclaimed,
+            'compact_seconds': compact_seconds,
+            'before': before,
+            'after': after,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""IRC post order benchmark.
+
+Every user sends a burst of `--images` images at once
+while the fake Imgur answers with random latency,
+so uploads finish out of order.
+Runs with `irc.order` enabled and disabled
+and reports how many posts overtook an earlier image of the same user.
+
+    python -m bench.order --users 4 --images 5 --imgur-jitter 1
+"""
+
+import argparse
+import json
+import sys
+
+from bench.e2e import Bench, add_common_arguments
+
+
+class OrderBench(Bench):
+    def run(self):
+        report = super().run()
+        posted = {}  # user -> image numbers in the order they were posted
+        for _, _, _, text in sorted(self.ircd.messages, key=lambda m: m[0]):
+            _, user, number = text.rsplit(" ", 1)[-1].split("-")
+            posted.setdefault(user, []).append(int(number))
+        report['overtaken'] = sum(1 for numbers in posted.values()
+                                  for i, n in enumerate(numbers) if n < max(numbers[:i] or [n]))
+        return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--images', type=int, default=5, help="images per user")
+    parser.add_argument('--size', type=int, default=20000, help="image size in bytes")
+    add_common_arguments(parser)
+    parser.set_defaults(imgur_jitter=1.0, interval=0.0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    extra = json.loads(args.config) if args.config else {}
+
+    runs = {}
+    for mode, active in (("ordered", True), ("unordered", False)):
+        run_args = argparse.Namespace(**vars(args))
+        irc = dict(extra.get('irc', {}), order={'active': active})
+        run_args.config = json.dumps(dict(extra, irc=irc))
+        report = OrderBench(run_args).run()
+        runs[mode] = {k: report[k] for k in ('delivered', 'overtaken', 'latency_seconds')}
+
+    report = {'images': args.users * args.images, 'runs': runs}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    print(text)
+    return 0 if all(run['delivered'] == report['images'] for run in runs.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Overload benchmark for admission control (`admission`).
+
+Sends a burst of images against a slow fake Imgur,
+once with `admission.max_pending` set and once without a limit,
+and reports how many images were posted, how many were turned away with a "busy" reply,
+how fast that reply came and the bot's peak memory and thread count.
+No image may be lost silently: each one is either posted or answered.
+
+    python -m bench.overload --users 20 --images 20 --max-pending 50 --imgur-latency 2
+"""
+
+import argparse
+import json
+import sys
+
+from bench.e2e import Bench, add_common_arguments, percentile
+
+
+class OverloadBench(Bench):
+    def busy_replies(self):
+        return [(at, params) for at, method, params in list(self.telegram.sent)
+                if method == 'sendMessage' and "busy" in params.get('text', "")]
+
+    def outstanding(self):
+        return super().outstanding() - len(self.busy_replies())
+
+    def run(self):
+        report = super().run()
+        busy = self.busy_replies()
+        # Updates carry the sender, not the caption; match replies to a user's images in order
+        sent = {}
+        for caption, at in sorted(self.sent_at.items(), key=lambda item: item[1]):
+            if caption not in self.posted_at:
+                sent.setdefault(caption.split("-")[1], []).append(at)
+        reply_latencies = []
+        for at, params in busy:
+            pending = sent.get(params.get('chat_id'))
+            if pending:
+                reply_latencies.append(at - pending.pop(0))
+        reply_latencies.sort()
+        report['rejected'] = len(busy)
+        report['lost'] = report['images'] - report['delivered'] - len(busy)
+        report['busy_reply_seconds'] = {
+            'p50': percentile(reply_latencies, 50),
+            'max': reply_latencies[-1] if reply_latencies else None,
+        }
+        return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--images', type=int, default=20, help="images per user")
+    parser.add_argument('--size', type=int, default=100000, help="image size in bytes")
+    parser.add_argument('--interval', type=float, default=0.0,
+                        help="seconds between sending rounds (one image per user)")
+    parser.add_argument('--max-pending', type=int, default=50,
+                        help="admission.max_pending of the limited run")
+    add_common_arguments(parser)
+    parser.set_defaults(imgur_latency=2.0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    extra = json.loads(args.config) if args.config else {}
+
+    runs = {}
+    for mode, max_pending in (("limited", args.max_pending), ("unlimited", 0)):
+        run_args = argparse.Namespace(**vars(args))
+        admission = dict(extra.get('admission', {}), max_pending=max_pending)
+        run_args.config = json.dumps(dict(extra, admission=admission))
+        report = OverloadBench(run_args).run()
+        runs[mode] = {key: report[key] for key in (
+            'delivered', 'rejected', 'lost', 'busy_reply_seconds', 'latency_seconds',
+            'peak_rss_kb', 'peak_threads')}
+
+    report = {'images': args.users * args.images, 'max_pending': args.max_pending,
+              'runs': runs}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    print(text)
+    return 0 if all(run['lost'] == 0 for run in runs.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Thread-per-job versus asyncio pipeline benchmark.
+
+Runs the end-to-end benchmark once with a thread per image job
+and once with the asyncio pipeline (`pipeline.asyncio`),
+with slow fake servers so that many jobs are in flight at once,
+and reports peak memory, peak thread count and latencies of both.
+
+    python -m bench.pipeline --users 50 --images 10 --imgur-latency 1
+"""
+
+import argparse
+import json
+import sys
+
+from bench.e2e import Bench, add_common_arguments
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--images', type=int, default=10, help="images per user")
+    parser.add_argument('--size', type=int, default=20000, help="image size in bytes")
+    parser.add_argument('--interval', type=float, default=0.0,
+                        help="seconds between sending rounds (one image per user)")
+    add_common_arguments(parser)
+    parser.set_defaults(imgur_latency=1.0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    extra = json.loads(args.config) if args.config else {}
+
+    runs = {}
+    for mode, asyncio in (("threads", False), ("asyncio", True)):
+        run_args = argparse.Namespace(**vars(args))
+        pipeline = dict(extra.get('pipeline', {}), asyncio=asyncio)
+        run_args.config = json.dumps(dict(extra, pipeline=pipeline))
+        report = Bench(run_args).run()
+        runs[mode] = {
+            'delivered': report['delivered'],
+            'throughput_per_second': report['throughput_per_second'],
+            'latency_seconds': report['latency_seconds'],
+            'peak_rss_kb': report['peak_rss_kb'],
+            'peak_threads': report['peak_threads'],
+        }
+
+    report = {'images': args.users * args.images, 'runs': runs}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    print(text)
+    return 0 if all(run['delivered'] == report['images'] for run in runs.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""IRC reconnect benchmark.
+
+Runs the end-to-end benchmark while the fake IRC server
+drops all client connections every `--kill-interval` seconds.
+Every image must still be posted; duplicates are counted, losses fail the run.
+
+    python -m bench.reconnect --users 2 --images 20 --interval 0.2 --kill-interval 1
+"""
+
+import argparse
+import sys
+from threading import Event, Thread
+
+from bench.e2e import Bench, add_common_arguments, write_report
+
+
+class ReconnectBench(Bench):
+    def __init__(self, args):
+        super().__init__(args)
+        self.kills = 0
+        self._sending = Event()
+
+    def send_images(self):
+        killer = Thread(target=self.kill_loop, name="killer", daemon=True)
+        killer.start()
+        try:
+            super().send_images()
+        finally:
+            self._sending.set()
+            killer.join()
+
+    def kill_loop(self):
+        while not self._sending.wait(self.args.kill_interval):
+            self.kills += self.ircd.kill_clients()
+
+    def run(self):
+        report = super().run()
+        captions = [text.rsplit(" ", 1)[-1] for _, _, _, text in self.ircd.messages]
+        report.update(
+            kills=self.kills,
+            registrations=self.ircd.registrations,
+            duplicates=len(captions) - len(set(captions)),
+        )
+        return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--users', type=int, default=2)
+    parser.add_argument('--images', type=int, default=20, help="images per user")
+    parser.add_argument('--size', type=int, default=20000, help="image size in bytes")
+    parser.add_argument('--interval', type=float, default=0.2,
+                        help="seconds between sending rounds (one image per user)")
+    parser.add_argument('--kill-interval', type=float, default=1.0,
+                        help="seconds between dropping the bot's IRC connections")
+    add_common_arguments(parser)
+    parser.set_defaults(config='{"irc": {"reconnect": {"min_delay": 0.2, "max_delay": 2}}}')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    return write_report(ReconnectBench(args).run(), args.output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Replay a recorded update stream against the bot.
+
+Feeds a log written by the bot's update recorder (`telegram.record`)
+through the fake Bot API, at the recorded pace (`--speed 1`),
+N times faster (`--speed N`) or as fast as possible (`--speed 0`),
+and reports the same metrics as `bench.e2e`.
+File contents are taken from the log if they were recorded,
+otherwise random data of the recorded size is served.
+
+    python -m bench.replay updates.log.gz --speed 10
+"""
+
+import argparse
+import base64
+import mimetypes
+import os
+import sys
+import time
+
+from bench.e2e import Bench, add_common_arguments, make_image, write_report
+from bots.recorder import read_log
+from bots.telegram import IMAGE_EXTENSIONS
+
+
+def image_file(message):
+    """Return (file_id, file_size) of the image in a Bot API message, if any."""
+    if message.get('photo'):
+        largest = max(message['photo'], key=lambda p: p.get('file_size') or 0)
+        return largest['file_id'], largest.get('file_size') or 0
+    document = message.get('document')
+    if document and mimetypes.guess_extension(document.get('mime_type') or "") in IMAGE_EXTENSIONS:
+        return document['file_id'], document.get('file_size') or 0
+    return None, None
+
+
+class Replay(Bench):
+    def __init__(self, args):
+        super().__init__(args)
+        self.updates = []  # (time, message)
+        self.files = {}
+        for entry in read_log(args.log):
+            if 'update' in entry and entry['update'].get('message'):
+                self.updates.append((entry['t'], entry['update']['message']))
+            elif 'file' in entry:
+                self.files[entry['file']] = base64.b64decode(entry['data'])
+
+    def user_ids(self):
+        return sorted({message['chat']['id'] for _, message in self.updates})
+
+    def expected_images(self):
+        return sum(1 for _, message in self.updates if image_file(message)[0])
+
+    def send_images(self):
+        blob = os.urandom(max((image_file(m)[1] or 0 for _, m in self.updates), default=0))
+        start = time.monotonic()
+        first = self.updates[0][0] if self.updates else 0
+
+        for i, (t, message) in enumerate(self.updates):
+            if self.args.speed:
+                delay = (t - first) / self.args.speed - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            message = dict(message)
+            message.pop('message_id', None)
+            message.pop('date', None)
+            file_id, size = image_file(message)
+            if file_id:
+                # Tag the caption, so the post on IRC can be attributed to this update
+                tag = "replay-{}".format(i)
+                message['caption'] = ((message.get('caption') or "") + " " + tag).lstrip()
+                if file_id not in self.telegram.files:
+                    data = self.files.get(file_id) or make_image(file_id, size, blob)
+                    self.telegram.add_file(file_id, data)
+                self.mark_sent(tag)
+            self.telegram.push_update(message)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('log', help="update log written by the recorder")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="replay speed factor; 0 replays as fast as possible")
+    add_common_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    return write_report(Replay(args).run(), args.output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
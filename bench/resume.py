@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Resumable download check (`util.download`).
+
+Serves a file from the fake Telegram file server,
+which drops the connection after every `--drop-after` bytes,
+and downloads it with `util.download.download`.
+The download must resume from the part-file with Range requests
+and end with the file's SHA-256.
+
+    python -m bench.resume --size 1000000 --drop-after 300000
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from bench.fakes import FakeTelegram
+from util.download import download
+from util.log import NewStyleLogRecord
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--size', type=int, default=1000000, help="file size in bytes")
+    parser.add_argument('--drop-after', type=int, default=300000,
+                        help="bytes sent per response before the connection is dropped")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    logging.setLogRecordFactory(NewStyleLogRecord)
+    logging.basicConfig(level=logging.ERROR)
+
+    data = random.Random(args.seed).randbytes(args.size)
+    fake = FakeTelegram(drop_after=args.drop_after)
+    fake.add_file("resume", data)
+    fake.start()
+    workdir = tempfile.mkdtemp(prefix="tgircresume-")
+    try:
+        out_file = os.path.join(workdir, "resume.jpg")
+        # Enough retries to fetch everything in pieces of `drop_after` bytes
+        retries = args.size // max(args.drop_after, 1) + 2
+        start = time.perf_counter()
+        digest = download(fake.file_url + "token/photos/resume.jpg", out_file,
+                          expected_size=len(data), retries=retries, timeout=10)
+        seconds = time.perf_counter() - start
+        with open(out_file, 'rb') as f:
+            complete = f.read() == data
+    finally:
+        fake.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    expected = hashlib.sha256(data).hexdigest()
+    report = {
+        'params': vars(args),
+        'requests': len(fake.file_requests),
+        'resumed_from': [offset for _, offset in fake.file_requests if offset],
+        'sha256_matches': digest == expected,
+        'complete': complete,
+        'seconds': seconds,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    print(text)
+    return 0 if report['sha256_matches'] and complete else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""Full-text search benchmark.
+
+Fills an image database with `--rows` synthetic images
+(captions drawn from a Zipf-distributed vocabulary, a few hundred users),
+builds the search index over them like a migration of an existing database would,
+and reports the time of `ImageDatabase.search` for rare, common and combined terms,
+of inserts with the index triggers and the size of the database.
+
+    python -m bench.search --rows 3000000 --queries 200
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from bench.e2e import percentile
+from models.image import ImageDatabase, ImageInfo
+
+
+def make_vocabulary(size):
+    words = ["w{}".format(i) for i in range(size)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(size)))
+    return words, cum_weights
+
+
+def fill(dbpath, rows, vocabulary, users, rng, batch=50000):
+    """Insert images without the index, as in a database from before it existed."""
+    words, cum_weights = vocabulary
+    db = sqlite3.connect(dbpath)
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute(
+        """CREATE TABLE images (
+            f_id TEXT PRIMARY KEY, time INTEGER, username TEXT, c_id INTEGER, m_id INTEGER,
+            caption TEXT, ext TEXT, remote_path TEXT, local_path TEXT, url TEXT, finished INTEGER
+        )"""
+    )
+    start = int(time.time()) - 365 * 86400
+    step = 365 * 86400 / rows
+    for offset in range(0, rows, batch):
+        db.executemany(
+            "INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, NULL, NULL, ?, 1)",
+            (("f{}".format(i), int(start + i * step), "user{}".format(i % users), i % users, i,
+              " ".join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(0, 8))),
+              ".jpg", "https://i.imgur.com/{}.jpg".format(i))
+             for i in range(offset, min(offset + batch, rows)))
+        )
+        db.commit()
+    db.close()
+
+
+def time_queries(db, queries):
+    durations, results = [], 0
+    for terms in queries:
+        start = time.perf_counter()
+        results += len(db.search(terms))
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    return {
+        'p50_ms': percentile(durations, 50) * 1000,
+        'p99_ms': percentile(durations, 99) * 1000,
+        'max_ms': durations[-1] * 1000,
+        'results_per_query': results / len(queries),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--vocabulary', type=int, default=50000, help="distinct caption words")
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--queries', type=int, default=200, help="queries per kind")
+    parser.add_argument('--inserts', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(args.vocabulary)
+    words = vocabulary[0]
+    workdir = tempfile.mkdtemp(prefix="tgircsearch-")
+    dbpath = os.path.join(workdir, "images.db")
+    try:
+        start = time.perf_counter()
+        fill(dbpath, args.rows, vocabulary, args.users, rng)
+        fill_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        db = ImageDatabase(dbpath)
+        index_seconds = time.perf_counter() - start
+
+        kinds = {
+            'common': lambda: [rng.choice(words[:10])],
+            'medium': lambda: [rng.choice(words[100:1000])],
+            'rare': lambda: [rng.choice(words[-10000:])],
+            'two_terms': lambda: [rng.choice(words[:100]), rng.choice(words[100:5000])],
+            'username': lambda: ["user{}".format(rng.randrange(args.users))],
+            'no_match': lambda: ["nosuchword{}".format(rng.randrange(1000))],
+        }
+        queries = {kind: time_queries(db, [make() for _ in range(args.queries)])
+                   for kind, make in kinds.items()}
+
+        start = time.perf_counter()
+        for i in range(args.inserts):
+            db.insert_image(ImageInfo(
+                "new{}".format(i), int(time.time()), "user0", 0, i,
+                " ".join(rng.choices(words, k=5)), ".jpg", None, None, None, False))
+        insert_ms = (time.perf_counter() - start) / args.inserts * 1000
+        db.close()
+
+        report = {
+            'params': vars(args),
+            'sqlite_version': sqlite3.sqlite_version,
+            'fill_seconds': fill_seconds,
+            'index_seconds': index_seconds,
+            'insert_ms': insert_ms,
+            'database_bytes': sum(os.path.getsize(os.path.join(workdir, name))
+                                  for name in os.listdir(workdir)),
+            'queries': queries,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
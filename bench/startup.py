@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Startup-time benchmark.
+
+Starts the bot N times against the fake services
+and reports how long it takes until it joined the IRC channel
+and until it first polled Telegram for updates,
+measured from spawning the process.
+The IRC latency models the wait for the server's MOTD.
+
+    python -m bench.startup --runs 5 --irc-latency 2 --telegram-latency 0.2
+"""
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.e2e import percentile, ROOT, write_config
+from bench.fakes import FakeImgur, FakeIRCd, FakeTelegram
+
+
+def run_once(args):
+    telegram = FakeTelegram(latency=args.telegram_latency).start()
+    imgur = FakeImgur().start()
+    ircd = FakeIRCd(latency=args.irc_latency).start()
+    workdir = tempfile.mkdtemp(prefix="tgircstartup-")
+    proc = None
+    try:
+        write_config(workdir, telegram, imgur, ircd, [1000])
+        start = time.time()
+        proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "__main__.py"),
+                                 args.log_level], cwd=workdir)
+        if not (ircd.wait_joined(args.timeout) and telegram.wait_polling(args.timeout)):
+            raise RuntimeError("bot did not start up")
+        irc = ircd.joined[0][0] - start
+        polling = telegram.first_poll_at - start
+        return dict(irc_joined=irc, polling=polling, ready=max(irc, polling))
+    finally:
+        if proc:
+            proc.send_signal(signal.SIGINT)
+            try:
+                proc.wait(15)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        for fake in (telegram, imgur, ircd):
+            fake.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--telegram-latency', type=float, default=0.0)
+    parser.add_argument('--irc-latency', type=float, default=1.0,
+                        help="delay before the IRC server completes registration")
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--log-level', default="WARNING", help="console log level of the bot")
+    args = parser.parse_args(argv)
+
+    runs = [run_once(args) for _ in range(args.runs)]
+    report = {'params': vars(args)}
+    for key in ('irc_joined', 'polling', 'ready'):
+        values = sorted(r[key] for r in runs)
+        report[key + '_seconds'] = dict(min=values[0], p50=percentile(values, 50),
+                                        max=values[-1])
+    print(json.dumps(report, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Worker process scaling benchmark.
+
+Runs the end-to-end benchmark once per `--processes` value
+(`workers.processes`; 0 handles jobs in threads of the main process)
+and reports throughput and the speedup over the first value.
+Speedups beyond 1 need spare cores; the fake servers use one as well.
+
+    python -m bench.workers --processes 0 1 2 4 --users 8 --images 10 --size 2000000
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from bench.e2e import Bench, add_common_arguments
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--processes', type=int, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--images', type=int, default=10, help="images per user")
+    parser.add_argument('--size', type=int, default=2000000, help="image size in bytes")
+    parser.add_argument('--interval', type=float, default=0.0,
+                        help="seconds between sending rounds (one image per user)")
+    add_common_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    extra = json.loads(args.config) if args.config else {}
+
+    runs = []
+    for processes in args.processes:
+        run_args = argparse.Namespace(**vars(args))
+        run_args.config = json.dumps(dict(extra, workers={'processes': processes}))
+        report = Bench(run_args).run()
+        runs.append({
+            'processes': processes,
+            'delivered': report['delivered'],
+            'throughput_per_second': report['throughput_per_second'],
+            'latency_p50_seconds': report['latency_seconds']['p50'],
+            'peak_rss_kb': report['peak_rss_kb'],
+        })
+
+    base = runs[0]['throughput_per_second']
+    for run in runs:
+        run['speedup'] = (run['throughput_per_second'] / base
+                          if base and run['throughput_per_second'] else None)
+
+    report = {'cpus': os.cpu_count(), 'images': args.users * args.images, 'runs': runs}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    print(text)
+    return 0 if all(run['delivered'] == report['images'] for run in runs) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,11 @@
 __all__ = ('IRCBot', 'TelegramImageBot')
 
 from .irc import IRCBot
-from .telegram import TelegramImageBot
+
+
+def __getattr__(name):
+    # twx.botapi (and with it requests) is only imported when the Telegram bot is first needed
+    if name == 'TelegramImageBot':
+        from .telegram import TelegramImageBot
+        return TelegramImageBot
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
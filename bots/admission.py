@@ -0,0 +1,91 @@
+"""Admission control for incoming updates (`admission`).
+
+Updates are checked before any bytes are fetched or threads started:
+images by their reported size and the number of image jobs in progress,
+and images and commands by a token bucket per sender.
+"""
+
+import logging
+from threading import Lock
+import time
+
+import metrics
+
+
+l = logging.getLogger(__name__)
+
+REJECTED = metrics.counter('admission_rejected_total', "Updates rejected by admission control",
+                           labels=('kind', 'reason'))
+
+# Buckets are dropped once they are full again, beyond this many senders
+MAX_BUCKETS = 10000
+
+
+class Admission(object):
+    def __init__(self):
+        self.pending = None  # callable returning the number of image jobs in progress
+        self._buckets = {}  # (kind, sender id) -> [tokens, last refill, rejected]
+        self._limits = {}  # kind -> its limit as last used, for pruning
+        self._lock = Lock()
+
+    def admit_image(self, conf, sender_id, file_size):
+        """Return None to accept an image, or the reply explaining why it is not."""
+        settings = conf.admission
+        if settings.max_file_size and file_size and file_size > settings.max_file_size:
+            REJECTED.inc(kind='image', reason='file_size')
+            l.info("rejecting file of {} bytes from {}", file_size, sender_id)
+            return ("This file is too large ({:.1f} MB); the limit is {:.1f} MB."
+                    .format(file_size / 1e6, settings.max_file_size / 1e6))
+
+        if settings.max_pending and self.pending:
+            pending = self.pending()
+            if pending >= settings.max_pending:
+                REJECTED.inc(kind='image', reason='busy')
+                l.warn("rejecting image from {}; {} image jobs in progress", sender_id, pending)
+                return "I am busy right now, please try again in a few minutes."
+
+        return self._take('image', sender_id, settings.images)
+
+    def admit_command(self, conf, sender_id):
+        """Return None to accept a text message, or the reply explaining why it is not.
+
+        The reply is '' for further messages while the sender stays over the limit,
+        which should not be answered at all.
+        """
+        return self._take('command', sender_id, conf.admission.commands)
+
+    def _take(self, kind, sender_id, limit):
+        if not limit.rate:
+            return None
+
+        key = (kind, sender_id)
+        now = time.monotonic()
+        burst = limit.burst
+        with self._lock:
+            self._limits[kind] = limit
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= MAX_BUCKETS:
+                    self._prune(now)
+                bucket = self._buckets[key] = [burst, now, 0]
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * limit.rate)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                bucket[2] = 0
+                return None
+            bucket[2] += 1
+            first = bucket[2] == 1
+
+        REJECTED.inc(kind=kind, reason='rate')
+        if not first:
+            return ''
+        l.info("{} rate limit reached for {}", kind, sender_id)
+        return ("You are sending too fast; please wait {:.0f} seconds."
+                .format(max(1 / limit.rate, 1)))
+
+    def _prune(self, now):
+        for key, bucket in list(self._buckets.items()):
+            limit = self._limits[key[0]]
+            if not limit.rate or bucket[0] + (now - bucket[1]) * limit.rate >= limit.burst:
+                del self._buckets[key]
@@ -1,30 +1,217 @@
+import base64
+import itertools
 import logging
+import queue
 from threading import Lock
 import time
 
 import asyncirc
 
+import metrics
 from util import randomstr
 
 
 l = logging.getLogger(__name__)
 
+QUEUE_SIZE = metrics.gauge('irc_queue_size', "Lines waiting in the IRC client queues",
+                           labels=('network', 'queue'))
+RECONNECTS = metrics.counter('irc_reconnects_total', "Re-established IRC connections",
+                             labels=('network',))
+DROPPED = metrics.counter('irc_dropped_messages_total',
+                          "Messages given up on before the server acknowledged them",
+                          labels=('network',))
+
+# Prefix of the PING tokens that acknowledge sent messages
+ACK_PREFIX = "ack-"
+# Messages sent at most before an "ack" PING while the send queue does not drain
+ACK_BATCH = 20
+# Limits of the messages kept for acknowledgement; older ones are dropped
+MAX_UNACKED = 500
+MAX_UNACKED_AGE = 600  # seconds
+
 
 class IRCBot(asyncirc.IRCBot):
-    def __init__(self, *args, **kwargs):
+    """IRC bot that survives reconnects.
+
+    Channels are (re-)joined once registration completes.
+    Messages are kept until the server acknowledged them:
+    once the send queue drains, or after `ACK_BATCH` messages,
+    a PING with the sequence number of the last message is sent,
+    and the matching PONG proves that the server processed everything sent before it.
+    Unacknowledged messages are sent again after a reconnect,
+    so a message may be delivered twice.
+    At most `MAX_UNACKED` messages are kept for up to `MAX_UNACKED_AGE` seconds.
+    Servers that never answered an "ack" PING get only the messages that were not sent yet,
+    as nothing shows which of the others arrived.
+    """
+
+    def __init__(self, *args, name='default', **kwargs):
         super().__init__(*args, **kwargs)
-        if hasattr(self._socket, 'version'):  # ssl.SSLSocket; added in Py3.5
-            ssl_version = self._socket.version()
-            if ssl_version is None:
-                l.error("requested SSL/TLS connection, but none could be established")
-            l.debug("using SSL version {}", ssl_version)
 
+        self.name = name
         self._connected = False
+        self.channels = {}  # channel -> key
+        self._unacked = []  # (seq, channel, message, queued_at), oldest first
+        self._seq = itertools.count(1)
+        self._last_sent = 0  # highest seq written to a connection
+        self._last_pinged = 0  # highest seq followed by an "ack" PING
+        self._acks_seen = False  # whether the server answered an "ack" PING
+        self._state_lock = Lock()
         self.auth_map = {}
         self._auth_map_lock = Lock()
 
         self.on_chanmsg(self.__class__.on_msg_command)
 
+        QUEUE_SIZE.set_function(self._in_queue.qsize, network=name, queue='in')
+        QUEUE_SIZE.set_function(self._out_queue.qsize, network=name, queue='out')
+        QUEUE_SIZE.set_function(lambda: len(self._unacked), network=name, queue='unacked')
+
+    def join(self, channel, key=None):
+        with self._state_lock:
+            self.channels[channel] = key
+            if not self._connected:
+                return  # joined once registered
+        super().join(channel, key)
+
+    def msg(self, channel, message):
+        with self._state_lock:
+            seq = next(self._seq)
+            self._unacked.append((seq, channel, message, time.time()))
+            self._expire()
+            if not self._connected:
+                return  # sent once registered
+            self._send_msg(seq, channel, message)
+
+    def _send_msg(self, seq, channel, message):
+        """Queue a message; the state lock must be held."""
+        super().msg(channel, message)
+        self._last_sent = seq
+        if self._last_sent - self._last_pinged >= ACK_BATCH:
+            self._send_ack_ping()
+
+    def _send_ack_ping(self):
+        # Acknowledges every message up to the last one queued before it
+        self.send_raw("PING :{}{}".format(ACK_PREFIX, self._last_sent))
+        self._last_pinged = self._last_sent
+
+    def _on_sent_all(self):
+        with self._state_lock:
+            if self._connected and self._last_sent > self._last_pinged:
+                self._send_ack_ping()
+
+    def _expire(self):
+        """Drop messages over the age and size limits; the state lock must be held."""
+        oldest = time.time() - MAX_UNACKED_AGE
+        kept = [m for m in self._unacked[-MAX_UNACKED:] if m[3] >= oldest]
+        dropped = len(self._unacked) - len(kept)
+        if dropped:
+            self._unacked = kept
+            DROPPED.inc(dropped, network=self.name)
+            l.warn("dropped {} unacknowledged messages to {}", dropped, self.name)
+
+    def _on_registered(self):
+        with self._state_lock:
+            if self._connected:
+                return
+            self._connected = True
+            self._expire()
+            if not self._acks_seen:
+                # Without acknowledgements a replay would repeat everything ever sent
+                unsent = [m for m in self._unacked if m[0] > self._last_sent]
+                if len(unsent) < len(self._unacked):
+                    l.warn("{} never acknowledged messages; not sending {} of them again",
+                           self.name, len(self._unacked) - len(unsent))
+                self._unacked = unsent
+            l.info("IRC client connected to {} as {}; joining {} channels, sending {} messages",
+                   self.name, self.nick, len(self.channels), len(self._unacked))
+            self._last_pinged = 0  # a PING may have been lost with the connection
+            for channel, key in self.channels.items():
+                super().join(channel, key)
+            for seq, channel, message, _ in self._unacked:
+                self._send_msg(seq, channel, message)
+
+    def _on_acked(self, seq):
+        with self._state_lock:
+            self._acks_seen = True
+            self._unacked = [m for m in self._unacked if m[0] > seq]
+
+    def _on_connected(self):
+        if self.reconnects:
+            RECONNECTS.inc(network=self.name)
+
+    def _on_disconnected(self):
+        with self._state_lock:
+            self._connected = False
+        l.warn("IRC connection to {} lost; {} messages waiting for acknowledgement",
+               self.name, len(self._unacked))
+
+    def queue_sizes(self):
+        return {'in': self._in_queue.qsize(), 'out': self._out_queue.qsize(),
+                'unacked': len(self._unacked)}
+
+    def stop(self):
+        if self._send_thread is None:  # never started
+            return
+        super().stop()
+
+    def detach_state(self, timeout=10):
+        """Detach from the connection for another process to continue it.
+
+        Returns the socket and a JSON-serializable state for `adopt_state`,
+        or None if the connection cannot be handed over
+        (not registered yet, or TLS).
+        Pending auth callbacks are not part of the state.
+        """
+        if not self._connected:
+            return None
+        detached = self.detach(timeout)
+        if not detached:
+            return None
+        sock, recv_buffer = detached
+
+        lines = []
+        while True:
+            try:
+                lines.append(self._in_queue.get_nowait())
+            except queue.Empty:
+                break
+        with self._state_lock:
+            self._connected = False
+            state = dict(
+                nick=self.nick,
+                channels=self.channels,
+                unacked=self._unacked,
+                seq=next(self._seq),
+                last_sent=self._last_sent,
+                acks_seen=self._acks_seen,
+                recv_buffer=base64.b64encode(recv_buffer).decode('ascii'),
+                in_queue=lines,
+            )
+        return sock, state
+
+    def adopt_state(self, sock, state):
+        """Continue a registered connection handed over by `detach_state`."""
+        with self._state_lock:
+            joined = state['channels']
+            new_channels = {c: k for c, k in self.channels.items() if c not in joined}
+            self.nick = state['nick']
+            self.channels = dict(joined, **new_channels)
+            # Messages from a predecessor without queue times count as queued now
+            self._unacked = [tuple(m) if len(m) > 3 else tuple(m) + (time.time(),)
+                             for m in state['unacked']]
+            self._seq = itertools.count(state['seq'])
+            self._last_sent = state.get('last_sent', state['seq'] - 1)
+            self._acks_seen = state.get('acks_seen', False)
+            self._last_pinged = 0
+            for line in state['in_queue']:
+                self._in_queue.put(line)
+            self._connected = True
+        self.adopt(sock, base64.b64decode(state['recv_buffer']))
+        for channel, key in new_channels.items():
+            super().join(channel, key)
+        l.info("continuing IRC connection as {} with {} unacknowledged messages",
+               self.nick, len(self._unacked))
+
     def new_auth_callback(self, callback, authcode=None):
         with self._auth_map_lock:
             while not authcode or authcode in self.auth_map:
@@ -62,8 +249,15 @@ class IRCBot(asyncirc.IRCBot):
 
     # Check for successful connection and auto-rename if nick already in use
     def _process_data(self, line):
+        words = line.split()
+        if len(words) > 2 and words[1] == 'PONG':
+            token = words[-1].lstrip(":")
+            if token.startswith(ACK_PREFIX) and token[len(ACK_PREFIX):].isdigit():
+                self._on_acked(int(token[len(ACK_PREFIX):]))
+            return
+
         try:
-            code = int(line.split()[1])
+            code = int(words[1])
         except:
             pass
         else:
@@ -71,8 +265,7 @@ class IRCBot(asyncirc.IRCBot):
             # 266 is the current global user count;
             # 251 is used by slack.
             if code in (266, 251):
-                self._connected = True
-                l.info("IRC client connected as {}", self.nick)
+                self._on_registered()
             elif code == 433:  # Nickname is already in use
                 self.nick += "_"
                 self.send_raw("NICK {nick}".format(nick=self.nick))
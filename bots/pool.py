@@ -0,0 +1,116 @@
+from collections import OrderedDict
+import logging
+from threading import Thread
+
+from config.schema import DEFAULT_NETWORK
+
+from .irc import IRCBot
+
+
+l = logging.getLogger(__name__)
+
+
+def targets(conf, c_id):
+    """(network, channel) pairs that images from chat `c_id` are posted to.
+
+    Chats without a route go to the channel of every network.
+    """
+    routed = conf.routes.get(c_id)
+    if routed:
+        return routed
+    channels = [(DEFAULT_NETWORK, conf.irc.channel)]
+    channels.extend((name, net.channel) for name, net in conf.irc.networks.items())
+    return tuple((name, channel) for name, channel in channels if channel)
+
+
+class IRCPool:
+    """One `IRCBot` per configured network.
+
+    Every bot has its own send queue and threads,
+    so a slow or disconnected network does not hold up posts to the others.
+    """
+
+    def __init__(self, conf):
+        self.bots = OrderedDict()
+        networks = [(DEFAULT_NETWORK, conf.irc)]
+        networks.extend(conf.irc.networks.items())
+        for name, net in networks:
+            self.bots[name] = IRCBot(
+                name=name,
+                host=net.host,
+                port=net.port,
+                nick=net.nick,
+                realname=net.nick,
+                password=net.password,
+                use_ssl=net.ssl,
+                keepalive=net.keepalive,
+                min_reconnect_delay=net.reconnect.min_delay,
+                max_reconnect_delay=net.reconnect.max_delay
+            )
+        self.join_routes(conf)
+
+    @property
+    def default(self):
+        return self.bots[DEFAULT_NETWORK]
+
+    def join_routes(self, conf):
+        """Join each network's channel and all channels routed to it."""
+        joins = set(targets(conf, None))
+        for routed in conf.routes.values():
+            joins.update(routed)
+        for name, channel in sorted(joins):
+            bot = self.bots.get(name)
+            if bot and channel not in bot.channels:
+                bot.join(channel)
+
+    def start(self, handoff=None, socks=()):
+        """Connect all networks, or continue the connections in `handoff`.
+
+        Raises OSError if the default network cannot be connected;
+        the others are connected in the background and retried until they are.
+        """
+        handoff = handoff or {}
+        if 'nick' in handoff:  # a single connection from before networks existed
+            handoff = {DEFAULT_NETWORK: dict(handoff, fd=0)}
+
+        for name, bot in self.bots.items():
+            state = handoff.get(name)
+            if state:
+                bot.adopt_state(socks[state['fd']], state)
+            elif name != DEFAULT_NETWORK:
+                Thread(target=bot.start, kwargs=dict(retry=True),
+                       name="IRCStart-" + name, daemon=True).start()
+        if DEFAULT_NETWORK not in handoff:
+            self.default.start()
+
+    def msg(self, network, channel, message):
+        bot = self.bots.get(network)
+        if not bot:
+            l.warn("no IRC network {!r}; dropping message to {}", network, channel)
+            return
+        bot.msg(channel, message)
+
+    def queue_sizes(self):
+        return {"{}.{}".format(name, queue): size
+                for name, bot in self.bots.items()
+                for queue, size in bot.queue_sizes().items()}
+
+    def detach_state(self):
+        """Detach all connections that can be handed over; see `IRCBot.detach_state`.
+
+        Returns the sockets and a state for `start`, with indexes into the sockets.
+        """
+        socks, states = [], {}
+        for name, bot in self.bots.items():
+            detached = bot.detach_state()
+            if detached:
+                states[name] = dict(detached[1], fd=len(socks))
+                socks.append(detached[0])
+            else:
+                l.warn("IRC connection to {} cannot be handed over; the new process reconnects",
+                       name)
+        return socks, states
+
+    def stop(self):
+        for bot in self.bots.values():
+            bot.stop()
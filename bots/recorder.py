@@ -0,0 +1,107 @@
+import base64
+import gzip
+import json
+import logging
+from threading import Lock, Timer
+import time
+
+
+l = logging.getLogger(__name__)
+
+# twx renames some fields of the Bot API objects
+_FIELD_NAMES = {'sender': 'from'}
+
+# Seconds written lines may stay buffered; a crash loses at most this much of the log
+FLUSH_INTERVAL = 1
+# Bytes of a recorded file encoded at a time; a multiple of 3, so pieces need no padding
+FILE_CHUNK_SIZE = 3 * 64 * 1024
+
+
+def to_api_object(obj):
+    """Convert (nested) twx result objects back into Bot API JSON objects."""
+    if hasattr(obj, '_asdict'):
+        return {_FIELD_NAMES.get(k, k): to_api_object(v)
+                for k, v in obj._asdict().items() if v is not None}
+    if isinstance(obj, (list, tuple)):
+        return [to_api_object(v) for v in obj]
+    if hasattr(obj, 'value'):  # enums
+        return obj.value
+    return obj
+
+
+class UpdateRecorder(object):
+    """Appends received updates (and optionally downloaded files) to a gzipped JSON lines log.
+
+    Every line is an object with the wall-clock time `t`
+    and either an `update` or a `file` entry.
+    """
+
+    def __init__(self, path, contents=False):
+        self.path = path
+        self.contents = contents
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self._lock = Lock()
+        self._flush_timer = None
+        l.info("recording updates to {}", path)
+
+    def _write(self, entry):
+        entry['t'] = time.time()
+        line = json.dumps(entry, separators=(',', ':'))
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line + "\n")
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        # The lock must be held
+        if self._flush_timer is None:
+            self._flush_timer = Timer(FLUSH_INTERVAL, self.flush)
+            self._flush_timer.name = "RecorderFlush"
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._flush_timer = None
+            if self._file is not None:
+                self._file.flush()
+
+    def record_updates(self, updates):
+        for update in updates:
+            self._write(dict(update=to_api_object(update)))
+
+    def record_file(self, file_id, local_path):
+        if not self.contents:
+            return
+        # The base64 data is streamed into the line instead of building it in memory
+        head = json.dumps(dict(file=file_id, t=time.time()), separators=(',', ':'))
+        with open(local_path, 'rb') as f, self._lock:
+            if self._file is None:
+                return
+            self._file.write(head[:-1] + ',"data":"')
+            for chunk in iter(lambda: f.read(FILE_CHUNK_SIZE), b''):
+                self._file.write(base64.b64encode(chunk).decode('ascii'))
+            self._file.write('"}\n')
+            self._schedule_flush()
+
+    def close(self):
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_log(path):
+    """Yield the entries of a log written by `UpdateRecorder`."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        except (EOFError, ValueError) as e:
+            # The recording process may have died mid-write
+            l.warn("log {} ends with a truncated entry: {}", path, e)
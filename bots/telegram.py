@@ -1,18 +1,32 @@
 from collections import defaultdict
 import logging
 import mimetypes
+from threading import Event, Lock
 import time
 
 from twx import botapi
 
-from models.image import ImageInfo
+import metrics
+from models.image import ImageDatabase, ImageInfo
+from models.trace import STAGES, TraceDatabase
 from util import wrap
+from util.memstats import MemStats
+from util.profiler import SamplingProfiler, profile_path
+
+from .admission import Admission
 
 
 IMAGE_EXTENSIONS = ('.jpg', '.png', '.gif')
 
 l = logging.getLogger(__name__)
 
+UPDATES = metrics.counter('telegram_updates_total', "Telegram updates by kind", labels=('kind',))
+HANDLE_SECONDS = metrics.histogram('telegram_handle_updates_seconds',
+                                   "Time spent handling a batch of updates")
+POLLS = metrics.counter('telegram_polls_total', "Long polling requests by result",
+                        labels=('result',))
+POLL_SECONDS = metrics.histogram('telegram_poll_seconds', "Duration of long polling requests")
+
 
 class TelegramImageBot(botapi.TelegramBot):
     _command_handlers = defaultdict(list)
@@ -23,6 +37,13 @@ class TelegramImageBot(botapi.TelegramBot):
         self.conf = conf
         self.user_db = user_db
         self.on_image = on_image
+        self.recorder = None
+        self.file_infos = None  # FileInfoCache
+        self.admission = Admission()
+        self.memstats = MemStats()
+        self.profiler = SamplingProfiler()
+        self._stopped = Event()
+        self._handle_lock = Lock()
 
     # @command('cmdname') decorator
     @classmethod
@@ -46,8 +67,20 @@ class TelegramImageBot(botapi.TelegramBot):
         self._offset = offset
 
     def handle_updates(self, updates):
+        with self._handle_lock:
+            if self._stopped.is_set():
+                # Not confirmed, so the next poller receives them again
+                l.info("polling stopped, leaving {} updates", len(updates or ()))
+                return
+            self._handle_updates(updates)
+
+    @HANDLE_SECONDS.timed()
+    def _handle_updates(self, updates):
+        POLLS.inc(result='ok')
         if not updates:
             return
+        if self.recorder:
+            self.recorder.record_updates(updates)
 
         for update in updates:
             upd_id, message = update.update_id, update.message
@@ -63,6 +96,7 @@ class TelegramImageBot(botapi.TelegramBot):
                             remote_path=None, local_path=None, url=None, finished=False)
 
             if message.document:
+                UPDATES.inc(kind='document')
                 l.info("received document from {0.sender}: {0.document}", message)
                 # Check for image mime types
                 mime_type = message.document.mime_type
@@ -72,7 +106,7 @@ class TelegramImageBot(botapi.TelegramBot):
                     if ext in IMAGE_EXTENSIONS:
                         # Download document (image file)
                         img = img._replace(ext=ext, f_id=message.document.file_id)
-                        self.on_image(img)
+                        self.submit_image(message, img, message.document.file_size)
                     else:
                         l.warn("cannot handle MIME-type {}", mime_type)
                         self.send_message(message.chat.id, "I do not know how to handle that")
@@ -80,6 +114,7 @@ class TelegramImageBot(botapi.TelegramBot):
                     l.warn("no MIME-type detected; {0.document}", message)
 
             elif message.photo:
+                UPDATES.inc(kind='photo')
                 l.info("received photo from {0.sender}: {0.photo}",
                        message)
                 sorted_photo = sorted(message.photo, key=lambda p: p.file_size)
@@ -88,21 +123,36 @@ class TelegramImageBot(botapi.TelegramBot):
 
                 # Download the file (always jpg)
                 img = img._replace(f_id=sorted_photo[-1].file_id)
-                self.on_image(img)
+                self.submit_image(message, img, sorted_photo[-1].file_size)
 
             elif message.text:
+                UPDATES.inc(kind='text')
                 self.on_text(message)
 
             else:
+                UPDATES.inc(kind='other')
                 l.warn("didn't handle update: {}", update)
                 self.send_message(message.chat.id, "I do not know how to handle that")
 
             if not self.offset or upd_id >= self.offset:
                 self.offset = upd_id + 1
 
+    def submit_image(self, message, img, file_size):
+        reply = self.admission.admit_image(self.conf, message.sender.id, file_size)
+        if reply is None:
+            self.on_image(img)
+        elif reply:
+            self.send_message(message.chat.id, reply)
+
     def on_text(self, message):
         l.info("received text from {0.sender}: {0.text!r}", message)
 
+        reply = self.admission.admit_command(self.conf, message.sender.id)
+        if reply is not None:
+            if reply:
+                self.send_message(message.chat.id, reply)
+            return
+
         # check if this is a command
         if message.text.startswith("/") and len(message.text) > 1:
             cmd, *args = message.text[1:].split()
@@ -120,10 +170,10 @@ class TelegramImageBot(botapi.TelegramBot):
 
             for func, admin in self._command_handlers[cmd]:
                 if admin:
-                    if message.sender.id not in (self.conf.telegram.admin or []):
+                    if message.sender.id not in self.conf.telegram.admin:
                         self.send_message(message.chat.id,
                                           "You must be an admin to use this command.")
-                    continue
+                        continue
                 reply = func(self, args, message)
                 if reply:
                     if reply is not True:
@@ -134,18 +184,29 @@ class TelegramImageBot(botapi.TelegramBot):
                               "Just send me photos or images or type /help for a list of commands")
 
     def handle_error(self, error):
+        POLLS.inc(result='error')
         l.error("failed to fetch data; {}", error)
         # Delay next poll if there was an error
-        time.sleep(self.conf.telegram.timeout or 60)
+        time.sleep(self.conf.telegram.timeout)
+
+    def stop_polling(self):
+        """Make `poll_loop` return and stop handling updates.
+
+        Returns once a batch of updates in progress is handled,
+        so `offset` is final afterwards.
+        """
+        self._stopped.set()
+        with self._handle_lock:
+            return self.offset
 
     def poll_loop(self):
-        timeout = self.conf.telegram.timeout or 60
-        l.info("poll loop initiated with timeout {}", timeout)
+        l.info("poll loop initiated with timeout {}", self.conf.telegram.timeout)
 
         i = 0
-        while True:
+        while not self._stopped.is_set():
             i += 1
             l.debug("poll #{}", i)
+            timeout = self.conf.telegram.timeout
 
             # Long polling
             req = botapi.get_updates(
@@ -156,9 +217,11 @@ class TelegramImageBot(botapi.TelegramBot):
                 **self.request_args
             )
             req.thread.daemon = True
-            req.run()
-            while req.thread.is_alive():
-                req.join(1)
+            with POLL_SECONDS.time():
+                req.run()
+                while req.thread.is_alive() and not self._stopped.is_set():
+                    req.join(1)
+        l.info("poll loop stopped at offset {}", self.offset)
 
 
 # Add text commands (how2decorator in-class)
@@ -172,12 +235,14 @@ def cmd_start(self, args, message):
         which I will upload
         and link to in the IRC channel
         {conf.irc.channel} on {conf.irc.host}.
+        Use /search <terms> to find images posted before
+        by their caption or poster.
 
         Contact {conf.telegram.username_for_help}
         in case you are having problems.
     """).format(conf=self.conf)
 
-    if message.sender.id in (self.conf.telegram.admin or []):
+    if message.sender.id in self.conf.telegram.admin:
         msg = msg + "\n\n" + wrap("""
             More commands:
 
@@ -186,6 +251,12 @@ def cmd_start(self, args, message):
             More commands for admins:
 
             /blacklist [add | remove] <id> - modify the blacklist
+
+            /stats - stage latencies and throughput
+
+            /memstats [stop] - memory, threads, file descriptors and queues
+
+            /profile [seconds] - sample the stacks of all threads
         """)
 
     return msg
@@ -207,6 +278,61 @@ def cmd_get_id(self, args, message):
     return message.sender.id
 
 
+@TelegramImageBot.command('search')
+def cmd_search(self, args, message):
+    """/search <terms>"""
+    c_id = message.sender.id
+    if c_id not in self.user_db.name_map or c_id in self.user_db.blacklist:
+        return "You need to /auth before you can search."
+    if not args:
+        return "Command signature: {}".format(cmd_search.__doc__)
+    if not self.conf.storage.database:
+        return "No database configured."
+
+    with ImageDatabase(self.conf.storage.database) as db:
+        if not db.searchable:
+            return "Search is not available."
+        results = db.search(args)
+    if not results:
+        return "No images found."
+    return "\n".join(
+        "{} <{}> {}{}".format(time.strftime("%Y-%m-%d", time.localtime(img.time)),
+                              img.username, img.url, " " + img.caption if img.caption else "")
+        for img in results
+    )
+
+
+@TelegramImageBot.command('memstats', True)
+def cmd_memstats(self, args, message):
+    """/memstats [stop]"""
+    if args and args[0].lower() == 'stop':
+        self.memstats.stop()
+        return "Stopped tracemalloc."
+    return "\n".join(self.memstats.report())
+
+
+@TelegramImageBot.command('profile', True)
+def cmd_profile(self, args, message):
+    """/profile [seconds]"""
+    settings = self.conf.profiler
+    if args and not args[0].isdigit():
+        return "Command signature: {}".format(cmd_profile.__doc__)
+    seconds = int(args[0]) if args else settings.seconds
+    seconds = min(seconds, settings.max_seconds)
+    chat_id = message.chat.id
+
+    def on_done(profile, path):
+        if profile:
+            self.send_message(chat_id, "\n".join(profile.summary() + ["Written to " + path]))
+        else:
+            self.send_message(chat_id, "Profiling failed; see the log.")
+
+    if not self.profiler.start(seconds, profile_path(settings.path),
+                               interval=settings.interval, on_done=on_done):
+        return "A profile is running already."
+    return "Profiling all threads for {} seconds.".format(seconds)
+
+
 @TelegramImageBot.command('blacklist', True)
 def cmd_blacklist(self, args, message):
     """/blacklist [add | remove] <id>"""
@@ -222,3 +348,38 @@ def cmd_blacklist(self, args, message):
         return "Blacklist changed."
     else:
         return "Blacklist operation failed."
+
+
+@TelegramImageBot.command('stats', True)
+def cmd_stats(self, args, message):
+    """/stats"""
+    if not self.conf.storage.database:
+        return "No database configured."
+
+    def fmt(value):
+        return "-" if value is None else "{:.2f}".format(value)
+
+    lines = []
+    now = time.time()
+    with TraceDatabase(self.conf.storage.database) as traces:
+        for window, seconds in (("hour", 3600), ("day", 86400)):
+            delivered = traces.count('reply', now - seconds)
+            lines.append("Last {}: {} images delivered ({:.1f}/h)"
+                         .format(window, delivered, delivered / seconds * 3600))
+            for stage in STAGES[1:] + ('total',):
+                count, values = traces.percentiles(stage, now - seconds)
+                if count:
+                    lines.append("  {}: {} s (n={})"
+                                 .format(stage, " / ".join(map(fmt, values)), count))
+
+    lines.append("(p50 / p90 / p99)")
+    with ImageDatabase(self.conf.storage.database) as db:
+        images, archived = db.count_images()
+        used, free = db.database_size()
+    lines.append("Database: {} images, {} archived; {:.1f} MB in use, {:.1f} MB free"
+                 .format(images, archived, used / 1e6, free / 1e6))
+    if self.file_infos:
+        stats = self.file_infos.stats()
+        lines.append("getFile cache: {hits} hits, {misses} misses ({hit_rate:.0%}), "
+                     "{stale} stale, {entries} entries".format(**stats))
+    return "\n".join(lines)
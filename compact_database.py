@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""Enable incremental vacuum on the image database, for `maintenance.vacuum_pages`.
+
+This rewrites the whole database and locks it meanwhile; stop the bot first.
+"""
+
+import config
+from models.image import ImageDatabase
+
+CONFIG_FILE = "config.yaml"
+
+
+def compact():
+    conf = config.read_file(CONFIG_FILE)
+    if not conf.storage.database:
+        print("No database configured (storage.database).")
+        return
+
+    with ImageDatabase(conf.storage.database) as db:
+        if db.incremental_vacuum:
+            reclaimed = db.compact()
+            print("Incremental vacuum is enabled already.")
+        else:
+            print("Rewriting {} ...".format(conf.storage.database))
+            reclaimed = db.enable_incremental_vacuum()
+        used, free = db.database_size()
+
+    print("Reclaimed {:.1f} MB; {:.1f} MB in use.".format(reclaimed / 1e6, used / 1e6))
+
+
+if __name__ == "__main__":
+    compact()
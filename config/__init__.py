@@ -1,7 +1,8 @@
 import logging
 import os
 
-import yaml
+from .schema import compile_config, ConfigError, diff, is_live, replace_keys, to_dict  # noqa
+from .schema import DEFAULT_NETWORK
 
 
 l = logging.getLogger(__name__)
@@ -15,7 +16,10 @@ def _replace_with_type(type_, replace_type, data):
 
 # defaultdict is not an option because of recursivity
 class Config(dict):
-    # TODO docstring
+    """Raw, mutable config data as read from the YAML files; used for merging.
+
+    The application works with the result of `compile_config`.
+    """
 
     def __init__(self, items=None):
         if items is not None:
@@ -31,17 +35,7 @@ class Config(dict):
         if key in self:
             return self[key]
         else:
-            l.warn("AttrDict: did not find key '{}' in {}", key, self.keys())
-
-            if l.getEffectiveLevel() <= logging.INFO:
-                import inspect
-                stack = inspect.stack(1)[1:]
-                l.info("-- AttrDict stack --")
-                for info in reversed(stack):
-                    l.info('  File "{0[1]}", line {0[2]}, in {0[3]} -- {1}',
-                           info, info[4][-1].strip())
-                l.info("-- AttrDict stack -- end")
-
+            l.debug("AttrDict: did not find key '{}' in {}", key, self.keys())
             return self.__class__()  # return empty 'Config' as default
 
     def update(self, other=None):
@@ -53,8 +47,8 @@ class Config(dict):
             return
 
         for k, v in other.items():
-            if isinstance(v, self.__class__):
-                if not isinstance(self.get(k), self.__class__):
+            if isinstance(v, self.__class__) and k in self:
+                if not isinstance(self[k], self.__class__):
                     l.warn("Attempted to override {} instance with {} type",
                            self.__class__, type(v))
                     continue
@@ -66,6 +60,12 @@ class Config(dict):
 
 
 def read_file(filename, consider_user_config=True):
+    """Read, merge and compile the config file and the user config file it refers to.
+
+    Raises ConfigError if a value does not match the schema.
+    """
+    import yaml
+
     l.debug("reading config file: '{}'", filename)
     with open(filename) as f:
         config = Config(yaml.safe_load(f))
@@ -82,4 +82,34 @@ def read_file(filename, consider_user_config=True):
         else:
             l.warn("user_config file not found: '{}'", config.user_config)
 
-    return config
+    return compile_config(config)
+
+
+def source_files(filename, conf):
+    """The files `read_file(filename)` reads for `conf`, for watching them."""
+    return [filename, conf.user_config] if conf.user_config else [filename]
+
+
+def reload_file(filename, old):
+    """Read the config again and compare it to `old`.
+
+    Returns the config to use from now on,
+    i.e. `old` with the changed keys that can be applied live,
+    the list of those keys and the list of changed keys that require a restart.
+    Routes to networks that are only connected after a restart require one as well.
+    Raises ConfigError like `read_file`; `old` stays valid then.
+    """
+    new = read_file(filename)
+    changed = diff(old, new)
+    live = [k for k in changed if is_live(k)]
+    restart = [k for k in changed if not is_live(k)]
+    if 'routes' in live:
+        connected = {DEFAULT_NETWORK}.union(old.irc.networks)
+        unconnected = {network for targets in new.routes.values()
+                       for network, _ in targets} - connected
+        if unconnected:
+            l.warn("routes to networks that are not connected yet: {}",
+                   ", ".join(sorted(unconnected)))
+            live.remove('routes')
+            restart.append('routes')
+    return replace_keys(old, new, live), live, restart
@@ -0,0 +1,527 @@
+"""Typed defaults for all known config keys and the converters that validate them.
+
+`compile_config` turns the merged YAML data into nested namedtuples:
+immutable, slotted and with constant-time attribute access.
+Every known key is present and missing or empty ones have their default,
+so `conf.section.key` never misses and needs no fallback at the call site.
+"""
+
+from collections import namedtuple
+from collections.abc import Mapping
+import copyreg
+import logging
+import os
+import re
+from string import Template
+import tempfile
+from types import MappingProxyType
+
+
+l = logging.getLogger(__name__)
+
+
+class ConfigError(ValueError):
+    pass
+
+
+Option = namedtuple('Option', 'convert default')
+
+
+# Converters receive a non-None value and return it converted or raise ValueError
+
+def string(value):
+    if isinstance(value, (dict, list)):
+        raise ValueError("expected a string, got {!r}".format(value))
+    return str(value)
+
+
+def integer(value):
+    if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+        raise ValueError("expected an integer, got {!r}".format(value))
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError("expected an integer, got {!r}".format(value)) from None
+
+
+def number(value):
+    if isinstance(value, bool):
+        raise ValueError("expected a number, got {!r}".format(value))
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError("expected a number, got {!r}".format(value)) from None
+
+
+def boolean(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ('true', 'yes', 'on', '1'):
+        return True
+    if isinstance(value, str) and value.lower() in ('false', 'no', 'off', '0'):
+        return False
+    raise ValueError("expected a boolean, got {!r}".format(value))
+
+
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+_DURATION_RE = re.compile(r"^(\d+(?:\.\d+)?)\s*([smhd]?)$")
+
+
+def duration(value):
+    """Seconds from a number, "90s", "5m", "2h" or "[[h:]m:]s" (e.g. "5:00").
+
+    YAML 1.1 already reads unquoted `5:00` as 300;
+    quoted values and other units are handled here.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        seconds = value
+    elif isinstance(value, str) and ":" in value:
+        try:
+            parts = [float(p) for p in value.strip().split(":")]
+        except ValueError:
+            raise ValueError("invalid duration {!r}".format(value)) from None
+        if len(parts) > 3 or any(p < 0 for p in parts):
+            raise ValueError("invalid duration {!r}".format(value))
+        seconds = 0
+        for part in parts:
+            seconds = seconds * 60 + part
+    elif isinstance(value, str):
+        match = _DURATION_RE.match(value.strip().lower())
+        if not match:
+            raise ValueError("invalid duration {!r}".format(value))
+        seconds = float(match.group(1)) * _DURATION_UNITS[match.group(2) or 's']
+    else:
+        raise ValueError("invalid duration {!r}".format(value))
+
+    if seconds < 0:
+        raise ValueError("negative duration {!r}".format(value))
+    return int(seconds) if float(seconds).is_integer() else seconds
+
+
+def directory(value):
+    """Path with `$temp` substituted, made absolute."""
+    return os.path.abspath(Template(string(value)).substitute(temp=tempfile.gettempdir()))
+
+
+def log_level(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    level = getattr(logging, string(value).upper(), None)
+    if not isinstance(level, int):
+        raise ValueError("unknown log level {!r}".format(value))
+    return level
+
+
+def int_set(value):
+    if not isinstance(value, (list, tuple, set, frozenset)):
+        value = [value]
+    return frozenset(integer(v) for v in value)
+
+
+def mapping(value):
+    if not isinstance(value, Mapping):
+        raise ValueError("expected a mapping, got {!r}".format(value))
+    return MappingProxyType(dict(value))
+
+
+def positive(convert):
+    """Converter like `convert` that also rejects 0, for values where 0 would not work."""
+    def converter(value):
+        value = convert(value)
+        if value <= 0:
+            raise ValueError("expected a value above 0, got {!r}".format(value))
+        return value
+    return converter
+
+
+# Section types; module attributes, so compiled configs can be pickled for worker processes
+Config = namedtuple('Config', 'user_config telegram imgur storage irc routes timeouts retry '
+                              'pipeline admission maintenance profiler workers metrics reload '
+                              'handoff logging')
+TelegramConfig = namedtuple('TelegramConfig', 'token admin timeout download_retries '
+                                              'username_for_help api_url file_url '
+                                              'record file_info')
+TelegramRecordConfig = namedtuple('TelegramRecordConfig', 'path contents')
+TelegramFileInfoConfig = namedtuple('TelegramFileInfoConfig', 'ttl max_entries persist')
+ImgurConfig = namedtuple('ImgurConfig', 'client_id client_secret refresh_token album '
+                                        'timestamp_format api_url')
+StorageConfig = namedtuple('StorageConfig', 'directory delete_images cache database user_database')
+StorageCacheConfig = namedtuple('StorageCacheConfig', 'max_bytes max_files')
+IrcConfig = namedtuple('IrcConfig', 'host port ssl nick password channel timeout auth_timeout '
+                                    'keepalive reconnect order networks')
+NetworkConfig = namedtuple('NetworkConfig', 'host port ssl nick password channel '
+                                            'keepalive reconnect')
+ReconnectConfig = namedtuple('ReconnectConfig', 'min_delay max_delay')
+IrcOrderConfig = namedtuple('IrcOrderConfig', 'active timeout max_pending')
+TimeoutsConfig = namedtuple('TimeoutsConfig', 'total file_info download upload')
+RetryConfig = namedtuple('RetryConfig', 'active max_attempts base_delay max_delay interval')
+PipelineConfig = namedtuple('PipelineConfig', 'asyncio threads limits')
+PipelineLimitsConfig = namedtuple('PipelineLimitsConfig', 'db download upload')
+AdmissionConfig = namedtuple('AdmissionConfig', 'max_file_size max_pending images commands')
+RateLimitConfig = namedtuple('RateLimitConfig', 'rate burst')
+MaintenanceConfig = namedtuple('MaintenanceConfig', 'active interval archive_after batch '
+                                                    'vacuum_pages traces_after')
+ProfilerConfig = namedtuple('ProfilerConfig', 'path interval seconds max_seconds')
+WorkersConfig = namedtuple('WorkersConfig', 'processes')
+MetricsConfig = namedtuple('MetricsConfig', 'active host port')
+ReloadConfig = namedtuple('ReloadConfig', 'watch interval')
+HandoffConfig = namedtuple('HandoffConfig', 'path drain_timeout timeout')
+LoggingConfig = namedtuple('LoggingConfig', 'active path level json rate_limit rotate')
+LoggingRateLimitConfig = namedtuple('LoggingRateLimitConfig', 'active per_second burst')
+
+
+# Missing keys and `None` values (empty in YAML) take the default.
+SCHEMA = {
+    'user_config': Option(string, "user_config.yaml"),
+    'telegram': {
+        'token': Option(string, None),
+        'admin': Option(int_set, frozenset()),
+        'timeout': Option(positive(duration), 60),
+        'download_retries': Option(integer, 5),
+        'username_for_help': Option(string, None),
+        'api_url': Option(string, None),
+        'file_url': Option(string, None),
+        'record': {
+            'path': Option(string, None),
+            'contents': Option(boolean, False),
+        },
+        'file_info': {
+            'ttl': Option(duration, 3000),
+            'max_entries': Option(integer, 1000),
+            'persist': Option(boolean, True),
+        },
+    },
+    'imgur': {
+        'client_id': Option(string, None),
+        'client_secret': Option(string, None),
+        'refresh_token': Option(string, None),
+        'album': Option(string, None),
+        'timestamp_format': Option(string, "%Y-%m-%dT%H:%M:%S"),
+        'api_url': Option(string, None),
+    },
+    'storage': {
+        'directory': Option(directory, "$temp/telegram"),
+        'delete_images': Option(boolean, False),
+        'cache': {
+            'max_bytes': Option(integer, None),
+            'max_files': Option(integer, None),
+        },
+        'database': Option(string, None),
+        'user_database': Option(string, "users.json"),
+    },
+    'irc': {
+        'host': Option(string, None),
+        'port': Option(positive(integer), 6667),
+        'ssl': Option(boolean, False),
+        'nick': Option(string, "TelegramBot"),
+        'password': Option(string, None),
+        'channel': Option(string, ''),
+        'timeout': Option(positive(duration), 7),
+        'auth_timeout': Option(positive(duration), 300),
+        'keepalive': Option(duration, 120),
+        'reconnect': {
+            'min_delay': Option(duration, 1),
+            'max_delay': Option(duration, 300),
+        },
+        'order': {
+            'active': Option(boolean, True),
+            'timeout': Option(duration, 60),
+            'max_pending': Option(integer, 100),
+        },
+        # name -> connection settings (see NETWORK_SCHEMA)
+        'networks': Option(mapping, MappingProxyType({})),
+    },
+    # Telegram chat id -> "network/#channel" targets; see `compile_config`
+    'routes': Option(mapping, MappingProxyType({})),
+    'timeouts': {
+        'total': Option(duration, None),
+        'file_info': Option(duration, None),
+        'download': Option(duration, None),
+        'upload': Option(duration, None),
+    },
+    'retry': {
+        'active': Option(boolean, True),
+        'max_attempts': Option(positive(integer), 8),
+        'base_delay': Option(duration, 30),
+        'max_delay': Option(duration, 3600),
+        'interval': Option(positive(duration), 10),
+    },
+    'pipeline': {
+        'asyncio': Option(boolean, False),
+        'threads': Option(positive(integer), 128),
+        'limits': {
+            'db': Option(positive(integer), 8),
+            'download': Option(positive(integer), 64),
+            'upload': Option(positive(integer), 64),
+        },
+    },
+    'admission': {
+        'max_file_size': Option(integer, 20000000),
+        'max_pending': Option(integer, 100),
+        # Token buckets per sender; a rate of 0 disables them
+        'images': {
+            'rate': Option(number, 0),
+            'burst': Option(positive(integer), 20),
+        },
+        'commands': {
+            'rate': Option(number, 0.2),
+            'burst': Option(positive(integer), 5),
+        },
+    },
+    'maintenance': {
+        'active': Option(boolean, True),
+        'interval': Option(positive(duration), 86400),
+        # Finished images older than this are moved to images_archive; 0 keeps them
+        'archive_after': Option(duration, 30 * 86400),
+        'batch': Option(positive(integer), 1000),
+        # Free pages returned per run; 0 for all
+        'vacuum_pages': Option(integer, 0),
+        # Job traces older than this are deleted (/stats reports the last day); 0 keeps them
+        'traces_after': Option(duration, 86400),
+    },
+    'profiler': {
+        'path': Option(string, "profiles"),
+        'interval': Option(positive(number), 0.02),
+        'seconds': Option(positive(duration), 30),
+        'max_seconds': Option(positive(duration), 300),
+    },
+    'workers': {
+        # 0 runs image jobs in threads of the main process
+        'processes': Option(integer, 0),
+    },
+    'metrics': {
+        'active': Option(boolean, False),
+        'host': Option(string, "127.0.0.1"),
+        'port': Option(positive(integer), 9120),
+    },
+    'reload': {
+        'watch': Option(boolean, False),
+        'interval': Option(positive(duration), 5),
+    },
+    'handoff': {
+        'path': Option(string, None),
+        'drain_timeout': Option(duration, 60),
+        'timeout': Option(positive(duration), 120),
+    },
+    'logging': {
+        'active': Option(boolean, True),
+        'path': Option(string, "log"),
+        'level': Option(log_level, logging.WARNING),
+        'json': Option(boolean, False),
+        'rate_limit': {
+            'active': Option(boolean, False),
+            'per_second': Option(positive(number), 10),
+            'burst': Option(positive(integer), 20),
+        },
+        'rotate': Option(mapping, MappingProxyType({})),
+    },
+}
+
+# Connection settings of an additional IRC network in `irc.networks`;
+# keys missing there are taken from `irc`.
+NETWORK_SCHEMA = {
+    key: SCHEMA['irc'][key]
+    for key in ('host', 'port', 'ssl', 'nick', 'password', 'channel', 'keepalive', 'reconnect')
+}
+
+# Name of the network configured directly in `irc`
+DEFAULT_NETWORK = 'default'
+
+# Keys that take effect without a restart when the config is reloaded;
+# a trailing dot covers a whole section.
+LIVE_KEYS = (
+    'telegram.admin', 'telegram.timeout', 'telegram.download_retries',
+    'telegram.username_for_help',
+    'imgur.album', 'imgur.timestamp_format',
+    'imgur.client_id', 'imgur.client_secret', 'imgur.refresh_token',
+    'storage.cache.',
+    'irc.auth_timeout', 'irc.order.',
+    'routes',
+    'admission.',
+    'profiler.',
+    'maintenance.interval', 'maintenance.archive_after', 'maintenance.batch',
+    'maintenance.vacuum_pages', 'maintenance.traces_after',
+    'timeouts.',
+    'retry.max_attempts', 'retry.base_delay', 'retry.max_delay', 'retry.interval',
+    'reload.interval',
+    'logging.level', 'logging.rate_limit.',
+)
+
+
+def is_live(key):
+    return any(key == k or k.endswith(".") and key.startswith(k) for k in LIVE_KEYS)
+
+
+copyreg.pickle(MappingProxyType, lambda proxy: (mapping, (dict(proxy),)))
+
+# Section path -> type
+_TYPES = {
+    (): Config,
+    ('telegram',): TelegramConfig,
+    ('telegram', 'record'): TelegramRecordConfig,
+    ('telegram', 'file_info'): TelegramFileInfoConfig,
+    ('imgur',): ImgurConfig,
+    ('storage',): StorageConfig,
+    ('storage', 'cache'): StorageCacheConfig,
+    ('irc',): IrcConfig,
+    ('irc', 'reconnect'): ReconnectConfig,
+    ('irc', 'order'): IrcOrderConfig,
+    ('timeouts',): TimeoutsConfig,
+    ('retry',): RetryConfig,
+    ('pipeline',): PipelineConfig,
+    ('pipeline', 'limits'): PipelineLimitsConfig,
+    ('admission',): AdmissionConfig,
+    ('admission', 'images'): RateLimitConfig,
+    ('admission', 'commands'): RateLimitConfig,
+    ('maintenance',): MaintenanceConfig,
+    ('profiler',): ProfilerConfig,
+    ('workers',): WorkersConfig,
+    ('metrics',): MetricsConfig,
+    ('reload',): ReloadConfig,
+    ('handoff',): HandoffConfig,
+    ('logging',): LoggingConfig,
+    ('logging', 'rate_limit'): LoggingRateLimitConfig,
+    ('network',): NetworkConfig,
+    ('network', 'reconnect'): ReconnectConfig,
+}
+
+
+def _check_types(schema, path=()):
+    fields = _TYPES[path]._fields
+    if set(fields) != set(schema):
+        raise TypeError("fields of {} do not match the schema: {}"
+                        .format(_TYPES[path].__name__, set(fields) ^ set(schema)))
+    for key, spec in schema.items():
+        if isinstance(spec, dict):
+            _check_types(spec, path + (key,))
+
+
+_check_types(SCHEMA)
+_check_types(NETWORK_SCHEMA, ('network',))
+
+
+def _compile(schema, data, path, errors, type_path=None):
+    if not isinstance(data, dict):
+        errors.append("{}: expected a mapping, got {!r}".format(".".join(path), data))
+        data = {}
+
+    for key in data.keys() - schema.keys():
+        l.warn("unknown config key '{}'", ".".join(path + (key,)))
+
+    values = {}
+    for key, spec in schema.items():
+        if isinstance(spec, dict):
+            values[key] = _compile(spec, data.get(key) or {}, path + (key,), errors,
+                                   type_path and type_path + (key,))
+            continue
+        value = data.get(key)
+        if value is None:
+            value = spec.default
+        if value is not None:
+            try:
+                value = spec.convert(value)
+            except ValueError as e:
+                errors.append("{}: {}".format(".".join(path + (key,)), e))
+        values[key] = value
+    return _TYPES[type_path or path](**values)
+
+
+def _compile_networks(irc, errors):
+    networks = {}
+    for name, data in irc.networks.items():
+        path = ('irc', 'networks', str(name))
+        if name == DEFAULT_NETWORK or "/" in str(name):
+            errors.append("{}: invalid network name".format(".".join(path)))
+            continue
+        if not isinstance(data, dict):
+            errors.append("{}: expected a mapping, got {!r}".format(".".join(path), data))
+            continue
+        merged = {key: getattr(irc, key) for key in NETWORK_SCHEMA}
+        merged['reconnect'] = dict(irc.reconnect._asdict(), **(data.get('reconnect') or {}))
+        merged.update((k, v) for k, v in data.items() if k != 'reconnect')
+        networks[str(name)] = _compile(NETWORK_SCHEMA, merged, path, errors, ('network',))
+    return MappingProxyType(networks)
+
+
+def _compile_routes(routes, networks, errors):
+    compiled = {}
+    for chat, targets in routes.items():
+        path = "routes.{}".format(chat)
+        try:
+            chat = integer(chat)
+        except ValueError as e:
+            errors.append("{}: {}".format(path, e))
+            continue
+        if not isinstance(targets, (list, tuple)):
+            targets = [targets]
+        compiled[chat] = []
+        for target in targets:
+            network, _, channel = string(target).rpartition("/")
+            network = network or DEFAULT_NETWORK
+            if network != DEFAULT_NETWORK and network not in networks:
+                errors.append("{}: unknown network {!r}".format(path, network))
+            elif not channel:
+                errors.append("{}: no channel in {!r}".format(path, target))
+            else:
+                compiled[chat].append((network, channel))
+        compiled[chat] = tuple(compiled[chat])
+    return MappingProxyType(compiled)
+
+
+def compile_config(data):
+    """Validate `data` against the schema and return an immutable config object.
+
+    `irc.networks` maps names to connection settings like `irc`'s own.
+    `routes` maps Telegram chat ids (the user id for private chats)
+    to tuples of (network, channel) targets,
+    from strings like "freenode/#channel" or "#channel" (on the `irc` network).
+
+    Raises ConfigError listing all invalid values.
+    """
+    errors = []
+    conf = _compile(SCHEMA, data or {}, (), errors)
+    if not errors:
+        networks = _compile_networks(conf.irc, errors)
+        conf = conf._replace(irc=conf.irc._replace(networks=networks),
+                             routes=_compile_routes(conf.routes, networks, errors))
+    if errors:
+        raise ConfigError("invalid config:\n  " + "\n  ".join(errors))
+    return conf
+
+
+def to_dict(conf):
+    """Nested plain dicts of a compiled config, e.g. for printing or comparing."""
+    if hasattr(conf, '_asdict'):
+        return {k: to_dict(v) for k, v in conf._asdict().items()}
+    if isinstance(conf, MappingProxyType):
+        return {k: to_dict(v) for k, v in conf.items()}
+    if isinstance(conf, tuple):
+        return [to_dict(v) for v in conf]
+    if isinstance(conf, frozenset):
+        return sorted(conf)
+    return conf
+
+
+def diff(old, new, prefix=""):
+    """Dotted keys whose values differ between two compiled configs."""
+    changed = []
+    for key, value in new._asdict().items():
+        old_value = getattr(old, key)
+        if hasattr(value, '_asdict'):
+            changed.extend(diff(old_value, value, prefix + key + "."))
+        elif value != old_value:
+            changed.append(prefix + key)
+    return changed
+
+
+def replace_keys(old, new, keys):
+    """`old` with the values of the dotted `keys` taken from `new`."""
+    def replace(old, new, path):
+        value = getattr(new, path[0])
+        if len(path) > 1:
+            value = replace(getattr(old, path[0]), value, path[1:])
+        return old._replace(**{path[0]: value})
+
+    for key in keys:
+        old = replace(old, new, key.split("."))
+    return old
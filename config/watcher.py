@@ -0,0 +1,82 @@
+import logging
+import os
+from threading import Event, Thread
+
+from . import ConfigError, reload_file, source_files
+
+
+l = logging.getLogger(__name__)
+
+
+class ConfigWatcher(Thread):
+    """Reloads the config when requested (e.g. on SIGHUP) or, with `watch`, when its files change.
+
+    `on_reload(conf, changed)` is called with the new config and the changed live keys;
+    changes that require a restart are only reported.
+    """
+
+    def __init__(self, filename, conf, on_reload, watch=False, interval=5):
+        super().__init__(name="ConfigWatcher", daemon=True)
+        self.filename = filename
+        self.conf = conf
+        self.on_reload = on_reload
+        self.watch = watch
+        self.interval = interval
+
+        self._requested = Event()
+        self._stopped = False
+        self._mtimes = self._stat()
+
+    def request(self):
+        # Only sets a flag, so it may be called from a signal handler
+        self._requested.set()
+
+    def stop(self):
+        self._stopped = True
+        self._requested.set()
+
+    def _stat(self):
+        mtimes = {}
+        for path in source_files(self.filename, self.conf):
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def run(self):
+        l.info("config watcher started; watching files: {}", self.watch)
+        while True:
+            requested = self._requested.wait(self.interval if self.watch else None)
+            if self._stopped:
+                return
+            self._requested.clear()
+            if not requested and self._stat() == self._mtimes:
+                continue
+            try:
+                self.reload()
+            except Exception as e:
+                l.exception("failed to apply reloaded config: {}", e)
+
+    def reload(self):
+        import yaml
+
+        try:
+            conf, live, restart = reload_file(self.filename, self.conf)
+        except (ConfigError, OSError, yaml.YAMLError) as e:
+            l.error("config reload failed, keeping the current config: {}", e)
+            return
+        finally:
+            self._mtimes = self._stat()
+
+        if not live and not restart:
+            l.info("config reloaded without changes")
+            return
+
+        if live:
+            self.conf = conf
+            self.interval = conf.reload.interval
+            self.on_reload(conf, live)
+            l.warn("applied config changes: {}", ", ".join(live))
+        if restart:
+            l.warn("config changes that require a restart: {}", ", ".join(restart))
@@ -1,15 +1,25 @@
-__all__ = ('AuthHandler', 'ImageHandler')
+__all__ = ('AuthHandler', 'ImageHandler', 'MaintenanceJob', 'RetryScheduler')
 
+from collections import Counter
 import logging
-from threading import Thread
+from threading import Lock, Thread, active_count
+
+import metrics
 
 
 l = logging.getLogger(__name__)
 
+LIVE_HANDLERS = metrics.gauge('handlers_live', "Running handler threads", labels=('handler',))
+metrics.gauge('threads', "Live threads in the process").set_function(active_count)
+
 
 class BaseHandler(Thread):
     thread_num = 0
 
+    # Gauge of running handlers per class name
+    _live = Counter()
+    _live_lock = Lock()
+
     def __init__(self, *args, **kwargs):
         kwargs.setdefault(
             'name',
@@ -18,11 +28,26 @@ class BaseHandler(Thread):
         BaseHandler.thread_num += 1
         super().__init__(*args, **kwargs)
 
+    @classmethod
+    def live_handlers(cls):
+        with cls._live_lock:
+            return +cls._live  # drops zero counts
+
     def run(self):
+        name = self.__class__.__name__
+        with self._live_lock:
+            self._live[name] += 1
+        LIVE_HANDLERS.inc(handler=name)
         try:
             self.run_()
         except:
-            l.exception("error in {}", self.__class__.__name__)
+            l.exception("error in {}", name)
+        finally:
+            with self._live_lock:
+                self._live[name] -= 1
+            LIVE_HANDLERS.dec(handler=name)
+            l.debug("{} finished; live handlers: {}; threads: {}",
+                    self.name, dict(self.live_handlers()), active_count())
 
     # @abstractmethod
     def run_(self):
@@ -32,3 +57,5 @@ class BaseHandler(Thread):
 # but it seems like that is not the case.
 from .auth import AuthHandler
 from .image import ImageHandler
+from .maintenance import MaintenanceJob
+from .retry import RetryScheduler
@@ -60,7 +60,7 @@ class AuthHandler(BaseHandler):
 
         # ... and wait until do_authentication gets called, or timeout
         start_time = time.time()
-        while time.time() < start_time + (self.conf.irc.auth_timeout or 300):
+        while time.time() < start_time + self.conf.irc.auth_timeout:
             if self.authenticated:
                 break
             time.sleep(0.5)
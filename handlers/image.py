@@ -2,29 +2,64 @@ from datetime import datetime
 from functools import partial
 import logging
 import os
-from string import Template
-import tempfile
+import time
 
-from imgurpython import ImgurClient
-from imgurpython.helpers.error import ImgurClientError
-from twx import botapi
-
-from models.image import ImageDatabase
+from bots.pool import targets
+import metrics
+from models.image import FileInfo, ImageDatabase
+from models.job import JobDatabase, FAILED, RUNNING
+from models.trace import Trace, TraceDatabase
+from util.deadline import Deadline, StageTimeout, call_with_timeout, wait_request
+from util.download import download, BadStatus, DownloadError
+from util.endpoints import imgur_timeout
+from util.reorder import ReorderBuffer
+from util.singleflight import SingleFlight
 
 from . import BaseHandler
+from .retry import next_attempt_time
 
 
 l = logging.getLogger(__name__)
 
+STAGE_SECONDS = metrics.histogram('image_stage_seconds', "Duration of image job stages",
+                                  labels=('stage',))
+IMAGES = metrics.counter('images_total', "Image jobs by outcome", labels=('result',))
+
+
+class TransferFailed(Exception):
+    """The transfer failed with `error`; its handler told the user already."""
+
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.error = error
+
 
 class ImageHandler(BaseHandler):
-    def __init__(self, conf, irc_bot, tg_bot, user_db, img, *args, **kwargs):
+    # Jobs in progress, keyed by file id or content hash
+    flights = SingleFlight()
+    # IRC posts of a chat in the order the images were sent
+    order = ReorderBuffer()
+
+    def __init__(self, conf, irc_pool, tg_bot, user_db, img, cache=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.conf = conf
-        self.irc_bot = irc_bot
+        self.irc_pool = irc_pool
         self.tg_bot = tg_bot
         self.user_db = user_db
         self.img = img
+        self.cache = cache
+
+        self.stage = None  # the stage currently being worked on
+        self._stage_start = None
+        self.error = None
+        self.deadline = None
+        self.digest = None  # SHA-256 of the downloaded file
+        self.trace = Trace()
+        self._retry = None  # whether this is a retry of a failed job; looked up once
+        self.leading = False  # whether this handler ran the transfer shared with others
+        self.shared_failure = False  # failed in the transfer of another handler
+        self.ordered = bool(conf.irc.order.active
+                            and self.order.add(img.c_id, img.m_id, conf.irc.order.max_pending))
 
     def reply(self, msg):
         self.tg_bot.send_message(
@@ -35,107 +70,342 @@ class ImageHandler(BaseHandler):
             on_success=partial(l.info, "sent message to {0.chat}: {0.text}")
         )
 
+    def reply_error(self, msg):
+        """Tell the user about a failed attempt; retries fail quietly until the last one."""
+        if not self.is_retry():
+            self.reply(msg)
+
     def run_(self):
-        # Check if user may send images at all
+        self.deadline = Deadline(self.conf.timeouts.total)
+        if not self.authorize():
+            self.release_turn()
+            return
+
+        # Must be created in thread because multi-threading is now allowed
+        db = ImageDatabase(self.conf.storage.database) if self.conf.storage.database else None
+
+        try:
+            l.debug("Running ImageHandler with {}", self.img)
+            # Download and upload the file, unless another handler is doing that already
+            self.enter_stage('download')
+            try:
+                result, shared = self.flights.do(self.img.f_id, partial(self.transfer, db))
+            except Exception:
+                self.shared_failure = not self.leading
+                raise
+            if shared:
+                l.info("attached to in-flight job for {}", self.img.f_id)
+                self.attach(result)
+
+            self.wait_turn()
+            self.deliver()
+
+        except Exception as e:
+            self.fail(e)
+
+        finally:
+            self.finish(db)
+            if db:
+                db.close()
+
+    def authorize(self):
+        """Check if the user may send images at all.
+
+        A retry of a refused image ends its job; the user was told on the first attempt.
+        """
         if self.img.c_id in self.user_db.blacklist:
             l.info("discarding image from blacklisted user {}", self.img.c_id)
-            return
+            IMAGES.inc(result='discarded')
+            self.end_retried_job()
+            return False
         if self.img.c_id not in self.user_db.name_map:
-            self.reply("You need to authenticate via /auth before sending pictures")
+            if not self.end_retried_job():
+                self.reply("You need to authenticate via /auth before sending pictures")
             l.info("discarding image from unauthorized user {}", self.img.c_id)
-            return
+            IMAGES.inc(result='discarded')
+            return False
 
         self.img = self.img._replace(username=self.user_db.name_map[self.img.c_id])
+        self.trace.mark('auth')
 
         # Show that we're doing something
+        from twx import botapi
         self.tg_bot.send_chat_action(self.img.c_id, botapi.ChatAction.PHOTO)
+        return True
 
-        # Must be created in thread because multi-threading is now allowed
-        db = ImageDatabase(self.conf.storage.database) if self.conf.storage.database else None
+    def is_retry(self):
+        """Whether the image's job was started by the retry scheduler."""
+        if self._retry is None:
+            self._retry = False
+            if self.conf.storage.database:
+                with JobDatabase(self.conf.storage.database) as jobs:
+                    job = jobs.find_job(self.img.f_id)
+                self._retry = bool(job and job.state == RUNNING)
+        return self._retry
 
-        try:
-            l.debug("Running ImageHandler with {}", self.img)
-            # Check if we recieved the file already and see how far we got
-            if db:
-                db_img = db.find_image(self.img)
-                if db_img:
-                    self.img = db_img
-
-            # Download file if necessary
-            if not self.img.local_path or not os.path.exists(self.img.local_path):
-                if not self.download_file():
-                    return
+    def end_retried_job(self):
+        """Mark the image's job as failed if this is a retry; returns whether it was."""
+        if not self.is_retry():
+            return False
+        with JobDatabase(self.conf.storage.database) as jobs:
+            jobs.set_state(self.img.f_id, FAILED)
+        l.info("giving up on {}; the user may not send images", self.img.f_id)
+        return True
+
+    def attach(self, img):
+        """Take over the transfer results of another job for the same file."""
+        self.img = self.img._replace(remote_path=img.remote_path,
+                                     local_path=img.local_path,
+                                     url=img.url)
+
+    def wait_turn(self):
+        """Wait until the earlier images of the chat are posted, within `irc.order.timeout`."""
+        if self.ordered:
+            self.enter_stage('order')
+            if not self.order.wait(self.img.c_id, self.img.m_id, self.conf.irc.order.timeout):
+                l.warn("posting {} out of order; earlier images of chat {} are still pending",
+                       self.img.m_id, self.img.c_id)
+
+    def release_turn(self):
+        if self.ordered:
+            self.order.remove(self.img.c_id, self.img.m_id)
+            self.ordered = False
+
+    def deliver(self):
+        # Post to IRC
+        self.enter_stage('irc')
+        self.post_to_irc()
+        self.release_turn()
+        self.trace.mark('irc')
+
+        # Report success
+        self.enter_stage('reply')
+        self.reply("Image delivered. Uploaded to: " + self.img.url)
+        self.trace.mark('reply')
+        self.img = self.img._replace(finished=True)
+
+        # Cleanup (a handler sharing the transfer may have done so already)
+        if self.conf.storage.delete_images:
+            if self.img.local_path and os.path.exists(self.img.local_path):
+                os.remove(self.img.local_path)
+            self.img = self.img._replace(local_path=None)
+
+    def fail(self, error):
+        if isinstance(error, TransferFailed):
+            self.error = error.error
+            if self.shared_failure:
+                self.reply_error("Error getting the image: {}".format(error.error))
+            return
+
+        self.error = error
+        if isinstance(error, StageTimeout):
+            self.reply_error("Sorry, this is taking too long ({}). "
+                             "Contact {} if this keeps happening."
+                             .format(error, self.conf.telegram.username_for_help))
+            l.warn("ImageHandler timed out: {}", error)
+        else:
+            self.reply_error("Oops, there was an error. Contact {} and run in circles.\n"
+                             "Error: {}"
+                             .format(self.conf.telegram.username_for_help, error))
+            l.error("Uncaught exception in ImageHandler: {}", error,
+                    exc_info=(type(error), error, error.__traceback__))
+
+    def finish(self, db):
+        """Record the outcome; `db` is the job's image database, if any."""
+        self.release_turn()  # if the image is not posted
+        self.finish_stage()
+        IMAGES.inc(result='finished' if self.img.finished
+                   else 'timeout' if isinstance(self.error, StageTimeout)
+                   else 'failed')
+
+        if db:
+            # A failed transfer is recorded by the handler that ran it
+            if not self.shared_failure:
+                self.save(db)
+                self.update_job()
+            with TraceDatabase(self.conf.storage.database) as traces:
+                traces.insert_trace(self.img.f_id, self.trace)
+
+        # Let the cache account for the file; only finished images may be evicted
+        if self.cache and self.img.local_path and os.path.exists(self.img.local_path):
+            if self.img.finished:
+                self.cache.finish(self.img.local_path)
             else:
-                l.warn("File exists already, skipping download: {}", self.img.local_path)
+                self.cache.add(self.img.local_path)
 
-            # Upload file if necessary
-            if not self.img.url:
-                self.upload_file()
+    def enter_stage(self, stage):
+        if stage == self.stage:
+            return
+        self.finish_stage()
+        self.stage = stage
+        self._stage_start = time.monotonic()
+
+    def finish_stage(self):
+        if self._stage_start is not None:
+            STAGE_SECONDS.observe(time.monotonic() - self._stage_start, stage=self.stage)
+            self._stage_start = None
+
+    def transfer(self, db):
+        self.leading = True
+        self.load_progress(db)
+
+        # Download file if necessary
+        self.enter_stage('download')
+        if not self.is_cached():
+            if not self.download_file():
+                raise TransferFailed(self.error)
+            self.trace.mark('download')
+            if self.tg_bot.recorder:
+                self.tg_bot.recorder.record_file(self.img.f_id, self.img.local_path)
+        else:
+            l.warn("File exists already, skipping download: {}", self.img.local_path)
+
+        # Upload file if necessary; identical content is only uploaded once at a time
+        self.enter_stage('upload')
+        if not self.img.url:
+            if self.digest:
+                url, shared = self.flights.do("sha256:" + self.digest, self.upload_file)
+                if shared:
+                    l.info("reusing concurrent upload of identical file: {}", url)
+                    self.img = self.img._replace(url=url)
             else:
-                l.warn("File already uploaded: {}", self.img.url)
+                self.upload_file()
+            self.trace.mark('upload')
+        else:
+            l.warn("File already uploaded: {}", self.img.url)
 
-            # Post to IRC
-            self.post_to_irc()
+        # Persist progress before handlers waiting for this transfer continue
+        if db:
+            self.save(db)
+        return self.img
 
-            # Report success
-            self.reply("Image delivered. Uploaded to: " + self.img.url)
-            self.img = self.img._replace(finished=True)
+    def load_progress(self, db):
+        # Check if we recieved the file already and see how far we got
+        if db:
+            db_img = db.find_image(self.img)
+            if db_img:
+                self.attach(db_img)
 
-            # Cleanup
-            if self.conf.storage.delete_images:
-                os.remove(self.img.local_path)
-                self.img = self.img._replace(local_path=None)
+    def save(self, db):
+        stored = db.find_image(self.img)
+        if not stored:
+            db.insert_image(self.img)
+        elif stored != self.img:
+            db.update_image(self.img)
 
-        except Exception as e:
-            self.reply("Oops, there was an error. Contact {} and run in circles.\n"
-                       "Error: {}"
-                       .format(self.conf.telegram.username_for_help, e))
-            l.exception("Uncaught exception in ImageHandler: {}", e)
+    def update_job(self):
+        if not self.stage:
+            return  # never started working on the image
 
-        finally:
-            if db:
-                if not db_img:
-                    db.insert_image(self.img)
-                elif self.img != db_img:
-                    db.update_image(self.img)
-                db.close()
+        with JobDatabase(self.conf.storage.database) as jobs:
+            if self.img.finished:
+                jobs.record_success(self.img.f_id)
+                return
 
-    def download_file(self):
-        # Get file info
-        file_info = self.tg_bot.get_file(self.img.f_id).wait()
+            job = jobs.record_failure(self.img.f_id, self.stage, self.error,
+                                      backoff=partial(next_attempt_time, self.conf),
+                                      max_attempts=self.conf.retry.max_attempts)
+        if job.state == FAILED:
+            l.error("giving up on {} after {} attempts", job.f_id, job.attempts)
+            if job.attempts > 1:  # the first attempt told the user already
+                self.reply("Giving up on this image after {} attempts. Contact {} if this "
+                           "keeps happening.\nLast error: {}"
+                           .format(job.attempts, self.conf.telegram.username_for_help, self.error))
+        else:
+            l.info("scheduled retry #{} of {} in {:.0f}s", job.attempts, job.f_id,
+                   job.next_attempt - time.time())
+
+    def is_cached(self):
+        if self.cache:
+            return self.cache.lookup(self.img.local_path)
+        return self.img.local_path and os.path.exists(self.img.local_path)
+
+    def get_file_info(self, refresh=False):
+        """Look up the file's download path; returns `(FileInfo or None, from_cache)`."""
+        from twx import botapi
+
+        cache = self.tg_bot.file_infos
+        if cache and not refresh:
+            info = cache.get(self.img.f_id)
+            if info:
+                l.info("cached file info: {}", info)
+                self.trace.mark('file_info')
+                return info, True
+
+        req = botapi.get_file(self.img.f_id, **self.tg_bot.request_args)
+        req.thread.daemon = True  # don't let a stalled request keep us alive
+        file_info = wait_request(req.run(), 'file_info',
+                                 self.deadline.timeout('file_info', self.conf.timeouts.file_info))
         if isinstance(file_info, botapi.Error):
+            self.error = file_info
             msg = "Error getting file info: {}".format(file_info)
             l.error(msg)
-            self.reply(msg)
-            return False
+            self.reply_error(msg)
+            return None, False
 
         l.info("file info: {}", file_info)
+        self.trace.mark('file_info')
+        if cache:
+            info = cache.put(self.img.f_id, file_info.file_path, file_info.file_size)
+        else:
+            info = FileInfo(file_info.file_path, file_info.file_size, time.time())
+        return info, False
 
-        # Build file path
-        directory = (Template(self.conf.storage.directory or "$temp/telegram")
-                     .substitute(temp=tempfile.gettempdir()))
-        directory = os.path.abspath(directory)
-        basename = file_info.file_path.replace("/", "_")
-        out_file = os.path.join(directory, basename)
-        self.img = self.img._replace(remote_path=file_info.file_path, local_path=out_file)
+    def download_file(self):
+        info, cached = self.get_file_info()
+        if not info:
+            return False
 
-        # Do download
-        os.makedirs(directory, exist_ok=True)
-        result = self.tg_bot.download_file(self.img.remote_path,
-                                           out_file=self.img.local_path).wait()
-        if isinstance(result, Exception):
-            msg = "Error downloading file: {}".format(result)
+        try:
+            try:
+                self.fetch_file(info)
+            except BadStatus as e:
+                if not cached:
+                    raise
+                # Telegram invalidated the path before our TTL expired; ask again once
+                l.warn("cached file path {} failed ({}); refreshing", info.file_path, e)
+                self.tg_bot.file_infos.invalidate(self.img.f_id)
+                info, cached = self.get_file_info(refresh=True)
+                if not info:
+                    return False
+                self.fetch_file(info)
+        except DownloadError as e:
+            self.error = e
+            msg = "Error downloading file: {}".format(e)
             l.error(msg)
-            self.reply(msg)
+            self.reply_error(msg)
             return False
         else:
             l.info("Downloaded file to: {}", self.img.local_path)
             return True
 
-    def upload_file(self):
-        timestamp = datetime.fromtimestamp(self.img.time).strftime(
-            self.conf.imgur.timestamp_format or "%Y-%m-%dT%H:%M:%S"
+    def fetch_file(self, info):
+        from twx import botapi
+
+        # Build file path
+        directory = self.conf.storage.directory
+        basename = info.file_path.replace("/", "_")
+        out_file = os.path.join(directory, basename)
+        self.img = self.img._replace(remote_path=info.file_path, local_path=out_file)
+
+        # Do download (through a part-file, so local_path never points to a truncated file)
+        os.makedirs(directory, exist_ok=True)
+        url = "{}{}/{}".format(botapi.TelegramDownloadRequest.download_url_base,
+                               self.tg_bot.token, self.img.remote_path)
+        self.digest = download(
+            url, self.img.local_path,
+            expected_size=info.file_size,
+            retries=self.conf.telegram.download_retries,
+            timeout=self.conf.telegram.timeout,
+            deadline=self.deadline.timeout('download', self.conf.timeouts.download)
         )
+
+    def upload_file(self):
+        # Imported on first use; imgurpython pulls in requests
+        from imgurpython import ImgurClient
+        from imgurpython.helpers.error import ImgurClientError
+
+        timestamp = datetime.fromtimestamp(self.img.time).strftime(self.conf.imgur.timestamp_format)
         config = dict(
             album=self.conf.imgur.album,
             name="{}_{}".format(timestamp, self.img.username).replace(":", "-"),
@@ -143,24 +413,35 @@ class ImageHandler(BaseHandler):
                                           self.img.username, timestamp)
         )
 
+        timeout = self.deadline.timeout('upload', self.conf.timeouts.upload)
+
+        def upload():
+            # A socket timeout ends stalled requests, also after the call was abandoned
+            with imgur_timeout(timeout):
+                client = ImgurClient(self.conf.imgur.client_id, self.conf.imgur.client_secret,
+                                     refresh_token=self.conf.imgur.refresh_token)
+                data = client.upload_from_path(self.img.local_path, config=config, anon=False)
+            return client, data
+
         try:
-            client = ImgurClient(self.conf.imgur.client_id, self.conf.imgur.client_secret,
-                                 refresh_token=self.conf.imgur.refresh_token)
-            data = client.upload_from_path(self.img.local_path, config=config, anon=False)
+            client, data = call_with_timeout(upload, 'upload', timeout,
+                                             name=self.name + "-upload")
         except ImgurClientError as e:
             msg = "Error uploading to imgur: {0.status_code} {0.error_message}".format(e)
             l.error(msg)
-            self.reply(msg)
+            self.reply_error(msg)
             raise
 
         l.info("uploaded image: {}", data)
         l.debug("X-RateLimit-ClientRemaining: {}", client.credits['ClientRemaining'])
 
         self.img = self.img._replace(url=data['link'])
-        return True
+        return self.img.url
 
     def post_to_irc(self):
         pre_msg = ("<{{0.username}}> {{0.url}}{}"
                    .format(" {0.caption}" if self.img.caption else ""))
         msg = pre_msg.format(self.img)
-        self.irc_bot.msg(self.conf.irc.channel, msg)
+        # Only queued here; every network sends from its own queue
+        for network, channel in targets(self.conf, self.img.c_id):
+            self.irc_pool.msg(network, channel, msg)
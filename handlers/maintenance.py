@@ -0,0 +1,80 @@
+import logging
+from threading import Event
+import time
+
+import metrics
+from models.fileinfo import FileInfoDatabase
+from models.image import ImageDatabase
+from models.trace import TraceDatabase
+
+from . import BaseHandler
+
+
+l = logging.getLogger(__name__)
+
+ARCHIVED = metrics.counter('db_archived_images_total', "Images moved to images_archive")
+RECLAIMED = metrics.counter('db_reclaimed_bytes_total', "Bytes returned to the file system")
+DELETED_TRACES = metrics.counter('db_deleted_traces_total', "Expired job trace marks deleted")
+DELETED_FILE_INFO = metrics.counter('db_deleted_file_info_total',
+                                    "Expired Telegram download paths deleted")
+
+
+class MaintenanceJob(BaseHandler):
+    """Periodically archive old images, delete old traces and download paths
+    and compact the image database (`maintenance`)."""
+
+    def __init__(self, conf, *args, **kwargs):
+        kwargs.setdefault('daemon', True)
+        super().__init__(*args, **kwargs)
+        self.conf = conf
+        self._stop_event = Event()
+        self._warned = False
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run_(self):
+        l.info("database maintenance started with interval {}",
+               self.conf.maintenance.interval)
+        while not self._stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                l.exception("database maintenance failed: {}", e)
+            # Re-read the interval every time, the config may have been reloaded
+            self._stop_event.wait(self.conf.maintenance.interval)
+
+    def run_once(self):
+        settings = self.conf.maintenance
+        start = time.monotonic()
+        traces = 0
+        if settings.traces_after:
+            with TraceDatabase(self.conf.storage.database) as db:
+                traces = db.delete_before(time.time() - settings.traces_after)
+        # Regardless of `persist`, which may have been on before; a TTL of 0 deletes all
+        with FileInfoDatabase(self.conf.storage.database) as db:
+            file_infos = db.prune_file_info(time.time() - self.conf.telegram.file_info.ttl)
+        with ImageDatabase(self.conf.storage.database) as db:
+            archived = 0
+            if settings.archive_after:
+                archived = db.archive(time.time() - settings.archive_after,
+                                      batch=settings.batch)
+            reclaimed = db.compact(settings.vacuum_pages)
+            used, free = db.database_size()
+
+        if reclaimed is None:
+            if not self._warned:
+                l.warn("incremental vacuum is not enabled; "
+                       "run compact_database.py while the bot is stopped to enable it")
+                self._warned = True
+            reclaimed = 0
+        ARCHIVED.inc(archived)
+        DELETED_TRACES.inc(traces)
+        DELETED_FILE_INFO.inc(file_infos)
+        RECLAIMED.inc(reclaimed)
+        l.info("database maintenance: archived {} images, deleted {} trace marks "
+               "and {} download paths, reclaimed {:.1f} MB in {:.1f} s; "
+               "{:.1f} MB in use, {:.1f} MB free",
+               archived, traces, file_infos, reclaimed / 1e6, time.monotonic() - start,
+               used / 1e6, free / 1e6)
+        return archived, reclaimed
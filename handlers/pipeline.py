@@ -0,0 +1,234 @@
+"""Image jobs as coroutines on one event loop (`pipeline.asyncio`).
+
+A job waits for its stages instead of occupying a thread of its own:
+blocking calls (database, Telegram and Imgur requests) run in a small thread pool,
+and a semaphore per stage bounds how many jobs are in that stage at a time.
+The stages and their outcome are the same as with `ImageHandler` threads.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+import logging
+from threading import Thread
+import time
+
+from models.image import ImageDatabase
+from util.deadline import Deadline
+
+from .image import ImageHandler, TransferFailed
+
+
+l = logging.getLogger(__name__)
+
+# Stages that call blocking code and are limited by `pipeline.limits`
+STAGES = ('db', 'download', 'upload')
+
+
+class PipelineJob(object):
+    """Handle of a job on the pipeline; can be joined like a handler thread."""
+
+    def __init__(self, future):
+        self.future = future
+
+    def join(self, timeout=None):
+        wait([self.future], timeout)
+
+    def is_alive(self):
+        return not self.future.done()
+
+
+class AsyncSingleFlight(object):
+    """`util.singleflight.SingleFlight` for coroutines on one event loop."""
+
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, func):
+        """Return a tuple of the result of awaiting `func()` and whether it was shared."""
+        call = self._calls.get(key)
+        if call is not None:
+            l.debug("waiting for in-flight call: {}", key)
+            return await asyncio.shield(call), True
+
+        call = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await func()
+        except BaseException as e:
+            call.set_exception(e)
+            call.exception()  # retrieved, even if nobody else waits
+            raise
+        else:
+            call.set_result(value)
+        finally:
+            del self._calls[key]
+        return value, False
+
+
+class AsyncImageHandler(ImageHandler):
+    """`ImageHandler` driven by `ImagePipeline.run_job` instead of a thread of its own."""
+
+    # Jobs in progress, keyed by file id or content hash
+    async_flights = AsyncSingleFlight()
+
+    def __init__(self, pipeline, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pipeline = pipeline
+
+    def start(self):
+        raise RuntimeError("AsyncImageHandler is run by ImagePipeline")
+
+    def with_db(self, func):
+        # Connections are used by the thread that opened them only
+        if not self.conf.storage.database:
+            return func(None)
+        with ImageDatabase(self.conf.storage.database) as db:
+            return func(db)
+
+    async def run_async(self):
+        self.deadline = Deadline(self.conf.timeouts.total)
+        if not await self.pipeline.stage('db', self.authorize):
+            self.release_turn()
+            return
+
+        try:
+            l.debug("Running AsyncImageHandler with {}", self.img)
+            self.enter_stage('download')
+            try:
+                result, shared = await self.async_flights.do(self.img.f_id, self.transfer_async)
+            except Exception:
+                self.shared_failure = not self.leading
+                raise
+            if shared:
+                l.info("attached to in-flight job for {}", self.img.f_id)
+                self.attach(result)
+
+            await self.wait_turn_async()
+            self.deliver()
+
+        except Exception as e:
+            # Looks up whether this is a retry
+            await self.pipeline.stage('db', self.fail, e)
+
+        finally:
+            await self.pipeline.stage('db', self.with_db, self.finish)
+
+    async def wait_turn_async(self):
+        if not self.ordered:
+            return
+        self.enter_stage('order')
+        timeout = self.conf.irc.order.timeout
+        end = time.monotonic() + timeout if timeout else None
+        while not self.order.is_turn(self.img.c_id, self.img.m_id):
+            if end and time.monotonic() > end:
+                l.warn("posting {} out of order; earlier images of chat {} are still pending",
+                       self.img.m_id, self.img.c_id)
+                return
+            await asyncio.sleep(0.05)
+
+    async def transfer_async(self):
+        self.leading = True
+        await self.pipeline.stage('db', self.with_db, self.load_progress)
+
+        self.enter_stage('download')
+        if not self.is_cached():
+            if not await self.pipeline.stage('download', self.download_file):
+                raise TransferFailed(self.error)
+            self.trace.mark('download')
+            if self.tg_bot.recorder:
+                self.tg_bot.recorder.record_file(self.img.f_id, self.img.local_path)
+        else:
+            l.warn("File exists already, skipping download: {}", self.img.local_path)
+
+        self.enter_stage('upload')
+        if not self.img.url:
+            if self.digest:
+                url, shared = await self.async_flights.do(
+                    "sha256:" + self.digest,
+                    partial(self.pipeline.stage, 'upload', self.upload_file))
+                if shared:
+                    l.info("reusing concurrent upload of identical file: {}", url)
+                    self.img = self.img._replace(url=url)
+            else:
+                await self.pipeline.stage('upload', self.upload_file)
+            self.trace.mark('upload')
+        else:
+            l.warn("File already uploaded: {}", self.img.url)
+
+        # Persist progress before jobs waiting for this transfer continue
+        await self.pipeline.stage('db', self.with_db, self.save_if)
+        return self.img
+
+    def save_if(self, db):
+        if db:
+            self.save(db)
+
+
+class ImagePipeline(object):
+    def __init__(self, conf, irc_pool, tg_bot, user_db, cache=None):
+        self.conf = conf
+        self.irc_pool = irc_pool
+        self.tg_bot = tg_bot
+        self.user_db = user_db
+        self.cache = cache
+
+        self.loop = asyncio.new_event_loop()
+        self.threads = conf.pipeline.threads
+        self.executor = ThreadPoolExecutor(max_workers=self.threads,
+                                           thread_name_prefix="PipelineCall")
+        self.sizes = {stage: getattr(conf.pipeline.limits, stage) for stage in STAGES}
+        self.limits = {stage: asyncio.Semaphore(size) for stage, size in self.sizes.items()}
+        self._pending = set()
+        self._thread = Thread(target=self.loop.run_forever, name="ImagePipeline", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        l.info("image pipeline started with {} threads; stage limits: {}",
+               self.threads, self.sizes)
+
+    def submit(self, img):
+        handler = AsyncImageHandler(
+            self,
+            conf=self.conf,
+            irc_pool=self.irc_pool,
+            tg_bot=self.tg_bot,
+            user_db=self.user_db,
+            img=img,
+            cache=self.cache
+        )
+        self._pending.add(handler)  # counted before the loop picks it up
+        future = asyncio.run_coroutine_threadsafe(self.run_job(handler), self.loop)
+        return PipelineJob(future)
+
+    def pending(self):
+        return len(self._pending)
+
+    async def run_job(self, handler):
+        try:
+            await handler.run_async()
+        except Exception:
+            l.exception("error in {}", handler.name)
+        finally:
+            self._pending.discard(handler)
+
+    async def stage(self, name, func, *args):
+        """Run the blocking `func(*args)` in the thread pool, within the limit of stage `name`."""
+        async with self.limits[name]:
+            return await self.loop.run_in_executor(self.executor, func, *args)
+
+    def stop(self, timeout=30):
+        """Let running jobs finish and stop the event loop."""
+        async def drain():
+            while self._pending:
+                await asyncio.sleep(0.1)
+
+        try:
+            asyncio.run_coroutine_threadsafe(drain(), self.loop).result(timeout)
+        except Exception:
+            l.warn("{} pipeline jobs still running at shutdown", len(self._pending))
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,61 @@
+import logging
+import random
+from threading import Event
+import time
+
+from models.image import ImageDatabase
+from models.job import JobDatabase, DONE, FAILED, RUNNING
+
+from . import BaseHandler
+
+
+l = logging.getLogger(__name__)
+
+
+def next_attempt_time(conf, attempts):
+    """Jittered exponential backoff, starting at `retry.base_delay` seconds."""
+    delay = min(conf.retry.base_delay * 2 ** (attempts - 1),
+                conf.retry.max_delay)
+    return time.time() + delay * random.uniform(0.5, 1.5)
+
+
+class RetryScheduler(BaseHandler):
+    def __init__(self, conf, on_image, *args, **kwargs):
+        kwargs.setdefault('daemon', True)
+        super().__init__(*args, **kwargs)
+        self.conf = conf
+        self.on_image = on_image
+        self._stop_event = Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run_(self):
+        with JobDatabase(self.conf.storage.database) as jobs:
+            reset = jobs.reset_running()
+        if reset:
+            l.info("rescheduled {} interrupted jobs", reset)
+
+        l.info("retry scheduler started with interval {}", self.conf.retry.interval)
+        # Re-read the interval every time, the config may have been reloaded
+        while not self._stop_event.wait(self.conf.retry.interval):
+            try:
+                self.dispatch_due_jobs()
+            except Exception as e:
+                l.exception("failed to dispatch due jobs: {}", e)
+
+    def dispatch_due_jobs(self):
+        with JobDatabase(self.conf.storage.database) as jobs, \
+                ImageDatabase(self.conf.storage.database) as images:
+            for job in jobs.get_due_jobs(time.time()):
+                img = images.find_image(job)
+                if not img:
+                    l.warn("no image for job {}, giving up", job.f_id)
+                    jobs.set_state(job.f_id, FAILED)
+                elif img.finished:
+                    jobs.set_state(job.f_id, DONE)
+                else:
+                    l.info("retrying {} (attempt {}, failed in stage {}: {})",
+                           job.f_id, job.attempts + 1, job.stage, job.last_error)
+                    jobs.set_state(job.f_id, RUNNING)
+                    self.on_image(img)
@@ -0,0 +1,310 @@
+"""Image jobs in worker processes (`workers.processes`).
+
+The main process keeps polling Telegram and owns the IRC connections and the image cache.
+Jobs are sharded by chat id across the workers,
+so the images of one chat are handled by the same process.
+Workers run the usual `ImageHandler`s
+and send IRC posts, cache updates, log records and completions back through a pipe each,
+so a worker that dies while sending does not block the others.
+"""
+
+import itertools
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import signal
+from threading import Event, Lock, Thread
+import time
+
+from util.log import NewStyleLogRecord, ProcessQueueHandler
+
+from . import BaseHandler
+from .image import ImageHandler
+
+
+l = logging.getLogger(__name__)
+
+
+class WorkerJob(object):
+    """Handle of a job submitted to a worker; can be joined like a handler thread."""
+
+    def __init__(self, img):
+        self.img = img
+        self.worker = None  # index of the worker the job is queued for
+        self.attempts = 0
+        self._done = Event()
+
+    def join(self, timeout=None):
+        self._done.wait(timeout)
+
+    def is_alive(self):
+        return not self._done.is_set()
+
+
+class WorkerPool(object):
+    # Seconds between checks whether the workers are alive
+    CHECK_INTERVAL = 1
+
+    def __init__(self, conf, irc_pool, user_db, cache=None):
+        self.conf = conf
+        self.irc_pool = irc_pool
+        self.user_db = user_db
+        self.cache = cache
+
+        # Workers import everything themselves instead of inheriting the threads and locks
+        self._context = multiprocessing.get_context('spawn')
+        self._level = logging.getLogger('handlers').getEffectiveLevel()
+        self._queues = [self._context.Queue() for _ in range(conf.workers.processes)]
+        self._processes = [None] * conf.workers.processes
+        self._results = []  # receiving ends of the workers' pipes, until they are drained
+
+        self._jobs = {}  # id -> WorkerJob
+        self._ids = itertools.count()
+        self._lock = Lock()
+        self._stopping = False
+        self._collector = Thread(target=self._collect, name="WorkerResults", daemon=True)
+
+    def _start_process(self, i):
+        results, sender = self._context.Pipe(duplex=False)
+        self._processes[i] = self._context.Process(
+            target=_worker_main, name="ImageWorker-{}".format(i),
+            args=(self.conf, self._queues[i], sender, self._level, self.cache is not None),
+            daemon=True
+        )
+        self._processes[i].start()
+        sender.close()  # the pipe reaches its end when the worker exits
+        self._results.append(results)
+
+    def start(self):
+        with self._lock:
+            for i in range(len(self._processes)):
+                self._start_process(i)
+        self._collector.start()
+        l.info("started {} image worker processes", len(self._processes))
+
+    def submit(self, img):
+        job = WorkerJob(img)
+        with self._lock:
+            job_id = next(self._ids)
+            self._jobs[job_id] = job
+            self._enqueue(job_id, job)
+        return job
+
+    def _enqueue(self, job_id, job):
+        # User data is only loaded in this process, where /auth changes it
+        img = job.img
+        blacklisted = img.c_id in self.user_db.blacklist
+        name = self.user_db.name_map.get(img.c_id)
+        job.worker = img.c_id % len(self._queues)
+        job.attempts += 1
+        self._queues[job.worker].put(('job', job_id, img, blacklisted, name))
+
+    def pending(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def update_conf(self, conf):
+        self.conf = conf
+        for jobs in self._queues:
+            jobs.put(('conf', conf))
+
+    def stop(self, timeout=30):
+        """Let the workers finish their jobs and exit."""
+        with self._lock:
+            self._stopping = True
+        for jobs in self._queues:
+            jobs.put(('stop',))
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                l.warn("worker {} did not stop in time; terminating", process.name)
+                process.terminate()
+        # The collector stops once every pipe is drained
+        self._collector.join(timeout)
+
+    def _check_workers(self):
+        """Replace workers that died and requeue their jobs once; fail jobs requeued before."""
+        with self._lock:
+            if self._stopping:
+                return
+            for i, process in enumerate(self._processes):
+                if process.is_alive():
+                    continue
+                l.error("worker {} died with exit code {}; starting a new one",
+                        process.name, process.exitcode)
+                # The dead process may have held the queue's lock
+                self._queues[i] = self._context.Queue()
+                self._start_process(i)
+
+                for job_id, job in list(self._jobs.items()):
+                    if job.worker != i:
+                        continue
+                    if job.attempts > 1:
+                        l.error("giving up on {} after its worker died twice", job.img.f_id)
+                        del self._jobs[job_id]
+                        job._done.set()
+                    else:
+                        self._enqueue(job_id, job)
+
+    def _collect(self):
+        checked = time.monotonic()
+        while True:
+            if time.monotonic() - checked >= self.CHECK_INTERVAL:
+                self._check_workers()
+                checked = time.monotonic()
+            with self._lock:
+                pipes = list(self._results)
+                if not pipes and self._stopping:
+                    break
+            if not pipes:
+                time.sleep(self.CHECK_INTERVAL)
+                continue
+            for pipe in wait(pipes, self.CHECK_INTERVAL):
+                try:
+                    result = pipe.recv()
+                except EOFError:
+                    self._drop_pipe(pipe)
+                except Exception as e:
+                    l.warn("dropping the results of a dead worker: {}", e)
+                    self._drop_pipe(pipe)
+                else:
+                    self._handle(result)
+
+    def _drop_pipe(self, pipe):
+        with self._lock:
+            self._results.remove(pipe)
+        pipe.close()
+
+    def _handle(self, result):
+        kind, *args = result
+        try:
+            if kind == 'irc':
+                self.irc_pool.msg(*args)
+            elif kind == 'cache' and self.cache:
+                method, path = args
+                getattr(self.cache, method)(path)
+            elif kind == 'log':
+                record = args[0]
+                logging.getLogger(record.name).handle(record)
+            elif kind == 'done':
+                with self._lock:
+                    job = self._jobs.pop(args[0], None)
+                if job:
+                    job._done.set()
+        except Exception:
+            l.exception("error handling worker result {!r}", result)
+
+
+class _Results(object):
+    """A worker's sending end of its results pipe, shared by the worker's threads."""
+
+    def __init__(self, pipe):
+        self._pipe = pipe
+        self._lock = Lock()
+
+    def put(self, result):
+        with self._lock:
+            self._pipe.send(result)
+
+
+# Stand-ins for the main process' objects, used by ImageHandler in the workers
+
+class _IRCPoolProxy(object):
+    def __init__(self, results):
+        self._results = results
+
+    def msg(self, network, channel, message):
+        self._results.put(('irc', network, channel, message))
+
+
+class _CacheProxy(object):
+    """Reports to the main process' cache index; files are checked directly."""
+
+    def __init__(self, results):
+        self._results = results
+
+    def lookup(self, path):
+        self._results.put(('cache', 'lookup', path))
+        return bool(path) and os.path.exists(path)
+
+    def add(self, path):
+        self._results.put(('cache', 'add', path))
+
+    def finish(self, path):
+        self._results.put(('cache', 'finish', path))
+
+
+class _UserView(object):
+    """The part of the user database concerning one job's sender."""
+
+    def __init__(self, c_id, blacklisted, name):
+        self.blacklist = {c_id} if blacklisted else set()
+        self.name_map = {c_id: name} if name is not None else {}
+
+
+class _WorkerImageHandler(ImageHandler):
+    def __init__(self, job_id, results, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.job_id = job_id
+        self.results = results
+
+    def run_(self):
+        try:
+            super().run_()
+        finally:
+            self.results.put(('done', self.job_id))
+
+
+class _ResultsLogHandler(ProcessQueueHandler):
+    def enqueue(self, record):
+        self.queue.put(('log', record))
+
+
+def _worker_main(conf, jobs, results, level, use_cache):
+    # The main process coordinates shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    results = _Results(results)
+
+    logging.setLogRecordFactory(NewStyleLogRecord)
+    root = logging.getLogger()
+    root.handlers[:] = [_ResultsLogHandler(results)]
+    root.setLevel(level)
+
+    from bots import TelegramImageBot
+    from models.fileinfo import FileInfoCache
+    from util.endpoints import configure_endpoints
+
+    configure_endpoints(conf)
+    tg_bot = TelegramImageBot(conf, None, token=conf.telegram.token)
+    tg_bot.file_infos = FileInfoCache.from_conf(conf)
+    irc_pool = _IRCPoolProxy(results)
+    cache = _CacheProxy(results) if use_cache else None
+    l.info("image worker {} started", os.getpid())
+
+    handlers = []
+    while True:
+        kind, *args = jobs.get()
+        if kind == 'stop':
+            break
+        elif kind == 'conf':
+            conf = tg_bot.conf = args[0]
+            continue
+
+        job_id, img, blacklisted, name = args
+        handler = _WorkerImageHandler(
+            job_id, results,
+            conf=conf,
+            irc_pool=irc_pool,
+            tg_bot=tg_bot,
+            user_db=_UserView(img.c_id, blacklisted, name),
+            img=img,
+            cache=cache
+        )
+        handler.start()
+        handlers = [h for h in handlers if h.is_alive()] + [handler]
+
+    for handler in handlers:
+        handler.join()
+    l.info("image worker {} stopped; live handlers: {}",
+           os.getpid(), dict(BaseHandler.live_handlers()))
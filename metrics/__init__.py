@@ -0,0 +1,234 @@
+"""Minimal metrics registry with Prometheus text exposition.
+
+Instruments are module-level objects created through `counter`, `gauge` and `histogram`.
+Recording is a no-op until the registry is enabled (see `metrics.active` in the config),
+so instrumented code paths cost a single attribute check when metrics are disabled.
+"""
+
+__all__ = ('REGISTRY', 'counter', 'gauge', 'histogram')
+
+from bisect import bisect_left
+from functools import wraps
+import logging
+from threading import Lock
+import time
+
+
+l = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+                          for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry(object):
+    def __init__(self):
+        self.enabled = False
+        self._metrics = {}
+        self._lock = Lock()
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def exposition(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.doc))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            try:
+                lines.extend(metric.samples())
+            except Exception as e:
+                l.exception("unable to collect metric {}: {}", metric.name, e)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, doc, labels=(), registry=REGISTRY):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.registry = registry
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return ["{}{} {}".format(self.name, _format_labels(self.labels, key), _format_value(v))
+                for key, v in items]
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, func, **labels):
+        """Compute the value with `func` at collection time only."""
+        with self._lock:
+            self._functions[self._key(labels)] = func
+
+    def remove_function(self, **labels):
+        with self._lock:
+            self._functions.pop(self._key(labels), None)
+
+    def value(self, **labels):
+        key = self._key(labels)
+        func = self._functions.get(key)
+        return func() if func else self._values.get(key, 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, func in functions.items():
+            values[key] = func()
+        return ["{}{} {}".format(self.name, _format_labels(self.labels, key), _format_value(v))
+                for key, v in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one counter per bucket, +Inf, sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def timed(self, **labels):
+        """Decorator observing the duration of every call."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.registry.enabled:
+                    return func(*args, **kwargs)
+                start = time.monotonic()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.monotonic() - start, **labels)
+            return wrapper
+        return decorator
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, list(counts)) for key, counts in self._values.items())
+        lines = []
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name,
+                    _format_labels(self.labels, key, [('le', _format_value(float(bound)))]),
+                    cumulative
+                ))
+            lines.append("{}_sum{} {}".format(self.name, _format_labels(self.labels, key),
+                                              _format_value(counts[-1])))
+            lines.append("{}_count{} {}".format(self.name, _format_labels(self.labels, key),
+                                                cumulative))
+        return lines
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+        return False
+
+
+def counter(name, doc, labels=(), registry=REGISTRY):
+    return registry.register(Counter(name, doc, labels, registry))
+
+
+def gauge(name, doc, labels=(), registry=REGISTRY):
+    return registry.register(Gauge(name, doc, labels, registry))
+
+
+def histogram(name, doc, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+    return registry.register(Histogram(name, doc, labels, buckets=buckets, registry=registry))
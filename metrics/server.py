@@ -0,0 +1,54 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+from socketserver import ThreadingMixIn
+from threading import Thread
+
+from . import REGISTRY
+
+
+l = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """Serves the registry on `http://host:port/metrics` from a daemon thread."""
+
+    def __init__(self, host="127.0.0.1", port=9120, registry=REGISTRY):
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # noqa
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.exposition().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                l.debug("metrics request from {}: {}", self.address_string(), format % args)
+
+        self._server = _ThreadingHTTPServer((host, port), Handler)
+        self._thread = Thread(target=self._server.serve_forever, name="MetricsServer",
+                              daemon=True)
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+        self.registry.enabled = True
+        self._thread.start()
+        l.info("serving metrics on http://{0[0]}:{0[1]}/metrics", self.address)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,153 @@
+from collections import OrderedDict, namedtuple
+import logging
+import os
+from threading import RLock
+
+from models.image import ImageDatabase
+
+
+l = logging.getLogger(__name__)
+
+CacheEntry = namedtuple('CacheEntry', ['size', 'finished'])
+
+
+class ImageCache(object):
+    """Size-budgeted LRU index over the locally stored image files.
+
+    Entries are keyed by local path and mirror the `local_path` column of the image database.
+    Only entries of finished images are ever evicted;
+    evicting an entry removes the file and clears `local_path` in the database.
+    """
+
+    def __init__(self, max_bytes=None, max_files=None, dbpath=None):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.dbpath = dbpath
+
+        self._entries = OrderedDict()  # least recently used first
+        self._total_bytes = 0
+        self._lock = RLock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """Build the index from the database and clear rows whose file vanished."""
+        if not self.dbpath:
+            return
+
+        cached = []
+        with ImageDatabase(self.dbpath) as db:
+            for img in db.get_cached_images():
+                try:
+                    cached.append((os.path.getmtime(img.local_path), img))
+                except OSError:
+                    l.info("cached file vanished, clearing: {}", img.local_path)
+                    db.clear_local_path(img.local_path)
+
+        # Approximate the previous LRU order by modification time
+        with self._lock:
+            for _, img in sorted(cached, key=lambda c: c[0]):
+                self._add(img.local_path, img.finished)
+
+        l.info("loaded image cache with {} files, {} bytes", len(self._entries), self._total_bytes)
+        self.evict()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        with self._lock:
+            return dict(files=len(self._entries), bytes=self._total_bytes,
+                        hits=self.hits, misses=self.misses, hit_rate=self.hit_rate)
+
+    def lookup(self, path):
+        """Return whether `path` is cached and count the access as a hit or miss."""
+        with self._lock:
+            if path and path in self._entries and os.path.exists(path):
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return True
+
+            if path in self._entries:
+                self._remove(path)
+            self.misses += 1
+            return False
+
+    def add(self, path, finished=False):
+        with self._lock:
+            self._add(path, finished)
+        if finished:
+            self.evict()
+
+    def finish(self, path):
+        """Mark the image at `path` as finished, making it eligible for eviction."""
+        with self._lock:
+            if path not in self._entries:
+                self._add(path, True)
+            else:
+                self._entries[path] = self._entries[path]._replace(finished=True)
+                self._entries.move_to_end(path)
+        self.evict()
+
+    def resize(self, max_bytes=None, max_files=None):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self.max_files = max_files
+        self.evict()
+
+    def discard(self, path):
+        with self._lock:
+            if path in self._entries:
+                self._remove(path)
+
+    def evict(self):
+        evicted = []
+        with self._lock:
+            for path, entry in list(self._entries.items()):
+                if not self._over_budget():
+                    break
+                if not entry.finished:
+                    continue
+                self._remove(path)
+                evicted.append(path)
+
+            if self._over_budget():
+                l.warn("image cache over budget with only unfinished images left: "
+                       "{} files, {} bytes", len(self._entries), self._total_bytes)
+
+        if not evicted:
+            return
+
+        for path in evicted:
+            try:
+                os.remove(path)
+            except OSError as e:
+                l.warn("unable to remove evicted file {}: {}", path, e)
+
+        if self.dbpath:
+            with ImageDatabase(self.dbpath) as db:
+                for path in evicted:
+                    db.clear_local_path(path)
+
+        l.info("evicted {} files from image cache; hit rate: {:.1%}", len(evicted), self.hit_rate)
+
+    def _over_budget(self):
+        return ((self.max_files is not None and len(self._entries) > self.max_files)
+                or (self.max_bytes is not None and self._total_bytes > self.max_bytes))
+
+    def _add(self, path, finished):
+        if path in self._entries:
+            self._remove(path)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        self._entries[path] = CacheEntry(size=size, finished=bool(finished))
+        self._total_bytes += size
+
+    def _remove(self, path):
+        entry = self._entries.pop(path)
+        self._total_bytes -= entry.size
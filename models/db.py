@@ -0,0 +1,22 @@
+import sqlite3
+
+import metrics
+
+
+# Seconds a connection waits for another connection's write lock
+BUSY_TIMEOUT = 30
+
+DB_SECONDS = metrics.histogram('db_call_seconds', "Duration of database calls",
+                               labels=('db', 'call'))
+
+
+def connect(dbpath):
+    """Open `dbpath` in WAL mode.
+
+    Readers do not block the writer and vice versa,
+    so several threads and processes can share the database.
+    """
+    db = sqlite3.connect(dbpath, timeout=BUSY_TIMEOUT)
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")
+    return db
@@ -0,0 +1,159 @@
+from collections import OrderedDict
+import logging
+from threading import Lock
+import time
+
+import metrics
+from models.db import DB_SECONDS, connect
+from models.image import FileInfo
+
+
+l = logging.getLogger(__name__)
+
+LOOKUPS = metrics.counter('telegram_file_info_cache_total', "getFile cache lookups by result",
+                          labels=('result',))
+
+
+class FileInfoCache(object):
+    """TTL and LRU bounded cache of Telegram getFile results (`FileInfo`s by file id).
+
+    Telegram keeps a download path valid for about an hour,
+    so retries, backlog replays and forwarded duplicates can reuse it.
+    With `dbpath`, entries are also stored in the image database and survive restarts.
+    """
+
+    def __init__(self, ttl=3000, max_entries=1000, dbpath=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.dbpath = dbpath
+
+        self._entries = OrderedDict()  # least recently used first
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0  # entries that failed and were fetched again
+
+    def get(self, f_id):
+        """Return a fresh cached `FileInfo` or None; counts the lookup as hit or miss."""
+        min_fetched_at = time.time() - self.ttl
+        with self._lock:
+            info = self._entries.get(f_id)
+            if info and info.fetched_at < min_fetched_at:
+                del self._entries[f_id]
+                info = None
+            if info:
+                self._entries.move_to_end(f_id)
+
+        if not info and self.dbpath:
+            with FileInfoDatabase(self.dbpath) as db:
+                info = db.find_file_info(f_id, min_fetched_at)
+            if info:
+                self._remember(f_id, info)
+
+        with self._lock:
+            if info:
+                self.hits += 1
+            else:
+                self.misses += 1
+        LOOKUPS.inc(result='hit' if info else 'miss')
+        return info
+
+    def put(self, f_id, file_path, file_size):
+        info = FileInfo(file_path, file_size, time.time())
+        self._remember(f_id, info)
+        if self.dbpath:
+            with FileInfoDatabase(self.dbpath) as db:
+                db.save_file_info(f_id, info)
+        return info
+
+    def invalidate(self, f_id):
+        """Forget an entry that turned out to be stale."""
+        with self._lock:
+            self._entries.pop(f_id, None)
+            self.stale += 1
+        LOOKUPS.inc(result='stale')
+        if self.dbpath:
+            with FileInfoDatabase(self.dbpath) as db:
+                db.delete_file_info(f_id)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return dict(entries=len(self._entries), hits=self.hits, misses=self.misses,
+                        stale=self.stale, hit_rate=self.hits / total if total else 0.0)
+
+    @classmethod
+    def from_conf(cls, conf):
+        """Cache configured by `telegram.file_info`, or None if it is disabled."""
+        settings = conf.telegram.file_info
+        if not settings.ttl:
+            return None
+        dbpath = conf.storage.database if settings.persist else None
+        return cls(settings.ttl, settings.max_entries, dbpath)
+
+    def _remember(self, f_id, info):
+        with self._lock:
+            self._entries[f_id] = info
+            self._entries.move_to_end(f_id)
+            while self.max_entries and len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class FileInfoDatabase(object):
+    """Persisted `FileInfoCache` entries, stored next to the `images` table.
+
+    Expired rows are deleted by `prune_file_info`, which the database maintenance calls.
+    """
+
+    def __init__(self, dbpath):
+        self.db = connect(dbpath)
+
+        self.create_table()
+
+    def create_table(self):
+        # Results of Telegram's getFile; download paths expire after about an hour
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS file_info (
+                f_id TEXT PRIMARY KEY,
+                file_path TEXT,
+                file_size INTEGER,
+                fetched_at REAL
+            )"""
+        )
+
+    @DB_SECONDS.timed(db='file_info', call='find_file_info')
+    def find_file_info(self, f_id, min_fetched_at=0):
+        row = self.db.execute(
+            "SELECT file_path, file_size, fetched_at FROM file_info"
+            " WHERE f_id = ? AND fetched_at >= ?",
+            (f_id, min_fetched_at)
+        ).fetchone()
+        return FileInfo(*row) if row else None
+
+    @DB_SECONDS.timed(db='file_info', call='save_file_info')
+    def save_file_info(self, f_id, info):
+        self.db.execute("INSERT OR REPLACE INTO file_info VALUES (?, ?, ?, ?)", (f_id,) + info)
+        self.db.commit()
+
+    @DB_SECONDS.timed(db='file_info', call='delete_file_info')
+    def delete_file_info(self, f_id):
+        self.db.execute("DELETE FROM file_info WHERE f_id = ?", (f_id,))
+        self.db.commit()
+
+    @DB_SECONDS.timed(db='file_info', call='prune_file_info')
+    def prune_file_info(self, fetched_before):
+        """Delete the rows fetched before `fetched_before`; returns their number."""
+        cursor = self.db.execute("DELETE FROM file_info WHERE fetched_at < ?", (fetched_before,))
+        self.db.commit()
+        return cursor.rowcount
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
@@ -1,43 +1,146 @@
 from collections import namedtuple
 import logging
 import sqlite3
+import time
+
+from models.db import DB_SECONDS, connect
 
 
 l = logging.getLogger(__name__)
 
+
 ImageInfo = namedtuple(
     'ImageInfo',
     ['f_id', 'time', 'username', 'c_id', 'm_id', 'caption', 'ext',
      'remote_path', 'local_path', 'url', 'finished']
 )
 
+FileInfo = namedtuple('FileInfo', ['file_path', 'file_size', 'fetched_at'])
+
+# Matches of a search that are ranked; older matches are not considered
+SEARCH_CANDIDATES = 200
+# Age at which an image ranks half as high as an equally relevant new one
+SEARCH_HALF_LIFE = 30 * 86400
+
+# Finished images older than `maintenance.archive_after` are moved to images_archive,
+# which has the same columns; lookups and searches cover both tables.
+IMAGE_TABLES = ('images', 'images_archive')
+
+_fts5 = None  # whether SQLite has FTS5, checked once
+
+
+def fts5_available():
+    global _fts5
+    if _fts5 is None:
+        db = sqlite3.connect(":memory:")
+        try:
+            db.execute("CREATE VIRTUAL TABLE probe USING fts5(text)")
+            _fts5 = True
+        except sqlite3.OperationalError as e:
+            l.warn("full-text search is not available: {}", e)
+            _fts5 = False
+        finally:
+            db.close()
+    return _fts5
+
 
 class ImageDatabase(object):
     def __init__(self, dbpath):
-        self.db = sqlite3.connect(dbpath)
+        self.db = connect(dbpath)
         # self.db.row_factory = sqlite3.Row
 
         self.create_table()
 
     def create_table(self):
-        self.db.execute(
-            """CREATE TABLE IF NOT EXISTS images (
-                f_id TEXT PRIMARY KEY,
-                time INTEGER,
-                username TEXT,
-                c_id INTEGER,
-                m_id INTEGER,
-                caption TEXT,
-                ext TEXT,
-                remote_path TEXT,
-                local_path TEXT,
-                url TEXT,
-                finished INTEGER
-            )"""
-        )
+        for table in IMAGE_TABLES:
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS {} (
+                    f_id TEXT PRIMARY KEY,
+                    time INTEGER,
+                    username TEXT,
+                    c_id INTEGER,
+                    m_id INTEGER,
+                    caption TEXT,
+                    ext TEXT,
+                    remote_path TEXT,
+                    local_path TEXT,
+                    url TEXT,
+                    finished INTEGER
+                )""".format(table)
+            )
+        self.searchable = self.create_search_index()
 
+    def create_search_index(self):
+        """Create the full-text indexes of captions and usernames and fill them from existing rows.
+
+        Returns False if SQLite was built without FTS5.
+        """
+        if not fts5_available():
+            return False
+        return all(self._create_search_index(table) for table in IMAGE_TABLES)
+
+    def _create_search_index(self, table):
+        exists = "SELECT 1 FROM sqlite_master WHERE name = '{}_fts'".format(table)
+        if self.db.execute(exists).fetchone():
+            return True
+
+        self.db.execute("BEGIN IMMEDIATE")  # another connection may be creating it
+        try:
+            if self.db.execute(exists).fetchone():
+                self.db.rollback()
+                return True
+            # External content: the index refers to rows by rowid instead of copying the text
+            self.db.execute(
+                """CREATE VIRTUAL TABLE {0}_fts USING fts5(
+                    caption, username,
+                    content='{0}', content_rowid='rowid',
+                    tokenize='unicode61 remove_diacritics 2'
+                )""".format(table)
+            )
+        except sqlite3.OperationalError as e:
+            self.db.rollback()
+            l.warn("full-text search is not available: {}", e)
+            return False
+
+        for trigger in (
+            """CREATE TRIGGER {0}_fts_insert AFTER INSERT ON {0} BEGIN
+                INSERT INTO {0}_fts (rowid, caption, username)
+                VALUES (new.rowid, new.caption, new.username);
+            END""",
+            """CREATE TRIGGER {0}_fts_delete AFTER DELETE ON {0} BEGIN
+                INSERT INTO {0}_fts ({0}_fts, rowid, caption, username)
+                VALUES ('delete', old.rowid, old.caption, old.username);
+            END""",
+            """CREATE TRIGGER {0}_fts_update AFTER UPDATE OF caption, username ON {0} BEGIN
+                INSERT INTO {0}_fts ({0}_fts, rowid, caption, username)
+                VALUES ('delete', old.rowid, old.caption, old.username);
+                INSERT INTO {0}_fts (rowid, caption, username)
+                VALUES (new.rowid, new.caption, new.username);
+            END""",
+        ):
+            self.db.execute(trigger.format(table))
+        # Backfill rows inserted before the index existed
+        self.db.execute("INSERT INTO {0}_fts ({0}_fts) VALUES ('rebuild')".format(table))
+        self.db.commit()
+        count = self.db.execute("SELECT count(*) FROM {}".format(table)).fetchone()[0]
+        l.info("created full-text index of {} rows in {}", count, table)
+        return True
+
+    @DB_SECONDS.timed(db='images', call='rebuild_search_index')
+    def rebuild_search_index(self):
+        if self.searchable:
+            for table in IMAGE_TABLES:
+                self.db.execute("INSERT INTO {0}_fts ({0}_fts) VALUES ('rebuild')".format(table))
+            self.db.commit()
+
+    @DB_SECONDS.timed(db='images', call='find_image')
     def find_image(self, img):
-        cursor = self.db.execute("SELECT * FROM images WHERE f_id = ?", (img.f_id,))
+        # Archived images are found as well, so their uploads are reused
+        cursor = self.db.execute(
+            "SELECT * FROM images WHERE f_id = :f_id"
+            " UNION ALL SELECT * FROM images_archive WHERE f_id = :f_id",
+            dict(f_id=img.f_id)
+        )
         row = cursor.fetchone()
         if row is None:
             return
@@ -46,6 +149,7 @@ class ImageDatabase(object):
         l.debug("found image in database: {}", db_img)
         return db_img
 
+    @DB_SECONDS.timed(db='images', call='get_unfinished_images')
     def get_unfinished_images(self):
         results = [ImageInfo(*row)
                    for row in self.db.execute("SELECT * FROM images WHERE finished = 0")]
@@ -53,6 +157,23 @@ class ImageDatabase(object):
         l.debug("found {} unfinished images in database", len(results))
         return results
 
+    @DB_SECONDS.timed(db='images', call='get_cached_images')
+    def get_cached_images(self):
+        # Archived images keep their files until the cache evicts them
+        return [ImageInfo(*row)
+                for row in self.db.execute(
+                    "SELECT * FROM images WHERE local_path IS NOT NULL"
+                    " UNION ALL SELECT * FROM images_archive WHERE local_path IS NOT NULL")]
+
+    @DB_SECONDS.timed(db='images', call='clear_local_path')
+    def clear_local_path(self, local_path):
+        for table in IMAGE_TABLES:
+            self.db.execute("UPDATE {} SET local_path = NULL WHERE local_path = ?".format(table),
+                            (local_path,))
+        self.db.commit()
+        l.debug("cleared local_path in database: {}", local_path)
+
+    @DB_SECONDS.timed(db='images', call='insert_image')
     def insert_image(self, img):
         self.db.execute(
             "INSERT INTO images VALUES (%s)"
@@ -62,16 +183,137 @@ class ImageDatabase(object):
         self.db.commit()
         l.debug("inserted image into database: {}", img)
 
+    @DB_SECONDS.timed(db='images', call='update_image')
     def update_image(self, img):
         update_columns = ('remote_path', 'local_path', 'url', 'finished')
-        self.db.execute(
-            "UPDATE images SET %s WHERE f_id = :f_id"
-            % ", ".join("{0}=:{0}".format(key) for key in update_columns),
-            img._asdict()
-        )
+        for table in IMAGE_TABLES:  # the row is in one of them
+            self.db.execute(
+                "UPDATE %s SET %s WHERE f_id = :f_id"
+                % (table, ", ".join("{0}=:{0}".format(key) for key in update_columns)),
+                img._asdict()
+            )
         self.db.commit()
         l.debug("updated image in database: {}", img)
 
+    @DB_SECONDS.timed(db='images', call='search')
+    def search(self, terms, limit=5, now=None):
+        """Find uploaded images whose caption or username contains all `terms`.
+
+        Of the `SEARCH_CANDIDATES` most recent matches in each of `IMAGE_TABLES`,
+        the best by relevance (bm25) weighted with age are returned.
+        """
+        query = " ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        if not (self.searchable and query):
+            return []
+        now = time.time() if now is None else now
+        matches = " UNION ALL ".join(
+            """SELECT {0}.*, matches.score FROM (
+                SELECT rowid, bm25({0}_fts) AS score FROM {0}_fts
+                WHERE {0}_fts MATCH :query
+                ORDER BY rowid DESC LIMIT :candidates
+            ) AS matches
+            JOIN {0} ON {0}.rowid = matches.rowid""".format(table)
+            for table in IMAGE_TABLES
+        )
+        rows = self.db.execute(
+            """SELECT * FROM ({})
+            WHERE url IS NOT NULL
+            ORDER BY score / (1.0 + max(:now - time, 0) / :half_life)
+            LIMIT :limit""".format(matches),
+            dict(query=query, candidates=SEARCH_CANDIDATES, now=now,
+                 half_life=SEARCH_HALF_LIFE, limit=limit)
+        )
+        return [ImageInfo(*row[:len(ImageInfo._fields)]) for row in rows]
+
+    @DB_SECONDS.timed(db='images', call='archive')
+    def archive(self, finished_before, batch=1000):
+        """Move finished images older than `finished_before` to images_archive.
+
+        Their remote paths are dropped, Telegram's download paths expire.
+        Local files stay in the `ImageCache` budget until it evicts them.
+        Moves `batch` rows per transaction, so other connections can write in between.
+        Returns the number of rows moved.
+        """
+        moved = 0
+        while True:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                rowids = [row[0] for row in self.db.execute(
+                    "SELECT rowid FROM images WHERE finished = 1 AND time < ? LIMIT ?",
+                    (finished_before, batch)
+                )]
+                if rowids:
+                    selected = "rowid IN ({})".format(", ".join(map(str, rowids)))
+                    self.db.execute(
+                        "INSERT INTO images_archive SELECT f_id, time, username, c_id, m_id,"
+                        " caption, ext, NULL, local_path, url, finished FROM images WHERE "
+                        + selected
+                    )
+                    self.db.execute("DELETE FROM images WHERE " + selected)
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                raise
+            moved += len(rowids)
+            if len(rowids) < batch:
+                break
+        if moved:
+            l.info("archived {} images", moved)
+        return moved
+
+    @DB_SECONDS.timed(db='images', call='count_images')
+    def count_images(self):
+        """Return the number of images and of archived images."""
+        return tuple(self.db.execute("SELECT count(*) FROM {}".format(table)).fetchone()[0]
+                     for table in IMAGE_TABLES)
+
+    def database_size(self):
+        """Return the pages in use and free pages in bytes."""
+        page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+        pages = self.db.execute("PRAGMA page_count").fetchone()[0]
+        free = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages - free) * page_size, free * page_size
+
+    @property
+    def incremental_vacuum(self):
+        return self.db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+    def enable_incremental_vacuum(self):
+        """Switch the database to incremental auto-vacuum; returns the number of bytes reclaimed.
+
+        This rewrites the whole database with VACUUM and locks it meanwhile,
+        so it is left to `compact_database.py`, run while the bot is stopped.
+        """
+        before = self._page_count()
+        self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.db.execute("VACUUM")
+        # VACUUM may renumber the rowids the search indexes refer to
+        self.rebuild_search_index()
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return (before - self._page_count()) * self._page_size()
+
+    @DB_SECONDS.timed(db='images', call='compact')
+    def compact(self, max_pages=0):
+        """Return up to `max_pages` free pages (0 for all) to the file system.
+
+        Returns the number of bytes reclaimed,
+        or None if incremental vacuum is not enabled.
+        """
+        if not self.incremental_vacuum:
+            return None
+        before = self._page_count()
+        # Frees one page per step; execute() would only take the first step
+        self.db.executescript("PRAGMA incremental_vacuum({});".format(int(max_pages)))
+        # Also truncate the write-ahead log, or the space moves there
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return (before - self._page_count()) * self._page_size()
+
+    def _page_count(self):
+        return self.db.execute("PRAGMA page_count").fetchone()[0]
+
+    def _page_size(self):
+        return self.db.execute("PRAGMA page_size").fetchone()[0]
+
     def close(self):
         self.db.close()
 
@@ -0,0 +1,97 @@
+from collections import namedtuple
+import logging
+
+from models.db import DB_SECONDS, connect
+
+
+l = logging.getLogger(__name__)
+
+
+JobInfo = namedtuple(
+    'JobInfo',
+    ['f_id', 'state', 'stage', 'attempts', 'next_attempt', 'last_error']
+)
+
+# Job states
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobDatabase(object):
+    """Retry bookkeeping for image jobs, stored next to the `images` table."""
+
+    def __init__(self, dbpath):
+        self.db = connect(dbpath)
+
+        self.create_table()
+
+    def create_table(self):
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                f_id TEXT PRIMARY KEY,
+                state TEXT,
+                stage TEXT,
+                attempts INTEGER,
+                next_attempt REAL,
+                last_error TEXT
+            )"""
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, next_attempt)"
+        )
+
+    def find_job(self, f_id):
+        row = self.db.execute("SELECT * FROM jobs WHERE f_id = ?", (f_id,)).fetchone()
+        return JobInfo(*row) if row else None
+
+    @DB_SECONDS.timed(db='jobs', call='get_due_jobs')
+    def get_due_jobs(self, now, limit=100):
+        return [JobInfo(*row) for row in self.db.execute(
+            "SELECT * FROM jobs WHERE state = ? AND next_attempt <= ? "
+            "ORDER BY next_attempt LIMIT ?",
+            (PENDING, now, limit)
+        )]
+
+    def set_state(self, f_id, state):
+        self.db.execute("UPDATE jobs SET state = ? WHERE f_id = ?", (state, f_id))
+        self.db.commit()
+        l.debug("set job state of {} to {}", f_id, state)
+
+    def reset_running(self):
+        """Reschedule jobs that were running when the process went down."""
+        cursor = self.db.execute("UPDATE jobs SET state = ?, next_attempt = 0 WHERE state = ?",
+                                 (PENDING, RUNNING))
+        self.db.commit()
+        return cursor.rowcount
+
+    @DB_SECONDS.timed(db='jobs', call='record_success')
+    def record_success(self, f_id):
+        self.db.execute(
+            "UPDATE jobs SET state = ?, stage = NULL, last_error = NULL WHERE f_id = ?",
+            (DONE, f_id)
+        )
+        self.db.commit()
+
+    @DB_SECONDS.timed(db='jobs', call='record_failure')
+    def record_failure(self, f_id, stage, error, backoff, max_attempts):
+        """Count a failed attempt and schedule the next one at `backoff(attempts)`."""
+        job = self.find_job(f_id)
+        attempts = (job.attempts if job else 0) + 1
+        state = PENDING if attempts < max_attempts else FAILED
+        job = JobInfo(f_id, state, stage, attempts, backoff(attempts), str(error))
+        self.db.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)", job)
+        self.db.commit()
+        l.debug("recorded failure #{} of {} in stage {}: {}", attempts, f_id, stage, error)
+        return job
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
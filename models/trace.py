@@ -0,0 +1,109 @@
+import logging
+import math
+import time
+
+from models.db import DB_SECONDS, connect
+
+
+l = logging.getLogger(__name__)
+
+
+# Stages in the order they are marked; each mark ends the stage of the same name.
+STAGES = ('received', 'auth', 'file_info', 'download', 'upload', 'irc', 'reply')
+
+
+class Trace(object):
+    """Timeline of a single image job.
+
+    Durations are measured with the monotonic clock;
+    the wall-clock time is only kept to locate the marks in time.
+    """
+
+    def __init__(self):
+        self.marks = []  # (stage, wall-clock time, elapsed seconds since previous mark)
+        self._start = self._last = time.monotonic()
+        self.mark('received')
+
+    def mark(self, stage):
+        now = time.monotonic()
+        self.marks.append((stage, time.time(), now - self._last))
+        self._last = now
+
+    @property
+    def total(self):
+        return self._last - self._start
+
+
+class TraceDatabase(object):
+    def __init__(self, dbpath):
+        self.db = connect(dbpath)
+
+        self.create_table()
+
+    def create_table(self):
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS traces (
+                f_id TEXT,
+                stage TEXT,
+                at REAL,
+                elapsed REAL
+            )"""
+        )
+        # Covering index for the windowed percentile queries
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS traces_stage_at ON traces (stage, at, elapsed)"
+        )
+
+    @DB_SECONDS.timed(db='traces', call='insert_trace')
+    def insert_trace(self, f_id, trace):
+        rows = [(f_id, stage, at, elapsed) for stage, at, elapsed in trace.marks]
+        if trace.marks[-1][0] == 'reply':
+            rows.append((f_id, 'total', trace.marks[-1][1], trace.total))
+        self.db.executemany("INSERT INTO traces VALUES (?, ?, ?, ?)", rows)
+        self.db.commit()
+        l.debug("inserted trace for {}: {}", f_id, trace.marks)
+
+    def count(self, stage, since):
+        return self.db.execute(
+            "SELECT COUNT(*) FROM traces WHERE stage = ? AND at >= ?", (stage, since)
+        ).fetchone()[0]
+
+    @DB_SECONDS.timed(db='traces', call='percentiles')
+    def percentiles(self, stage, since, percentiles=(50, 90, 99)):
+        """Return the number of samples and the requested percentiles (nearest rank)."""
+        # One sorted fetch; the index serves the range, not the order of `elapsed`
+        elapsed = [row[0] for row in self.db.execute(
+            "SELECT elapsed FROM traces WHERE stage = ? AND at >= ? ORDER BY elapsed",
+            (stage, since)
+        )]
+        count = len(elapsed)
+        if not count:
+            return 0, [None] * len(percentiles)
+
+        values = []
+        for p in percentiles:
+            rank = max(0, min(count - 1, math.ceil(p / 100 * count) - 1))
+            values.append(elapsed[rank])
+        return count, values
+
+    @DB_SECONDS.timed(db='traces', call='delete_before')
+    def delete_before(self, at):
+        """Delete the marks made before `at`; returns their number."""
+        deleted = 0
+        # Per stage, so that the (stage, at) index finds them
+        for stage in STAGES + ('total',):
+            deleted += self.db.execute(
+                "DELETE FROM traces WHERE stage = ? AND at < ?", (stage, at)
+            ).rowcount
+        self.db.commit()
+        return deleted
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
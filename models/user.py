@@ -2,6 +2,8 @@ import json
 import logging
 import os
 
+from models.db import DB_SECONDS
+
 
 l = logging.getLogger(__name__)
 
@@ -12,6 +14,7 @@ class UserDatabase(object):
         self._user_cache = None
 
     @property
+    @DB_SECONDS.timed(db='users', call='user_cache')
     def user_cache(self):
         if not self._user_cache:
             if not os.path.exists(self.path):
@@ -32,6 +35,7 @@ class UserDatabase(object):
             l.debug("found {} blacklisted users", len(self._user_cache['blacklist']))
         return self._user_cache
 
+    @DB_SECONDS.timed(db='users', call='write_cache')
     def _write_cache(self):
         if self._user_cache:
             with open(self.path, 'w') as f:
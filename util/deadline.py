@@ -0,0 +1,93 @@
+from threading import Thread
+import time
+
+import metrics
+
+
+ABANDONED = metrics.gauge('abandoned_calls', "Calls still running after their stage timed out",
+                          labels=('stage',))
+
+
+class StageTimeout(Exception):
+    def __init__(self, stage, timeout):
+        super().__init__("stage '{}' timed out after {:g}s".format(stage, timeout))
+        self.stage = stage
+        self.timeout = timeout
+
+
+class Deadline(object):
+    """Overall deadline of a job, combined with per-stage timeouts.
+
+    `None` or `0` disables the respective limit.
+    """
+
+    def __init__(self, total=None):
+        self.total = total
+        self.end = time.monotonic() + total if total else None
+
+    def remaining(self):
+        if self.end is None:
+            return None
+        return self.end - time.monotonic()
+
+    def timeout(self, stage, stage_timeout=None):
+        """Return the timeout for the next stage or raise if the deadline passed already."""
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise StageTimeout(stage, self.total)
+        timeouts = [t for t in (stage_timeout, remaining) if t]
+        return min(timeouts) if timeouts else None
+
+
+def wait_request(request, stage, timeout=None):
+    """Wait for a (started) twx request and raise `StageTimeout` if it takes too long.
+
+    The request's thread should be a daemon thread,
+    so that an abandoned request does not keep the process alive.
+    """
+    request.join(timeout)
+    if request.thread.is_alive():
+        _abandon(request.thread, stage)
+        raise StageTimeout(stage, timeout)
+    return request.wait()
+
+
+def call_with_timeout(func, stage, timeout=None, name=None):
+    """Run `func` in a daemon thread and return its result or raise `StageTimeout`.
+
+    Python threads cannot be killed, so a call that times out is abandoned, not stopped:
+    its thread keeps running, holding its connection and whatever `func` references,
+    until `func` returns by itself.
+    Give `func` a socket timeout as well, so that it does return eventually.
+    Abandoned calls are counted in `ABANDONED` until they end.
+    """
+    result = {}
+
+    def target():
+        try:
+            result['value'] = func()
+        except BaseException as e:
+            result['error'] = e
+
+    thread = Thread(target=target, name=name, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        _abandon(thread, stage)
+        raise StageTimeout(stage, timeout)
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+def _abandon(thread, stage):
+    """Count `thread` in `ABANDONED` until it ends."""
+    if not metrics.REGISTRY.enabled:
+        return
+    ABANDONED.inc(stage=stage)
+
+    def watch():
+        thread.join()
+        ABANDONED.dec(stage=stage)
+
+    Thread(target=watch, name=thread.name + "-abandoned", daemon=True).start()
@@ -0,0 +1,121 @@
+import hashlib
+import logging
+import os
+import time
+
+from .deadline import StageTimeout
+
+
+l = logging.getLogger(__name__)
+
+PART_SUFFIX = ".part"
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadTimeout(StageTimeout):
+    """The download's deadline passed; handled like every other stage timeout."""
+
+    def __init__(self, timeout):
+        super().__init__('download', timeout)
+
+
+class BadStatus(DownloadError):
+    """The server refused the request, e.g. because the URL expired."""
+
+    def __init__(self, status_code):
+        super().__init__("Bad HTTP status code {}".format(status_code))
+        self.status_code = status_code
+
+
+def download(url, out_file, expected_size=None, retries=5, timeout=30, deadline=None,
+             chunk_size=64 * 1024):
+    """Download `url` to `out_file` through a resumable part-file.
+
+    Interrupted transfers are resumed with HTTP Range requests.
+    The part-file is only renamed to `out_file` once its size matches `expected_size`
+    (if known), so `out_file` never refers to a truncated download.
+
+    `deadline` limits the time spent in total, including all retries, in seconds.
+
+    Returns the SHA-256 hex digest of the downloaded file.
+    """
+    import requests
+
+    part_file = out_file + PART_SUFFIX
+    end = time.monotonic() + deadline if deadline else None
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(min(2 ** attempt, 30) * 0.25)
+        if end is not None:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                raise DownloadTimeout(deadline)
+            timeout = min(timeout, remaining)
+
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        if expected_size and offset > expected_size:
+            l.warn("part-file larger than expected ({} > {}), restarting: {}",
+                   offset, expected_size, part_file)
+            os.remove(part_file)
+            offset = 0
+        if expected_size and offset == expected_size:
+            break
+
+        headers = {'Range': "bytes={}-".format(offset)} if offset else {}
+        try:
+            # Not `with`: Response is a context manager only from requests 2.18
+            resp = requests.get(url, headers=headers, stream=True, timeout=timeout)
+            try:
+                if resp.status_code == 416 and offset and not expected_size:
+                    break  # nothing left to fetch
+                elif resp.status_code == 206:
+                    mode = 'ab'
+                elif resp.status_code == 200:
+                    if offset:
+                        l.info("server ignored range request, restarting download")
+                    mode = 'wb'
+                elif 400 <= resp.status_code < 500 and resp.status_code not in (408, 429):
+                    raise BadStatus(resp.status_code)
+                else:
+                    l.warn("download attempt {} failed with status {}", attempt + 1,
+                           resp.status_code)
+                    continue
+
+                with open(part_file, mode) as f:
+                    for chunk in resp.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        if end is not None and time.monotonic() > end:
+                            raise DownloadTimeout(deadline)
+            finally:
+                resp.close()
+
+        except (requests.RequestException, OSError) as e:
+            l.warn("download attempt {} interrupted at {} bytes: {}", attempt + 1,
+                   os.path.getsize(part_file) if os.path.exists(part_file) else 0, e)
+            continue
+
+        if not expected_size or os.path.getsize(part_file) == expected_size:
+            break
+    else:
+        raise DownloadError("Download incomplete after {} attempts".format(retries + 1))
+
+    size = os.path.getsize(part_file)
+    if expected_size and size != expected_size:
+        raise DownloadError("Size mismatch: expected {} bytes, got {}".format(expected_size, size))
+
+    digest = _file_digest(part_file)
+    os.replace(part_file, out_file)
+    l.debug("downloaded {} bytes (sha256 {}) to {}", size, digest, out_file)
+    return digest
+
+
+def _file_digest(path, chunk_size=64 * 1024):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
@@ -0,0 +1,53 @@
+from contextlib import contextmanager
+from functools import partial
+from threading import local
+
+
+def configure_endpoints(conf):
+    from twx import botapi
+
+    # Allow pointing the API clients at other servers, e.g. the fakes in bench/
+    if conf.telegram.api_url:
+        botapi.TelegramBotRPCRequest.api_url_base = conf.telegram.api_url
+    if conf.telegram.file_url:
+        botapi.TelegramDownloadRequest.download_url_base = conf.telegram.file_url
+    if conf.imgur.api_url:
+        import imgurpython.client
+        imgurpython.client.API_URL = conf.imgur.api_url
+
+
+class _TimeoutRequests(object):
+    """Stand-in for the `requests` module in imgurpython, which never sets a timeout.
+
+    Requests made within `imgur_timeout()` use its timeout.
+    """
+
+    def __init__(self):
+        self.local = local()
+
+    def request(self, method, url, **kwargs):
+        import requests
+        kwargs.setdefault('timeout', getattr(self.local, 'timeout', None))
+        return requests.request(method, url, **kwargs)
+
+    def __getattr__(self, name):
+        if name in ('get', 'post', 'put', 'delete'):
+            return partial(self.request, name)
+        import requests
+        return getattr(requests, name)
+
+
+_imgur_requests = _TimeoutRequests()
+
+
+@contextmanager
+def imgur_timeout(timeout):
+    """Give the socket operations of Imgur requests made by this thread a timeout."""
+    import imgurpython.client
+
+    imgurpython.client.requests = _imgur_requests
+    _imgur_requests.local.timeout = timeout
+    try:
+        yield
+    finally:
+        _imgur_requests.local.timeout = None
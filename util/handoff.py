@@ -0,0 +1,175 @@
+"""Hand state and file descriptors from a running process to its successor.
+
+The running process listens on a Unix socket.
+A new process connects, which asks the running one to stop taking work,
+and receives a JSON state together with file descriptors (SCM_RIGHTS).
+Linux only.
+"""
+
+import json
+import logging
+import os
+import socket
+import struct
+from threading import Event, Thread
+
+
+l = logging.getLogger(__name__)
+
+_HEADER = struct.Struct("!I")
+_PEERCRED = struct.Struct("3i")  # pid, uid, gid
+MAX_FDS = 16
+
+
+def send_state(conn, state, socks=()):
+    payload = json.dumps(state).encode('utf-8')
+    data = _HEADER.pack(len(payload)) + payload
+    fds = [s.fileno() for s in socks]
+    # Ancillary data travels with the first bytes
+    sent = socket.send_fds(conn, [data[:4096]], fds) if fds else conn.send(data[:4096])
+    conn.sendall(data[sent:])
+
+
+def recv_state(conn):
+    data, fds, _, _ = socket.recv_fds(conn, 4096, MAX_FDS)
+    socks = [socket.socket(fileno=fd) for fd in fds]
+    try:
+        return json.loads(_recv_payload(conn, data).decode('utf-8')), socks
+    except:
+        for sock in socks:
+            sock.close()
+        raise
+
+
+def _recv_payload(conn, data):
+    while len(data) < _HEADER.size:
+        chunk = conn.recv(4096)
+        if not chunk:
+            raise ConnectionError("handoff connection closed early")
+        data += chunk
+    length = _HEADER.unpack_from(data)[0]
+    data = data[_HEADER.size:]
+    while len(data) < length:
+        chunk = conn.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("handoff connection closed early")
+        data += chunk
+    return data
+
+
+def _valid_state(state, socks):
+    if not isinstance(state, dict) or 'offset' not in state:
+        return False
+    if not isinstance(state['offset'], (int, type(None))):
+        return False
+    irc = state.get('irc') or {}
+    if not isinstance(irc, dict):
+        return False
+    if 'nick' in irc:  # a single connection from before networks existed
+        return len(socks) == 1
+    return all(isinstance(s, dict) and s.get('fd') in range(len(socks)) for s in irc.values())
+
+
+def request_handoff(path, timeout=120):
+    """Take over from the process listening at `path`.
+
+    Returns (state, sockets),
+    or None if no process is listening or the handoff failed;
+    the caller then starts from scratch.
+    """
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except OSError as e:
+        l.info("no process to take over from at {}: {}", path, e)
+        conn.close()
+        return None
+
+    l.warn("taking over from the running process at {}", path)
+    try:
+        with conn:
+            conn.settimeout(timeout)
+            conn.sendall(json.dumps(dict(pid=os.getpid())).encode('utf-8') + b"\n")
+            state, socks = recv_state(conn)
+    except (OSError, ValueError) as e:
+        l.error("handoff from {} failed, starting from scratch: {}", path, e)
+        return None
+    if not _valid_state(state, socks):
+        l.error("invalid handoff state from {}, starting from scratch: {!r}", path, state)
+        for sock in socks:
+            sock.close()
+        return None
+    l.info("received handoff state with {} sockets", len(socks))
+    return state, socks
+
+
+class HandoffServer(Thread):
+    """Waits for a successor and hands over the result of `prepare()`.
+
+    `prepare()` stops taking work and returns (state, sockets);
+    the sockets are closed in this process once they are sent.
+    Only processes of the same user may connect.
+    """
+
+    def __init__(self, path, prepare):
+        super().__init__(name="HandoffServer", daemon=True)
+        self.path = path
+        self.prepare = prepare
+        self.requested = Event()
+        self.done = Event()
+
+        if os.path.exists(path):
+            os.unlink(path)  # stale; a live process would have been taken over
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(path)
+        os.chmod(path, 0o600)
+        self._listener.listen(1)
+
+    def run(self):
+        l.info("waiting for handoff requests at {}", self.path)
+        while True:
+            try:
+                conn, _ = self._listener.accept()
+            except OSError:
+                return  # closed
+            with conn:
+                uid = self._peer_uid(conn)
+                if uid is not None and uid != os.getuid():
+                    l.warn("refused handoff request from user {}", uid)
+                    continue
+                try:
+                    request = json.loads(conn.makefile('rb').readline().decode('utf-8'))
+                except (OSError, ValueError) as e:
+                    l.warn("invalid handoff request: {}", e)
+                    continue
+
+                l.warn("handing over to process {}", request.get('pid'))
+                self.requested.set()
+                state, socks = self.prepare()
+                # The successor binds the path next
+                self.close()
+                try:
+                    send_state(conn, state, socks)
+                except OSError as e:
+                    l.error("handoff failed: {}", e)
+                finally:
+                    for sock in socks:
+                        sock.close()
+                self.done.set()
+                return
+
+    @staticmethod
+    def _peer_uid(conn):
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return None
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _PEERCRED.size)
+        return _PEERCRED.unpack(creds)[1]
+
+    def close(self):
+        self._listener.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,131 @@
+import json
+import logging
+import logging.handlers
+from threading import Lock
+import time
+
+
+class NewStyleLogRecord(logging.LogRecord):
+    """Log record that formats its message with `str.format`, once.
+
+    Records of third-party libraries using %-style formatting are still supported.
+    """
+
+    _message = None
+
+    def getMessage(self):  # noqa
+        if self._message is not None:
+            return self._message
+
+        msg = self.msg
+        if not isinstance(msg, str):
+            msg = str(msg)
+        args = self.args
+        if not isinstance(args, tuple):
+            args = (args,)
+
+        if args and "{" not in msg and "%" in msg:
+            try:
+                msg = msg % args
+            except (TypeError, ValueError):
+                pass
+        elif args:
+            msg = msg.format(*args)
+
+        self._message = msg.rstrip()
+        return self._message
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that defers all formatting to the listener thread.
+
+    The stock `prepare` formats every record in the logging thread;
+    here, records are passed on as they are
+    and only formatted by the handlers that actually emit them.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class ProcessQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler for records that are pickled to another process.
+
+    The message and traceback are formatted here, since the arguments may not be picklable;
+    the other process hands the records to its own loggers.
+    """
+
+    def prepare(self, record):
+        record.getMessage()  # cached in the record
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per message template for records below `max_level`.
+
+    Suppressed records are counted
+    and the count is appended to the next record of the same template that passes.
+    """
+
+    def __init__(self, per_second=10, burst=20, max_level=logging.INFO):
+        super().__init__()
+        self.per_second = per_second
+        self.burst = burst
+        self.max_level = max_level
+        self._buckets = {}  # (logger name, template) -> [tokens, last refill, suppressed]
+        self._lock = Lock()
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.per_second)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record, for structured log processing."""
+
+    def format(self, record):
+        data = dict(
+            time=record.created,
+            level=record.levelname,
+            logger=record.name,
+            thread=record.threadName,
+            message=record.getMessage(),
+        )
+        if getattr(record, 'suppressed', None):
+            data['suppressed'] = record.suppressed
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+class SuppressedCountFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', None)
+        if suppressed:
+            text += " [{} similar messages suppressed]".format(suppressed)
+        return text
@@ -0,0 +1,151 @@
+"""Memory diagnostics of the running process (`/memstats`, SIGUSR1).
+
+The first report starts tracemalloc;
+following reports list the top allocation sites
+and what changed since the previous report,
+next to RSS, threads by name, open file descriptors and queue sizes.
+"""
+
+from collections import Counter
+import logging
+import os
+import re
+from threading import Lock, enumerate as enumerate_threads
+import tracemalloc
+
+
+l = logging.getLogger(__name__)
+
+# Frames stored per allocation; more make sites more precise and tracing more expensive
+FRAMES = 1
+
+_IGNORED = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def thread_group(name):
+    """Thread name with the numeric suffix removed, e.g. 'ImageHandler' for 'ImageHandler-12'."""
+    return re.sub(r"[-_]?\d.*$", "", name) or name
+
+
+def thread_counts():
+    return Counter(thread_group(t.name) for t in enumerate_threads())
+
+
+def fd_counts():
+    """Open file descriptors by kind (file, socket, pipe, ...), or None if unknown."""
+    for fd_dir in ("/proc/self/fd", "/dev/fd"):
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        kinds = Counter()
+        for fd in fds:
+            try:
+                target = os.readlink(os.path.join(fd_dir, fd))
+            except OSError:
+                continue  # closed meanwhile, e.g. the one listdir used
+            kinds[target.split(":", 1)[0] if ":" in target else 'file'] += 1
+        return kinds
+    return None
+
+
+def rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _size(size):
+    return "{:.1f} KiB".format(size / 1024)
+
+
+class MemStats(object):
+    def __init__(self):
+        # name -> callable returning the queue's size or a mapping of sizes by sub-name
+        self.queues = {}
+        self._snapshot = None
+        self._lock = Lock()
+
+    def report(self, top=10):
+        """Return the report as lines of text."""
+        with self._lock:
+            lines = self._process_lines() + self._allocation_lines(top)
+        return lines
+
+    def stop(self):
+        with self._lock:
+            self._snapshot = None
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+                l.info("stopped tracemalloc")
+
+    def _process_lines(self):
+        lines = ["RSS: {} KiB".format(rss_kb() or "?")]
+
+        threads = thread_counts()
+        lines.append("Threads: {} ({})".format(
+            sum(threads.values()),
+            ", ".join("{} {}".format(name, n) for name, n in threads.most_common())))
+
+        fds = fd_counts()
+        if fds is not None:
+            lines.append("File descriptors: {} ({})".format(
+                sum(fds.values()),
+                ", ".join("{} {}".format(kind, n) for kind, n in fds.most_common())))
+
+        sizes = []
+        for name, size in sorted(self.queues.items()):
+            try:
+                size = size()
+            except Exception as e:
+                sizes.append("{} ({})".format(name, e))
+                continue
+            if isinstance(size, dict):
+                sizes.extend("{}.{} {}".format(name, sub, n) for sub, n in size.items())
+            else:
+                sizes.append("{} {}".format(name, size))
+        if sizes:
+            lines.append("Queues: " + ", ".join(sizes))
+        return lines
+
+    def _allocation_lines(self, top):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(FRAMES)
+            self._snapshot = None
+            l.info("started tracemalloc")
+            return ["Started tracemalloc; allocation sites follow in the next report."]
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(_IGNORED)
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ["Traced: {} (peak {}), overhead {}".format(
+            _size(current), _size(peak), _size(tracemalloc.get_tracemalloc_memory()))]
+
+        lines.append("Top allocation sites:")
+        for stat in snapshot.statistics('lineno')[:top]:
+            lines.append("  {} in {} blocks: {}".format(
+                _size(stat.size), stat.count, self._where(stat.traceback)))
+
+        if self._snapshot:
+            lines.append("Changes since last report:")
+            diffs = [d for d in snapshot.compare_to(self._snapshot, 'lineno') if d.size_diff]
+            for diff in diffs[:top]:
+                lines.append("  {:+.1f} KiB ({:+d} blocks): {}".format(
+                    diff.size_diff / 1024, diff.count_diff, self._where(diff.traceback)))
+        self._snapshot = snapshot
+        return lines
+
+    @staticmethod
+    def _where(traceback):
+        frame = traceback[0]
+        parts = frame.filename.split(os.sep)
+        return "{}:{}".format(os.sep.join(parts[-2:]), frame.lineno)
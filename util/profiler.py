@@ -0,0 +1,147 @@
+"""Sampling profiler over all threads (`/profile`, SIGUSR2).
+
+A background thread reads the stack of every other thread from `sys._current_frames()`
+every `profiler.interval` seconds
+and counts identical stacks under the thread's name (without numeric suffix).
+The counts are written in collapsed stack format ("root;caller;callee count"),
+which flamegraph.pl, speedscope and similar tools read.
+Threads waiting on a lock or socket are sampled as well,
+so the profile shows where time passes, not only where CPU is used.
+"""
+
+from collections import Counter
+import logging
+import os
+import sys
+from threading import Lock, Thread, enumerate as enumerate_threads, get_ident
+import time
+
+from .memstats import thread_group
+
+
+l = logging.getLogger(__name__)
+
+
+class Profile(object):
+    def __init__(self):
+        self.stacks = Counter()  # "thread;frame;frame" -> samples
+        self.samples = 0
+        self.duration = 0.0
+        self.sampling_seconds = 0.0  # time spent taking samples
+
+    @property
+    def overhead(self):
+        return self.sampling_seconds / self.duration if self.duration else 0.0
+
+    def write(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+    def summary(self, top=5):
+        """Return the busiest threads and the most sampled innermost frames as lines of text."""
+        threads, leaves = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            thread, _, rest = stack.partition(";")
+            threads[thread] += count
+            leaves[rest.rpartition(";")[2] or thread] += count
+
+        lines = ["{} samples in {:.1f} s, sampling overhead {:.1%}"
+                 .format(self.samples, self.duration, self.overhead)]
+        lines.append("Threads (samples):")
+        lines.extend("  {} {}".format(name, count) for name, count in threads.most_common(top))
+        lines.append("Innermost frames (samples):")
+        lines.extend("  {} {}".format(frame, count) for frame, count in leaves.most_common(top))
+        return lines
+
+
+def _label(code):
+    parts = code.co_filename.split(os.sep)
+    return "{}:{}".format("/".join(parts[-2:]), getattr(code, 'co_qualname', code.co_name))
+
+
+def sample(seconds, interval=0.02):
+    """Sample the stacks of all other threads for `seconds`."""
+    # Stacks are counted as tuples of code objects and only labelled at the end
+    counts = Counter()
+    samples = 0
+    sampling_seconds = 0.0
+    own = get_ident()
+    start = time.monotonic()
+    end = start + seconds
+    while time.monotonic() < end:
+        began = time.perf_counter()
+        names = {t.ident: t.name for t in enumerate_threads()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            codes = [names.get(ident, "unknown")]
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            counts[tuple(codes)] += 1
+        frame = None
+        samples += 1
+        sampling_seconds += time.perf_counter() - began
+        time.sleep(interval)
+
+    profile = Profile()
+    profile.samples = samples
+    profile.sampling_seconds = sampling_seconds
+    profile.duration = time.monotonic() - start
+    labels = {}  # code object -> label
+    for (name, *codes), count in counts.items():
+        stack = [thread_group(name)]
+        for code in reversed(codes):
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = _label(code)
+            stack.append(label)
+        profile.stacks[";".join(stack)] += count
+    return profile
+
+
+def profile_path(directory):
+    return os.path.join(directory, time.strftime("profile-%Y%m%d-%H%M%S.folded"))
+
+
+class SamplingProfiler(object):
+    """Runs one profile at a time in the background."""
+
+    def __init__(self):
+        self._thread = None
+        self._lock = Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, path, interval=0.02, on_done=None):
+        """Start profiling; returns False if a profile is running already.
+
+        `on_done(profile, path)` is called when the profile is written,
+        with None for `profile` if it failed.
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self._thread = Thread(target=self._run, args=(seconds, path, interval, on_done),
+                                  name="Profiler", daemon=True)
+            self._thread.start()
+        l.info("profiling all threads for {} s every {} s", seconds, interval)
+        return True
+
+    def _run(self, seconds, path, interval, on_done):
+        profile = None
+        try:
+            profile = sample(seconds, interval)
+            profile.write(path)
+            l.info("wrote profile of {} samples to {}", profile.samples, path)
+        except Exception:
+            l.exception("profiling failed")
+            profile = None
+        if on_done:
+            on_done(profile, path)
@@ -0,0 +1,67 @@
+from collections import defaultdict
+import logging
+from threading import Condition
+import time
+
+
+l = logging.getLogger(__name__)
+
+
+class ReorderBuffer(object):
+    """Let jobs with the same key pass a step in the order of their sequence numbers.
+
+    Jobs `add` themselves when they are created,
+    `wait` for their turn before the ordered step
+    and `remove` themselves after it, or when they fail before reaching it.
+    A job's turn comes when no job with the same key and a lower number is pending.
+    """
+
+    def __init__(self):
+        self._pending = defaultdict(set)  # key -> sequence numbers
+        self._released = {}  # key -> highest sequence number released
+        self._cond = Condition()
+
+    def add(self, key, seq, max_pending=None):
+        """Register a job; returns False if it is not ordered.
+
+        Jobs arriving after a later job was released already,
+        or beyond `max_pending` jobs of the same key, are not ordered.
+        """
+        with self._cond:
+            if seq <= self._released.get(key, seq - 1):
+                return False
+            if max_pending and len(self._pending.get(key, ())) >= max_pending:
+                l.info("reorder buffer for {} is full; not ordering {}", key, seq)
+                return False
+            self._pending[key].add(seq)
+            return True
+
+    def is_turn(self, key, seq):
+        with self._cond:
+            return seq <= min(self._pending.get(key, ()), default=seq)
+
+    def wait(self, key, seq, timeout=None):
+        """Wait for the job's turn; returns False if `timeout` passed first."""
+        end = time.monotonic() + timeout if timeout else None
+        with self._cond:
+            while seq > min(self._pending.get(key, ()), default=seq):
+                remaining = end - time.monotonic() if end else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def remove(self, key, seq):
+        with self._cond:
+            pending = self._pending.get(key, set())
+            pending.discard(seq)
+            if pending:
+                self._released[key] = max(seq, self._released.get(key, seq))
+            else:
+                self._pending.pop(key, None)
+                self._released.pop(key, None)
+            self._cond.notify_all()
+
+    def __len__(self):
+        with self._cond:
+            return sum(len(pending) for pending in self._pending.values())
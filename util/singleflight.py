@@ -0,0 +1,53 @@
+import logging
+from threading import Event, Lock
+
+
+l = logging.getLogger(__name__)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls with the same key into a single execution.
+
+    The first caller for a key runs the function;
+    callers arriving while it is in flight wait for it and receive its result (or exception).
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, func):
+        """Return a tuple of `func`'s result and whether it was shared with another caller."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            l.debug("waiting for in-flight call: {}", key)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+
+        try:
+            call.value = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value, False